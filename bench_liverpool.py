@@ -0,0 +1,1914 @@
+"""Benchmarks locales del scraper de Liverpool (no tocan liverpool.com.mx).
+
+Uso:
+    python bench_liverpool.py parse [--fixtures DIR] [--repeat N]
+    python bench_liverpool.py json  [--fixtures DIR] [--repeat N]
+    python bench_liverpool.py nextjson [--fixtures DIR] [--items N]
+    python bench_liverpool.py engine [--items N] [--latency S] [--rps R]
+    python bench_liverpool.py listing [--skus N] [--per-page K] [--coverage F] [--verify V]
+    python bench_liverpool.py variants [--products N] [--per-product K]
+    python bench_liverpool.py negative [--skus N] [--dead F] [--days D]
+    python bench_liverpool.py throttle [--items N] [--burst-every K] [--burst-len M]
+    python bench_liverpool.py faults [--deadline S]
+    python bench_liverpool.py cache [--items N] [--changed K]
+    python bench_liverpool.py formats [--days D] [--runs R] [--skus N]
+    python bench_liverpool.py schedule [--history CSV] [--budget B]
+    python bench_liverpool.py pool [--fixtures DIR] [--workers 0 1 2 4]
+    python bench_liverpool.py shards [--items N] [--shards 1 2 4]
+    python bench_liverpool.py catalog [--skus N] [--tag-every K]
+    python bench_liverpool.py metrics [--threads 1 4 16]
+    python bench_liverpool.py rows [--rows N]
+    python bench_liverpool.py transport [--items N] [--threads T] [--latency S]
+    python bench_liverpool.py importtime [--repeat N] [--out R.json] [--baseline R.json]
+    python bench_liverpool.py suite [--items N] [--fixtures DIR] [--out R.json] [--baseline R.json]
+
+Si no se pasa --fixtures se generan PDP sintéticas con la misma forma que
+las reales (__NEXT_DATA__ con query.data.mainContent.records[0].allMeta más
+bastante markup y estado de Next.js alrededor).
+"""
+import argparse
+import contextlib
+import csv
+import glob
+import gzip
+import importlib.util
+import io
+import json
+import os
+import random
+import resource
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List
+
+import liverpool_scraper as ls
+
+
+# ============================================================
+# Fixtures
+# ============================================================
+def make_next_data(code: str, price: float = 1299.0, promo: float = 999.0,
+                   seller: str = "Liverpool", padding_items: int = 300,
+                   build_id: str = "bench-build", variants: List[tuple] = None) -> Dict[str, Any]:
+    """Estado de Next.js parecido al de una PDP real, con ruido alrededor."""
+    noise = [
+        {
+            "id": f"rec-{i}",
+            "title": f"Producto recomendado {i}",
+            "prices": {"listPrice": 100.0 + i, "promoPrice": 90.0 + i},
+            "images": [f"https://ss.example/img/{i}-{j}.jpg" for j in range(4)],
+        }
+        for i in range(padding_items)
+    ]
+    return {
+        "props": {"pageProps": {"navigation": noise[: padding_items // 2], "cms": noise}},
+        "page": "/tienda/pdp/[...slug]",
+        "buildId": build_id,
+        "query": {
+            "data": {
+                "mainContent": {
+                    "records": [make_record(code, price, promo, seller, variants)] + noise[:20],
+                },
+                "reviews": noise[: padding_items // 3],
+            }
+        },
+    }
+
+
+def make_record(code: str, price: float = 1299.0, promo: float = 999.0, seller: str = "Liverpool",
+                variants: List[tuple] = None) -> Dict[str, Any]:
+    """Registro de un producto; `variants` = [(skuId, precio, promo), ...] (default: una sola, `code`)."""
+    return {
+        "_t": f"Producto {code}",
+        "allMeta": {
+            "productId": code,
+            "productDisplayName": f"Producto de prueba {code}",
+            "variants": [
+                {
+                    "skuId": sku,
+                    "skuName": f"Variante {sku}",
+                    "prices": {"listPrice": sku_price, "promoPrice": sku_promo},
+                    "offers": {"bestOffer": {"sellerName": seller}},
+                }
+                for sku, sku_price, sku_promo in (variants or [(code, price, promo)])
+            ],
+        },
+    }
+
+
+def make_listing_html(records: List[Dict[str, Any]], build_id: str = "bench-build") -> bytes:
+    """Página de listado: varios productos en query.data.mainContent.records, más un banner."""
+    data = {
+        "props": {"pageProps": {"facets": [{"id": f"f{i}", "values": list(range(30))} for i in range(20)]}},
+        "page": "/tienda/[...slug]",
+        "buildId": build_id,
+        "query": {"data": {"mainContent": {
+            "records": [{"banner": {"id": "promo-top"}}] + records,
+            "totalNumRecs": len(records),
+        }}},
+    }
+    return _pdp_from_next_data(data)
+
+
+def make_pdp_html(code: str, **kwargs) -> str:
+    next_data = json.dumps(make_next_data(code, **kwargs), ensure_ascii=False)
+    filler = "".join(
+        f'<div class="card"><a href="/tienda/pdp/x/{i}">Producto {i}</a>'
+        f'<style>.c{i}{{color:#{i % 999:03d}}}</style></div>\n'
+        for i in range(3000)
+    )
+    return (
+        "<!DOCTYPE html><html><head><title>PDP</title></head><body>"
+        f"{filler}"
+        f'<script id="__NEXT_DATA__" type="application/json">{next_data}</script>'
+        '<script src="/_next/static/chunks/main.js"></script>'
+        "</body></html>"
+    )
+
+
+def next_json_from_html(html: bytes) -> bytes:
+    """Lo que contestaría /_next/data para esa PDP: sus props y query.data, sin el HTML."""
+    payload = ls.extract_next_data(html)
+    try:
+        data = json.loads(payload)
+    except (TypeError, ValueError):
+        with contextlib.redirect_stdout(io.StringIO()):
+            data = ls._load_next_data_soup(html)
+    if not isinstance(data, dict):
+        return b""
+    page_props = dict((data.get("props") or {}).get("pageProps") or {})
+    page_props.update(data.get("query") or {})
+    return json.dumps({"pageProps": page_props, "__N_SSP": True}, ensure_ascii=False).encode("utf-8")
+
+
+def _pdp_from_next_data(data: Dict[str, Any], script_open: str = '<script id="__NEXT_DATA__" type="application/json">') -> bytes:
+    return (
+        "<!DOCTYPE html><html><head><title>PDP</title></head><body>"
+        + "".join(f'<div class="card"><a href="/tienda/pdp/x/{i}">Producto {i}</a></div>\n' for i in range(1500))
+        + script_open + json.dumps(data, ensure_ascii=False) + "</script></body></html>"
+    ).encode("utf-8")
+
+
+def _variant_record(code: str, edit) -> bytes:
+    data = make_next_data(code, padding_items=150)
+    rec0 = data["query"]["data"]["mainContent"]["records"][0]
+    edit(rec0["allMeta"], rec0["allMeta"]["variants"][0], rec0)
+    return _pdp_from_next_data(data)
+
+
+def _titulo_sin_marca(meta, variant, rec0):
+    meta["TituloSinMarca"] = f"Sin marca {meta['productId']}"
+
+
+def _titulo_solo_t(meta, variant, rec0):
+    del meta["productDisplayName"]
+    del variant["skuName"]
+
+
+def _precios_en_allmeta(meta, variant, rec0):
+    del variant["prices"]
+    meta.update(listPrice=1500.0, salePrice=1200.0)
+
+
+def _precios_alternos(meta, variant, rec0):
+    variant["prices"] = {"regularPrice": 1500.0, "offerPrice": 1100.0}
+
+
+def _vendedor_sellernames(meta, variant, rec0):
+    del variant["offers"]
+    variant["sellernames"] = ["Vendedor Marketplace"]
+
+
+# nombre -> (peso, generador de la página o None = 404, STATUS esperado, columnas que deben venir llenas)
+PDP_VARIANTS = {
+    "normal": (50, lambda code: _pdp_from_next_data(make_next_data(code, padding_items=150)),
+               "OK", ("TITULO", "PRECIO_REGULAR_NUM", "PRECIO_DESCUENTO_NUM", "VENDEDOR")),
+    "titulo_sin_marca": (6, lambda code: _variant_record(code, _titulo_sin_marca), "OK", ("TITULO",)),
+    "titulo_solo_t": (6, lambda code: _variant_record(code, _titulo_solo_t), "OK", ("TITULO",)),
+    "precios_allmeta": (6, lambda code: _variant_record(code, _precios_en_allmeta),
+                        "OK", ("PRECIO_REGULAR_NUM", "PRECIO_DESCUENTO_NUM")),
+    "precios_alternos": (6, lambda code: _variant_record(code, _precios_alternos),
+                         "OK", ("PRECIO_REGULAR_NUM", "PRECIO_DESCUENTO_NUM")),
+    "sellernames": (6, lambda code: _variant_record(code, _vendedor_sellernames), "OK", ("VENDEDOR",)),
+    # HTML válido pero raro: un ">" dentro de un atributo antes del id (en
+    # mayúsculas, sin comillas y en otra línea) que el extractor rápido no
+    # cruza, así que la página sale por el fallback de BeautifulSoup.
+    "bs4_fallback": (6, lambda code: _pdp_from_next_data(
+        make_next_data(code, padding_items=150),
+        '<script data-x="a>b"\nID=__NEXT_DATA__ type="application/json">'),
+        "OK", ("TITULO", "VENDEDOR")),
+    # Señuelos antes del real: un id que solo empieza con __NEXT_DATA__ (la
+    # ruta rápida lo ignora) y uno dentro de un comentario que sí decodifica a
+    # un dict sin records (se recupera con BeautifulSoup).
+    "senuelo": (6, lambda code: _pdp_from_next_data(
+        make_next_data(code, padding_items=150),
+        '<script id="__NEXT_DATA__-cfg">{"a": 1}</script>'
+        '<!-- <script id="__NEXT_DATA__">{"a": 1}</script> -->'
+        '<script id="__NEXT_DATA__" type="application/json">'),
+        "OK", ("TITULO", "VENDEDOR")),
+    "sin_next_data": (7, lambda code: _pdp_from_next_data(None, "<script>window.__x=").replace(b"window.__x=null", b""),
+                      "Formato PDP desconocido", ()),
+    "404": (7, None, "404 PDP", ()),
+}
+
+
+def assign_variants(codes: List[str], seed: int) -> Dict[str, str]:
+    names = list(PDP_VARIANTS)
+    weights = [PDP_VARIANTS[n][0] for n in names]
+    return dict(zip(codes, random.Random(seed).choices(names, weights, k=len(codes))))
+
+
+def split_pdp_path(path: str) -> tuple:
+    """(código, buildId) de /tienda/pdp/<slug>/<código> o de /_next/data/<buildId>/tienda/pdp/<slug>/<código>.json."""
+    path = path.split("?", 1)[0].rstrip("/")
+    build_id = None
+    if path.startswith("/_next/data/"):
+        build_id = path.split("/")[3]
+        if path.endswith(".json"):
+            path = path[:-len(".json")]
+    return path.rsplit("/", 1)[-1], build_id
+
+
+def load_fixtures(fixtures_dir: str, n: int = 5) -> List[bytes]:
+    if fixtures_dir:
+        paths = sorted(glob.glob(os.path.join(fixtures_dir, "*.html")))
+        if not paths:
+            sys.exit(f"No hay *.html en {fixtures_dir}")
+        pages = []
+        for path in paths:
+            with open(path, "rb") as f:
+                pages.append(f.read())
+        return pages
+    return [make_pdp_html(str(1086327259 + i)).encode("utf-8") for i in range(n)]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss viene en KB en Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# ============================================================
+# Servidor local que imita las PDP de Liverpool
+# ============================================================
+class MockLiverpoolServer:
+    """Sirve /tienda/pdp/<slug>/<code> con PDP sintéticas en 127.0.0.1."""
+
+    def __init__(self, latency: float = 0.0, burst_every: int = 0, burst_len: int = 0,
+                 retry_after: str = "", faults: Dict[str, str] = None, hang_seconds: float = 30.0,
+                 pages: Dict[str, bytes] = None, fault_rates: Dict[str, float] = None,
+                 compress: bool = False):
+        self.latency = latency
+        # Content-Encoding según Accept-Encoding (br si hay brotli, si no gzip).
+        self.compress = compress
+        self._encoded: Dict[tuple, bytes] = {}
+        self.connections = 0
+        # Páginas fijas por código (None = 404); los demás códigos reciben una PDP sintética.
+        self.fixed_pages = pages or {}
+        # Probabilidad por status ("429", "403", "500", "503"). Se decide con crc32 de
+        # (código, n-ésima petición a ese código), así que no depende del orden de los hilos.
+        self.fault_rates = fault_rates or {}
+        self._hits_per_code: Dict[str, int] = {}
+        self.status_counts: Dict[int, int] = {}
+        # Fallas por código: "500", "503" (con Retry-After), "hang" o "reset".
+        self.faults = faults or {}
+        self.hang_seconds = hang_seconds
+        # ETag/Last-Modified por página y versión por código (para simular cambios).
+        self.validators = False
+        self.versions: Dict[str, int] = {}
+        self.bytes_sent = 0
+        # Cada `burst_every` peticiones, las siguientes `burst_len` reciben 429.
+        self.burst_every = burst_every
+        self.burst_len = burst_len
+        self.retry_after = retry_after
+        # buildId vigente: /_next/data con otro buildId contesta 404 (como tras un deploy).
+        self.build_id = "bench-build"
+        self._json: Dict[tuple, bytes] = {}
+        # /tienda/listado/<nombre> -> códigos de esa página; precios del listado que
+        # difieren de la PDP (para simular un listado desfasado).
+        self.listings: Dict[str, List[str]] = {}
+        self.listing_prices: Dict[str, float] = {}
+        # Variantes hermanas: código -> (productId, [(skuId, precio, promo), ...]); la PDP
+        # de cualquiera de ellas es la misma página del producto.
+        self.families: Dict[str, tuple] = {}
+        self.requests = 0
+        self.throttled = 0
+        self._pages: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 para que los clientes reutilicen la conexión (keep-alive).
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                    n = server.requests
+                    throttled = bool(server.burst_every) and n % server.burst_every < server.burst_len
+                    server.throttled += throttled
+                if server.latency:
+                    time.sleep(server.latency)
+                code, build_id = split_pdp_path(self.path)
+                injected = server.injected_status(code) if server.fault_rates else None
+                if injected:
+                    self.send_response(injected)
+                    if injected in (429, 503) and server.retry_after:
+                        self.send_header("Retry-After", server.retry_after)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    server.count_status(injected)
+                    return
+                if throttled:
+                    self.send_response(429)
+                    if server.retry_after:
+                        self.send_header("Retry-After", server.retry_after)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                fault = server.faults.get(code)
+                if fault == "reset":
+                    self.close_connection = True
+                    self.connection.shutdown(2)
+                    return
+                if fault == "hang":
+                    time.sleep(server.hang_seconds)
+                if fault in ("500", "503"):
+                    self.send_response(int(fault))
+                    if fault == "503":
+                        self.send_header("Retry-After", "1")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if self.path.startswith("/tienda/listado/"):
+                    status, headers, body = server.listing_response(code)
+                else:
+                    status, headers, body = server.response_for(code, self.headers, build_id)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if body:
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+
+    def injected_status(self, code: str):
+        with self._lock:
+            n = self._hits_per_code.get(code, 0)
+            self._hits_per_code[code] = n + 1
+        roll = zlib.crc32(f"{code}:{n}".encode()) / 2 ** 32
+        for status, rate in sorted(self.fault_rates.items()):
+            if roll < rate:
+                return int(status)
+            roll -= rate
+        return None
+
+    def response_for(self, code: str, request_headers, build_id: str = None) -> tuple:
+        """(status, headers, cuerpo) para una PDP sin fallas inyectadas (la usan HTTP/1.1 y HTTP/2).
+
+        Con `build_id` es la petición a /_next/data: 404 si no es el vigente
+        o si la página no trae __NEXT_DATA__.
+        """
+        if code in self.fixed_pages and self.fixed_pages[code] is None:
+            self.count_status(404)
+            return 404, {"Content-Length": "0"}, b""
+        if build_id is not None and build_id != self.build_id:
+            self.count_status(404)
+            return 404, {"Content-Length": "0"}, b""
+        version = self.versions.get(code, 0)
+        etag = f'"{code}-v{version}{"-json" if build_id else ""}"'
+        if self.validators and request_headers.get("If-None-Match") == etag:
+            self.count_status(304)
+            return 304, {"ETag": etag}, b""
+        body = self.fixed_pages.get(code) or self.page(code)
+        headers = {"Content-Type": "text/html; charset=utf-8"}
+        if build_id is not None:
+            body = self.next_json(code, version, body)
+            if not body:
+                self.count_status(404)
+                return 404, {"Content-Length": "0"}, b""
+            headers = {"Content-Type": "application/json"}
+        accepted = request_headers.get("Accept-Encoding", "") if self.compress else ""
+        encoding = "br" if "br" in accepted and _has_brotli() else "gzip" if "gzip" in accepted else ""
+        if encoding:
+            key = (code, version, encoding, self.build_id, build_id is not None)
+            with self._lock:
+                encoded = self._encoded.get(key)
+            if encoded is None:
+                if encoding == "br":
+                    import brotli
+                    encoded = brotli.compress(body, quality=5)
+                else:
+                    encoded = gzip.compress(body, compresslevel=6)
+                with self._lock:
+                    self._encoded[key] = encoded
+            body = encoded
+            headers["Content-Encoding"] = encoding
+        headers["Content-Length"] = str(len(body))
+        if self.validators:
+            headers["ETag"] = etag
+            headers["Last-Modified"] = "Mon, 05 Oct 2026 11:00:00 GMT"
+        with self._lock:
+            self.bytes_sent += len(body)
+        self.count_status(200)
+        return 200, headers, body
+
+    def listing_response(self, name: str) -> tuple:
+        codes = self.listings.get(name)
+        if not codes:
+            self.count_status(404)
+            return 404, {"Content-Length": "0"}, b""
+        records = [make_record(code, price=self.listing_prices.get(code, 1299.0 + self.versions.get(code, 0)))
+                   for code in codes]
+        body = make_listing_html(records, self.build_id)
+        with self._lock:
+            self.bytes_sent += len(body)
+        self.count_status(200)
+        return 200, {"Content-Type": "text/html; charset=utf-8", "Content-Length": str(len(body))}, body
+
+    def count_status(self, status: int):
+        with self._lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def page(self, code: str) -> bytes:
+        version = self.versions.get(code, 0)
+        key = (code, version, self.build_id)
+        with self._lock:
+            body = self._pages.get(key)
+        if body is None:
+            if code in self.families:
+                product_id, variants = self.families[code]
+                body = make_pdp_html(product_id, build_id=self.build_id, variants=variants).encode("utf-8")
+            else:
+                body = make_pdp_html(code, price=1299.0 + version, build_id=self.build_id).encode("utf-8")
+            with self._lock:
+                self._pages[key] = body
+        return body
+
+    def next_json(self, code: str, version: int, html: bytes) -> bytes:
+        key = (code, version, self.build_id)
+        with self._lock:
+            body = self._json.get(key)
+        if body is None:
+            body = next_json_from_html(html)
+            with self._lock:
+                self._json[key] = body
+        return body
+
+    @property
+    def pdp_url_template(self) -> str:
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}/tienda/pdp/lo-que-sea/{{code}}"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _has_brotli() -> bool:
+    return importlib.util.find_spec("brotli") is not None
+
+
+class H2MockServer:
+    """HTTP/2 sin TLS (h2c con prior knowledge) que sirve las mismas PDP que `source`.
+
+    Cada stream se contesta en su propio hilo, así que varias peticiones
+    viajan multiplexadas sobre una sola conexión. Requiere el paquete h2.
+    """
+
+    def __init__(self, source: MockLiverpoolServer, latency: float = 0.0):
+        self.source = source
+        self.latency = latency
+        self.connections = 0
+        self.streams = 0
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self._closing = False
+
+    @property
+    def pdp_url_template(self) -> str:
+        host, port = self.sock.getsockname()
+        return f"http://{host}:{port}/tienda/pdp/lo-que-sea/{{code}}"
+
+    def _accept_loop(self):
+        while not self._closing:
+            try:
+                conn_sock, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._serve, args=(conn_sock,), daemon=True).start()
+
+    def _serve(self, sock):
+        import h2.config
+        import h2.connection
+        import h2.events
+
+        conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+        cond = threading.Condition()
+        with cond:
+            conn.initiate_connection()
+            sock.sendall(conn.data_to_send())
+        try:
+            while True:
+                data = sock.recv(65535)
+                if not data:
+                    return
+                with cond:
+                    events = conn.receive_data(data)
+                    sock.sendall(conn.data_to_send())
+                    cond.notify_all()
+                for event in events:
+                    if isinstance(event, h2.events.RequestReceived):
+                        self.streams += 1
+                        threading.Thread(target=self._respond, daemon=True,
+                                         args=(sock, conn, cond, event.stream_id, dict(event.headers))).start()
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        return
+        except OSError:
+            return
+        finally:
+            sock.close()
+
+    def _respond(self, sock, conn, cond, stream_id: int, headers: Dict[str, str]):
+        if self.latency:
+            time.sleep(self.latency)
+        code, build_id = split_pdp_path(headers.get(":path", ""))
+        request_headers = {k.title(): v for k, v in headers.items() if not k.startswith(":")}
+        status, resp_headers, body = self.source.response_for(code, request_headers, build_id)
+        try:
+            with cond:
+                conn.send_headers(stream_id, [(":status", str(status))]
+                                  + [(k.lower(), v) for k, v in resp_headers.items()], end_stream=not body)
+                sock.sendall(conn.data_to_send())
+            # Respeta el control de flujo: manda lo que permita la ventana y espera WINDOW_UPDATE.
+            while body:
+                with cond:
+                    window = min(conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size)
+                    if window <= 0:
+                        cond.wait(1.0)
+                        continue
+                    chunk, body = body[:window], body[window:]
+                    conn.send_data(stream_id, chunk, end_stream=not body)
+                    sock.sendall(conn.data_to_send())
+        except OSError:
+            pass
+
+    def __enter__(self):
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._closing = True
+        self.sock.close()
+
+
+@contextlib.contextmanager
+def scraper_against(server: MockLiverpoolServer, codes: List[str], env: Dict[str, str]):
+    """Apunta el scraper al servidor local y corre en una carpeta temporal."""
+    saved = (ls.INPUT_CODES, ls.INPUT_URLS, ls.PDP_URL_TEMPLATE, ls.rate_controller, ls.retry_policy,
+             ls.response_cache)
+    saved_env = {k: os.environ.get(k) for k in env}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            ls.INPUT_CODES = "\n".join(codes)
+            ls.INPUT_URLS = []
+            ls.PDP_URL_TEMPLATE = server.pdp_url_template
+            os.environ.update(env)
+            os.chdir(tmp)
+            yield tmp
+        finally:
+            os.chdir(cwd)
+            (ls.INPUT_CODES, ls.INPUT_URLS, ls.PDP_URL_TEMPLATE, ls.rate_controller, ls.retry_policy,
+             ls.response_cache) = saved
+            for k, v in saved_env.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+
+# ============================================================
+# parse: BeautifulSoup vs extractor en streaming
+# ============================================================
+PARSE_MODES = {
+    "soup": lambda page: ls.parse_product_from_next_data(ls._load_next_data_soup(page)),
+    "fast": ls.parse_product_from_html,
+}
+
+
+def _parse_child(mode: str, fixtures_dir: str, repeat: int):
+    pages = load_fixtures(fixtures_dir)
+    fn = PARSE_MODES[mode]
+    fn(pages[0])  # calentamiento
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            fn(page)
+    elapsed = time.perf_counter() - t0
+    print(json.dumps({
+        "mode": mode,
+        "pages": len(pages) * repeat,
+        "ms_per_page": 1000.0 * elapsed / (len(pages) * repeat),
+        "peak_rss_mb": peak_rss_mb(),
+    }))
+
+
+def bench_parse(args):
+    # Cada modo corre en su propio proceso para que el pico de RSS no se mezcle.
+    results = []
+    for mode in PARSE_MODES:
+        out = subprocess.run(
+            [sys.executable, __file__, "parse", "--child", mode,
+             "--fixtures", args.fixtures, "--repeat", str(args.repeat)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    print(f"{'modo':<6} {'páginas':>8} {'ms/página':>10} {'RSS pico MB':>12}")
+    for r in results:
+        print(f"{r['mode']:<6} {r['pages']:>8} {r['ms_per_page']:>10.2f} {r['peak_rss_mb']:>12.1f}")
+
+
+# ============================================================
+# json: json.loads completo vs decodificación selectiva de records[0]
+# ============================================================
+JSON_MODES = {
+    "full": lambda payload: ls.parse_product_from_next_data(json.loads(payload)),
+    "selective": lambda payload: ls.parse_product_from_record(ls.decode_record_from_next_data(payload)),
+}
+
+
+def bench_json(args):
+    payloads = [ls.extract_next_data(page) for page in load_fixtures(args.fixtures)]
+    payloads = [p for p in payloads if p is not None]
+    if not payloads:
+        sys.exit("Ningún fixture trae __NEXT_DATA__")
+
+    expected = [JSON_MODES["full"](p) for p in payloads]
+    for name, fn in JSON_MODES.items():
+        got = [fn(p) for p in payloads]
+        if got != expected:
+            sys.exit(f"El modo '{name}' no regresa los mismos campos que json.loads")
+
+    print(f"{'modo':<10} {'ms/página':>10} {'bloques':>10} {'pico KB':>10}")
+    for name, fn in JSON_MODES.items():
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            for p in payloads:
+                fn(p)
+        ms = 1000.0 * (time.perf_counter() - t0) / (args.repeat * len(payloads))
+
+        # Asignaciones: bloques vivos mientras se decodifica y pico de memoria.
+        tracemalloc.start()
+        blocks_before = sys.getallocatedblocks()
+        if name == "full":
+            held = json.loads(payloads[0])
+        else:
+            held = ls.decode_record_from_next_data(payloads[0])
+        blocks = sys.getallocatedblocks() - blocks_before
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del held
+        print(f"{name:<10} {ms:>10.2f} {blocks:>10} {peak / 1024:>10.1f}")
+
+
+# ============================================================
+# nextjson: PDP en HTML vs ruta /_next/data/<buildId>/...json
+# ============================================================
+def load_next_json_pairs(fixtures_dir: str) -> List[tuple]:
+    """(html, json) por fixture: usa <nombre>.json grabado junto al .html si existe."""
+    if not fixtures_dir:
+        return [(page, next_json_from_html(page)) for page in load_fixtures("")]
+    pairs = []
+    for path in sorted(glob.glob(os.path.join(fixtures_dir, "*.html"))):
+        with open(path, "rb") as f:
+            html = f.read()
+        json_path = path[:-len(".html")] + ".json"
+        if os.path.exists(json_path):
+            with open(json_path, "rb") as f:
+                body = f.read()
+        else:
+            body = next_json_from_html(html)
+        pairs.append((html, body))
+    if not pairs:
+        sys.exit(f"No hay *.html en {fixtures_dir}")
+    return pairs
+
+
+def _time_per_call(fn, bodies: List[bytes], repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for body in bodies:
+            fn(body)
+    return (time.perf_counter() - t0) / (repeat * len(bodies))
+
+
+def bench_nextjson(args):
+    pairs = load_next_json_pairs(args.fixtures)
+    for i, (html, body) in enumerate(pairs):
+        if ls.parse_product_from_next_json(body) != ls.parse_product_from_html(html):
+            sys.exit(f"El fixture {i} no da el mismo registro por JSON que por HTML")
+    htmls = [html for html, _ in pairs]
+    bodies = [body for _, body in pairs]
+
+    print(f"{len(pairs)} fixtures, promedio por PDP")
+    print(f"{'formato':<8} {'KB':>8} {'KB gzip':>8} {'parseo ms':>10}")
+    for name, pages, fn in (("HTML", htmls, ls.parse_product_from_html),
+                            ("JSON", bodies, ls.parse_product_from_next_json)):
+        raw = sum(len(p) for p in pages) / len(pages)
+        packed = sum(len(gzip.compress(p, compresslevel=6)) for p in pages) / len(pages)
+        ms = 1000.0 * _time_per_call(fn, pages, args.repeat)
+        print(f"{name:<8} {raw / 1024:>8.1f} {packed / 1024:>8.1f} {ms:>10.2f}")
+
+    # De punta a punta contra el servidor local (con compresión): sin la ruta,
+    # con la ruta, y con un deploy (buildId nuevo) justo antes de la corrida.
+    codes = [str(1086000000 + i) for i in range(args.items)]
+    saved_route = ls.next_data_route
+    print(f"\n{args.items} ítems contra el servidor local (latencia {args.latency}s)")
+    print(f"{'corrida':<12} {'seg':>6} {'peticiones':>10} {'KB red/ítem':>12} {'KB cuerpo/ítem':>15} "
+          f"{'parseo p50 ms':>14}  ruta")
+    try:
+        with MockLiverpoolServer(latency=args.latency, compress=True) as server:
+            route = ls.NextDataRoute(ttl=ls.NEXT_BUILD_ID_TTL_DEFAULT,
+                                     max_misses=ls.NEXT_DATA_ROUTE_MAX_MISSES_DEFAULT)
+            for run_name in ("HTML", "/_next/data", "deploy"):
+                if run_name == "deploy":
+                    server.build_id = "bench-build-2"
+                ls.next_data_route = None if run_name == "HTML" else route
+                with scraper_against(server, codes, {"CONCURRENCY": "4", "MAX_LOOPS": "1"}):
+                    ls.rate_controller = ls.RateController(100.0, max_rate=100.0)
+                    ls.stage_metrics = ls.StageMetrics()
+                    server.requests = server.bytes_sent = 0
+                    t0 = time.perf_counter()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        rows = ls.main()
+                    elapsed = time.perf_counter() - t0
+                bad = [r for r in rows if r["STATUS"] != "OK"]
+                if bad:
+                    sys.exit(f"{len(bad)} filas no OK en la corrida {run_name}")
+                report = ls.stage_metrics.report(elapsed)
+                parse_p50 = report["etapas"]["parseo"]["p50_s"] * 1000
+                print(f"{run_name:<12} {elapsed:>6.2f} {server.requests:>10} "
+                      f"{server.bytes_sent / 1024 / len(codes):>12.1f} "
+                      f"{report['bytes_descargados'] / 1024 / len(codes):>15.1f} {parse_p50:>14.2f}  "
+                      f"{ls.next_data_route.summary() if ls.next_data_route else '-'}")
+    finally:
+        ls.next_data_route = saved_route
+
+
+# ============================================================
+# listing: precios desde páginas de listado vs una PDP por SKU
+# ============================================================
+def bench_listing(args):
+    rng = random.Random(args.seed)
+    codes = [str(1086000000 + i) for i in range(args.skus)]
+    covered = rng.sample(codes, int(len(codes) * args.coverage))
+    stale = set(rng.sample(covered, min(args.stale, len(covered))))
+
+    with MockLiverpoolServer(latency=args.latency) as server, tempfile.TemporaryDirectory() as tmp:
+        for i in range(0, len(covered), args.per_page):
+            server.listings[f"page-{i // args.per_page + 1}"] = covered[i:i + args.per_page]
+        for code in stale:
+            server.listing_prices[code] = 1199.0
+        host, port = server.httpd.server_address
+        urls_path = os.path.join(tmp, "listados.txt")
+        with open(urls_path, "w", encoding="utf-8") as f:
+            f.write(f"http://{host}:{port}/tienda/listado/page-{{page}}\n")
+
+        print(f"{len(codes)} SKUs, {len(covered)} en {len(server.listings)} listados de {args.per_page}, "
+              f"{len(stale)} con precio desfasado en el listado")
+        print(f"{'modo':<10} {'seg':>6} {'peticiones':>10} {'filas OK':>9}")
+        for mode in ("PDP", "listados"):
+            env = {"CONCURRENCY": str(args.concurrency), "MAX_LOOPS": "1"}
+            if mode == "listados":
+                env.update(LISTING_URLS=urls_path, LISTING_VERIFY=str(args.verify),
+                           LISTING_MAX_PAGES=str(len(server.listings) + 5))
+            with scraper_against(server, codes, env) as run_dir:
+                ls.rate_controller = ls.RateController(args.rps, max_rate=args.rps)
+                server.requests = 0
+                t0 = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    rows = ls.main()
+                elapsed = time.perf_counter() - t0
+                report = None
+                if mode == "listados":
+                    with open(os.path.join(run_dir, ls.LISTING_REPORT_JSON), "r", encoding="utf-8") as f:
+                        report = json.load(f)
+            ok = sum(1 for r in rows if r["STATUS"] == "OK")
+            print(f"{mode:<10} {elapsed:>6.2f} {server.requests:>10} {ok:>9}")
+
+    print("\n" + ls.format_listing_report(report))
+    detected = {d["SKU"] for d in report["diferencias"]}
+    print(f"\nDesfasados: {len(stale)}; detectados por la muestra: {len(stale & detected)}; "
+          f"publicados desde el listado sin verificar: {len(stale - set(report['sin_cubrir']) - detected)}")
+
+
+# ============================================================
+# variants: SKUs hermanos que comparten PDP
+# ============================================================
+def _variant_price(sku: str) -> float:
+    return 1000.0 + int(sku[-2:])
+
+
+def bench_variants(args):
+    families = []
+    for p in range(args.products):
+        product_id = str(1108984900 + 100 * p)
+        skus = [str(int(product_id) + 1 + v) for v in range(args.per_product)]
+        families.append((product_id, [(sku, _variant_price(sku), _variant_price(sku) - 100) for sku in skus]))
+    codes = [sku for _, variants in families for sku, _, _ in variants]
+    shuffled = random.Random(args.seed).sample(codes, len(codes))
+
+    print(f"{args.products} productos x {args.per_product} variantes = {len(codes)} SKUs, "
+          f"concurrencia {args.concurrency}")
+    print(f"{'corrida':<26} {'seg':>6} {'peticiones':>10} {'precio de su variante':>22} {'con variants[0]':>16}")
+    with MockLiverpoolServer(latency=args.latency) as server, tempfile.TemporaryDirectory() as tmp:
+        for product_id, variants in families:
+            for sku, _, _ in variants:
+                server.families[sku] = (product_id, variants)
+        index_db = os.path.join(tmp, "indice.db")
+        runs = (("1a corrida, en orden", codes), ("1a corrida, revuelto", shuffled),
+                ("2a corrida, con índice", codes))
+        saved = ls.variant_resolver
+        try:
+            for i, (name, run_codes) in enumerate(runs):
+                if i < 2 and os.path.exists(index_db):
+                    os.remove(index_db)
+                ls.variant_resolver = ls.VariantResolver(index_db)
+                with scraper_against(server, run_codes, {"CONCURRENCY": str(args.concurrency), "MAX_LOOPS": "1"}):
+                    ls.rate_controller = ls.RateController(args.rps, max_rate=args.rps)
+                    server.requests = 0
+                    t0 = time.perf_counter()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        rows = ls.main()
+                    elapsed = time.perf_counter() - t0
+                ls.variant_resolver.conn.close()
+                right = sum(1 for r in rows if r["PRECIO_REGULAR_NUM"] == _variant_price(r["SKU"]))
+                # Lo que habría reportado tomar siempre variants[0] de la página.
+                first = sum(1 for r in rows if _variant_price(server.families[r["SKU"]][1][0][0]) == _variant_price(r["SKU"]))
+                print(f"{name:<26} {elapsed:>6.2f} {server.requests:>10} {right:>15}/{len(rows):<6} "
+                      f"{first:>9}/{len(rows):<6}")
+        finally:
+            ls.variant_resolver = saved
+
+
+# ============================================================
+# negative: SKUs muertos día tras día con y sin caché negativa
+# ============================================================
+def _shift_negative_clock(db_path: str, days: float):
+    """Simula que pasaron `days` días: recorre last_seen y skip_until hacia atrás."""
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE negative SET last_seen = last_seen - ?, skip_until = skip_until - ?",
+                 (days * 86400, days * 86400))
+    conn.commit()
+    conn.close()
+
+
+def bench_negative(args):
+    rng = random.Random(args.seed)
+    codes = [str(1086000000 + i) for i in range(args.skus)]
+    dead = rng.sample(codes, int(len(codes) * args.dead))
+    revive = dead[0]
+
+    print(f"{len(codes)} SKUs, {len(dead)} muertos (404); {revive} revive el día {args.revive_day}")
+    print(f"{'día':>4} {'peticiones sin caché':>21} {'peticiones con caché':>21} {'omitidos':>9} "
+          f"{'reprobados':>11} {'filas':>6}  {revive}")
+    saved = ls.negative_cache
+    totals = [0, 0]
+    with MockLiverpoolServer(latency=args.latency) as server, tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "negativa.db")
+        try:
+            for day in range(1, args.days + 1):
+                server.fixed_pages = {code: None for code in dead if not (code == revive and day >= args.revive_day)}
+                counts = []
+                for cached in (False, True):
+                    ls.negative_cache = ls.NegativeCache(
+                        db_path, min_failures=ls.NEGATIVE_MIN_FAILURES_DEFAULT,
+                        base_days=ls.NEGATIVE_TTL_BASE_DAYS_DEFAULT, max_days=ls.NEGATIVE_TTL_MAX_DAYS_DEFAULT,
+                    ) if cached else None
+                    with scraper_against(server, codes, {"CONCURRENCY": str(args.concurrency), "MAX_LOOPS": "1"}):
+                        ls.rate_controller = ls.RateController(args.rps, max_rate=args.rps)
+                        server.requests = 0
+                        with contextlib.redirect_stdout(io.StringIO()) as out:
+                            rows = ls.main()
+                    counts.append(server.requests)
+                    if cached:
+                        ls.negative_cache.conn.close()
+                totals[0] += counts[0]
+                totals[1] += counts[1]
+                if len(rows) != len(codes):
+                    sys.exit(f"Día {day}: {len(rows)} filas para {len(codes)} SKUs")
+                skipped = sum(1 for r in rows if r["STATUS"].startswith(ls.SKIPPED_STATUS))
+                # La pasada de reprueba corre como el loop MAX_LOOPS + 1.
+                probed = sum(1 for line in out.getvalue().splitlines() if line.startswith("[Loop 2] "))
+                revive_status = next(r["STATUS"] for r in rows if r["SKU"] == revive)
+                print(f"{day:>4} {counts[0]:>21} {counts[1]:>21} {skipped:>9} {probed:>11} {len(rows):>6}  {revive_status}")
+                _shift_negative_clock(db_path, 1)
+
+            # Un día en que todo el sitio da 404 (reto anti-bot, rediseño) no debe envenenar la caché.
+            server.fixed_pages = {code: None for code in codes}
+            ls.negative_cache = ls.NegativeCache(
+                db_path, min_failures=ls.NEGATIVE_MIN_FAILURES_DEFAULT,
+                base_days=ls.NEGATIVE_TTL_BASE_DAYS_DEFAULT, max_days=ls.NEGATIVE_TTL_MAX_DAYS_DEFAULT,
+            )
+            before = ls.negative_cache.conn.execute("SELECT COUNT(*) FROM negative").fetchone()[0]
+            with scraper_against(server, codes, {"CONCURRENCY": str(args.concurrency), "MAX_LOOPS": "1"}):
+                ls.rate_controller = ls.RateController(args.rps, max_rate=args.rps)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ls.main()
+            after = ls.negative_cache.conn.execute("SELECT COUNT(*) FROM negative").fetchone()[0]
+            ls.negative_cache.conn.close()
+            if after > before:
+                sys.exit(f"Caída de todo el sitio: la caché negativa pasó de {before} a {after} ítems")
+            print(f"\nDía con todo el sitio en 404: la caché negativa se queda en {after} ítems")
+        finally:
+            ls.negative_cache = saved
+    print(f"\nTotal: {totals[0]} peticiones sin caché negativa vs {totals[1]} con ella "
+          f"({100 * (totals[0] - totals[1]) / totals[0]:.0f}% menos)")
+
+
+# ============================================================
+# engine: items/minuto del motor concurrente contra el servidor local
+# ============================================================
+def bench_engine(args):
+    codes = [str(1086000000 + i) for i in range(args.items)]
+    print(f"{args.items} ítems, latencia {args.latency:.2f}s, límite {args.rps:.2f} req/s")
+    print(f"{'concurrencia':>12} {'segundos':>9} {'ítems/min':>10} {'req/s':>7}")
+    with MockLiverpoolServer(latency=args.latency) as server:
+        for concurrency in args.concurrency:
+            env = {"CONCURRENCY": str(concurrency), "MAX_LOOPS": "1"}
+            with scraper_against(server, codes, env):
+                ls.rate_controller = ls.RateController(args.rps, max_rate=args.rps)
+                server.requests = 0
+                t0 = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    rows = ls.main()
+                elapsed = time.perf_counter() - t0
+            ok = sum(1 for r in rows if r["STATUS"] == "OK")
+            if ok != len(codes):
+                sys.exit(f"Solo {ok}/{len(codes)} filas OK con concurrencia {concurrency}")
+            print(f"{concurrency:>12} {elapsed:>9.1f} {60 * ok / elapsed:>10.1f} "
+                  f"{server.requests / elapsed:>7.2f}")
+
+
+# ============================================================
+# throttle: el control AIMD frente a ráfagas de 429
+# ============================================================
+def bench_throttle(args):
+    codes = [str(1086000000 + i) for i in range(args.items)]
+    saved_backoff = (ls.BACKOFF_BASE, ls.BACKOFF_CAP)
+    samples = []
+    done = threading.Event()
+
+    with MockLiverpoolServer(latency=args.latency, burst_every=args.burst_every,
+                             burst_len=args.burst_len, retry_after=args.retry_after) as server:
+        with scraper_against(server, codes, {"CONCURRENCY": str(args.concurrency), "MAX_LOOPS": "1"}):
+            ls.BACKOFF_BASE, ls.BACKOFF_CAP = args.backoff_base, args.backoff_base * 8
+            ls.rate_controller = ls.RateController(args.rps, max_rate=args.max_rps, increase=args.increase)
+            controller = ls.rate_controller
+
+            def sample():
+                t0 = time.perf_counter()
+                while not done.wait(0.25):
+                    samples.append((time.perf_counter() - t0, controller.metrics()))
+
+            threading.Thread(target=sample, daemon=True).start()
+            t0 = time.perf_counter()
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    rows = ls.main()
+            finally:
+                done.set()
+                ls.BACKOFF_BASE, ls.BACKOFF_CAP = saved_backoff
+            elapsed = time.perf_counter() - t0
+
+    ok = sum(1 for r in rows if r["STATUS"] == "OK")
+    rates = [m["rate_rps"] for _, m in samples] or [controller.rate]
+    print(f"{ok}/{len(codes)} OK en {elapsed:.1f}s ({60 * ok / elapsed:.1f} ítems/min)")
+    print(f"peticiones: {server.requests}  429 servidos: {server.throttled}")
+    print(f"ritmo req/s: inicial {args.rps:.2f}  mín {min(rates):.2f}  máx {max(rates):.2f}  final {controller.rate:.2f}")
+    print("métricas finales:", json.dumps(controller.metrics()))
+    step = max(1, len(samples) // 20)
+    print(f"{'t(s)':>6} {'req/s':>7} {'pausa(s)':>9} {'ratio429':>9}")
+    for t, m in samples[::step]:
+        print(f"{t:>6.1f} {m['rate_rps']:>7.2f} {m['paused_for_s']:>9.2f} {m['ratio_429']:>9.2f}")
+
+
+# ============================================================
+# faults: tiempo máximo por SKU que falla con la política de reintentos
+# ============================================================
+def bench_faults(args):
+    faults = {
+        "2000000001": "500",
+        "2000000002": "503",
+        "2000000003": "hang",
+        "2000000004": "reset",
+    }
+    codes = list(faults) + [str(1086000000 + i) for i in range(args.items)]
+    with MockLiverpoolServer(faults=faults, hang_seconds=args.deadline * 3) as server:
+        with scraper_against(server, codes, {"CONCURRENCY": "4", "MAX_LOOPS": "1"}):
+            ls.rate_controller = ls.RateController(50.0, max_rate=50.0)
+            ls.retry_policy = ls.RetryPolicy(item_deadline=args.deadline, retry_budget=args.budget)
+            t0 = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                rows = ls.main()
+            elapsed = time.perf_counter() - t0
+            policy = ls.retry_policy
+
+    print(f"deadline por ítem {args.deadline:.1f}s, presupuesto {args.budget} reintentos, total {elapsed:.1f}s")
+    print(f"{'SKU':<12} {'falla':<6} {'intentos':>8} {'segundos':>9}  status")
+    worst = 0.0
+    for row in rows:
+        fault = faults.get(row["SKU"])
+        if fault:
+            worst = max(worst, float(row["SEGUNDOS_FETCH"]))
+            print(f"{row['SKU']:<12} {fault:<6} {row['INTENTOS']:>8} {row['SEGUNDOS_FETCH']:>9}  {row['STATUS']}")
+    print(f"peor caso: {worst:.1f}s  reintentos usados: {policy.retries_used}")
+    if worst > args.deadline + 1.0:
+        sys.exit("❌ Un SKU rebasó el deadline")
+
+
+# ============================================================
+# cache: corridas repetidas con la caché HTTP en disco
+# ============================================================
+def bench_cache(args):
+    codes = [str(1086000000 + i) for i in range(args.items)]
+    with tempfile.TemporaryDirectory() as cache_dir, MockLiverpoolServer() as server:
+        server.validators = True
+        print(f"{'corrida':<10} {'seg':>6} {'KB enviados':>12}  caché")
+        for run_name in ("fría", "tibia", "con cambios"):
+            if run_name == "con cambios":
+                for code in codes[:args.changed]:
+                    server.versions[code] = 1
+            with scraper_against(server, codes, {"CONCURRENCY": "4", "MAX_LOOPS": "1"}):
+                ls.rate_controller = ls.RateController(50.0, max_rate=50.0)
+                ls.response_cache = ls.ResponseCache(cache_dir, max_bytes=int(args.max_mb * 1_000_000))
+                server.bytes_sent = 0
+                t0 = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    rows = ls.main()
+                elapsed = time.perf_counter() - t0
+                cache = ls.response_cache
+            bad = [r for r in rows if r["STATUS"] != "OK"]
+            if bad:
+                sys.exit(f"{len(bad)} filas no OK en la corrida {run_name}")
+            print(f"{run_name:<10} {elapsed:>6.1f} {server.bytes_sent / 1024:>12.0f}  {cache.summary()}")
+
+
+# ============================================================
+# formats: historial de precios en CSV vs dataset Parquet por fecha
+# ============================================================
+def _dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def bench_formats(args):
+    import pandas as pd
+
+    rng = random.Random(7)
+    sellers = ["Liverpool", "Marketplace A", "Marketplace B", "Tienda Oficial"]
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_dir = os.path.join(tmp, "csv")
+        pq_dir = os.path.join(tmp, "parquet")
+        os.makedirs(csv_dir)
+        for day in range(args.days):
+            run_date = f"2026-{1 + day // 28:02d}-{1 + day % 28:02d}"
+            for run_idx in range(args.runs):
+                path = os.path.join(csv_dir, f"{run_date}-{run_idx}.csv")
+                sink = ls.ResultSink(path)
+                for i in range(args.skus):
+                    sku = str(1086000000 + i)
+                    price = 500.0 + (i * 37) % 5000
+                    sink.write({
+                        "TIMESTAMP": f"{run_date} {11 + run_idx:02d}:{i % 60:02d}:00",
+                        "SKU": sku,
+                        "URL_PDP": ls.PDP_URL_TEMPLATE.format(code=sku),
+                        "CODIGO_PRODUCTO": sku,
+                        "TITULO": f"Producto de prueba {sku}",
+                        "PRECIO_REGULAR_NUM": price,
+                        "PRECIO_DESCUENTO_NUM": round(price * rng.uniform(0.7, 1.0), 2),
+                        "VENDEDOR": rng.choice(sellers),
+                        "STATUS": "OK" if rng.random() > 0.05 else "404 PDP",
+                        "INTENTOS": 1,
+                        "SEGUNDOS_FETCH": round(rng.uniform(0.3, 3.0), 1),
+                    })
+                sink.close()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ls.write_parquet_partition(path, pq_dir, run_date=run_date)
+
+        def load_csv():
+            frames = [pd.read_csv(os.path.join(csv_dir, name), encoding="utf-8-sig",
+                                  dtype={"SKU": str, "CODIGO_PRODUCTO": str})
+                      for name in sorted(os.listdir(csv_dir))]
+            df = pd.concat(frames, ignore_index=True)
+            df["TIMESTAMP"] = pd.to_datetime(df["TIMESTAMP"])
+            return df
+
+        def load_parquet():
+            return pd.read_parquet(pq_dir)
+
+        rows = args.days * args.runs * args.skus
+        print(f"{rows} filas ({args.days} días x {args.runs} corridas x {args.skus} SKUs)")
+        print(f"{'formato':<8} {'MB':>8} {'carga s':>8}")
+        for name, loader, path in (("csv", load_csv, csv_dir), ("parquet", load_parquet, pq_dir)):
+            t0 = time.perf_counter()
+            df = loader()
+            elapsed = time.perf_counter() - t0
+            assert len(df) == rows
+            print(f"{name:<8} {_dir_size(path) / 1e6:>8.2f} {elapsed:>8.2f}")
+
+
+# ============================================================
+# schedule: planificador por prioridad vs round-robin sobre historiales
+# ============================================================
+def synthetic_histories(skus: int, days: int, volatile: float, seed: int = 11):
+    """{sku: [precio por día]} con una fracción de SKUs volátiles."""
+    rng = random.Random(seed)
+    histories, discounts = {}, {}
+    for i in range(skus):
+        is_volatile = rng.random() < volatile
+        p_change = 0.4 if is_volatile else 0.015
+        price = float(rng.randint(200, 20000))
+        series = []
+        for _ in range(days):
+            if rng.random() < p_change:
+                price = round(price * rng.uniform(0.8, 1.15), 2)
+            series.append(price)
+        key = str(1086000000 + i)
+        histories[key] = series
+        discounts[key] = rng.uniform(0.1, 0.4) if is_volatile else rng.uniform(0.0, 0.15)
+    return histories, discounts
+
+
+def load_histories(path: str):
+    """CSV con columnas fecha, SKU, PRECIO (p.ej. exportado del dataset Parquet)."""
+    by_day: Dict[str, Dict[str, float]] = {}
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            try:
+                by_day.setdefault(row["fecha"], {})[row["SKU"]] = float(row["PRECIO"])
+            except (KeyError, ValueError):
+                continue
+    days = sorted(by_day)
+    skus = sorted({sku for prices in by_day.values() for sku in prices})
+    histories = {}
+    for sku in skus:
+        last, series = None, []
+        for day in days:
+            last = by_day[day].get(sku, last)
+            series.append(last)
+        histories[sku] = series
+    return histories, {sku: 0.0 for sku in skus}
+
+
+def simulate_capture(histories, discounts, budget: int, policy: str):
+    """Cambios de precio vistos antes de ser sobrescritos y su retraso medio (días)."""
+    keys = list(histories)
+    days = len(next(iter(histories.values())))
+    stats: Dict[str, Dict[str, Any]] = {}
+    observed: Dict[str, float] = {}
+    pending_change: Dict[str, int] = {}   # sku -> día del cambio aún no visto
+    captured = total = 0
+    delay = 0
+    pointer = 0
+
+    for day in range(days):
+        now = day * 86400.0
+        for key in keys:
+            series = histories[key]
+            if day and series[day] != series[day - 1] and series[day] is not None:
+                total += 1
+                pending_change[key] = day   # si había uno sin ver, se perdió
+
+        if policy == "round-robin":
+            order = [keys[(pointer + i) % len(keys)] for i in range(min(budget, len(keys)))]
+            pointer = (pointer + budget) % len(keys)
+        else:
+            due, later = ls.plan_refresh(keys, stats, now)
+            order = (due + later)[:budget]
+
+        for key in order:
+            price = histories[key][day]
+            if price is None:
+                continue
+            st = stats.setdefault(key, {"failures": 0, "changes": 0, "discount": discounts[key]})
+            if key in pending_change:
+                captured += 1
+                delay += day - pending_change.pop(key)
+            if observed.get(key) != price:
+                st["last_change"] = now
+                st["changes"] += 1
+            observed[key] = price
+            st["last_fetch"] = now
+
+    return captured, total, (delay / captured if captured else 0.0)
+
+
+def bench_schedule(args):
+    if args.history:
+        histories, discounts = load_histories(args.history)
+    else:
+        histories, discounts = synthetic_histories(args.skus, args.days, args.volatile)
+    n = len(histories)
+    print(f"{n} SKUs, {len(next(iter(histories.values())))} días, presupuesto {args.budget} peticiones/día")
+    print(f"{'política':<12} {'capturados':>11} {'cambios':>8} {'tasa':>6} {'retraso d':>10}")
+    for policy in ("round-robin", "prioridad"):
+        captured, total, mean_delay = simulate_capture(histories, discounts, args.budget, policy)
+        rate = captured / total if total else 0.0
+        print(f"{policy:<12} {captured:>11} {total:>8} {rate:>6.1%} {mean_delay:>10.2f}")
+
+
+# ============================================================
+# pool: throughput de parseo según número de procesos
+# ============================================================
+def bench_pool(args):
+    pages = load_fixtures(args.fixtures, n=20)
+    # Mitad de las páginas por el camino lento (sin __NEXT_DATA__ limpio -> BeautifulSoup).
+    pages = pages + [p.replace(b'id="__NEXT_DATA__"', b"id=__NEXT_DATA__ data-x='>'") for p in pages]
+    total = len(pages) * args.repeat
+    print(f"{total} páginas, {args.fetchers} hilos de descarga simulados, CPUs: {os.cpu_count()}")
+    print(f"{'procesos':>8} {'págs/s':>8}")
+    for workers in args.workers:
+        stage = ls.ParseStage(workers=workers)
+        stage.parse(pages[0])  # arranca el pool fuera de la medición
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(args.fetchers) as fetchers:
+            list(fetchers.map(stage.parse, pages * args.repeat))
+        elapsed = time.perf_counter() - t0
+        stage.close()
+        print(f"{workers:>8} {total / elapsed:>8.1f}")
+
+
+# ============================================================
+# shards: N procesos con SHARD_INDEX/SHARD_COUNT + merge
+# ============================================================
+def _shard_child(args):
+    ls.INPUT_CODES = "\n".join(str(1086000000 + i) for i in range(args.items))
+    ls.INPUT_URLS = []
+    ls.PDP_URL_TEMPLATE = args.template
+    with contextlib.redirect_stdout(io.StringIO()):
+        ls.main()
+
+
+def bench_shards(args):
+    codes = [str(1086000000 + i) for i in range(args.items)]
+    # REQUESTS_PER_SECOND es el total hacia el sitio: cada shard corre a rps / N.
+    print(f"{args.items} ítems, latencia {args.latency:.2f}s, {args.rps:.2f} req/s en total")
+    print(f"{'shards':>6} {'segundos':>9} {'filas':>6} {'ítems/min':>10}")
+    with MockLiverpoolServer(latency=args.latency) as server:
+        for count in args.shards:
+            env = {"MAX_LOOPS": "1", "CONCURRENCY": str(args.concurrency)}
+            with scraper_against(server, codes, env) as tmp:
+                t0 = time.perf_counter()
+                children = [
+                    subprocess.Popen(
+                        [sys.executable, os.path.abspath(__file__), "shards", "--child",
+                         "--items", str(args.items), "--template", server.pdp_url_template],
+                        cwd=tmp,
+                        env={**os.environ, "SHARD_INDEX": str(i), "SHARD_COUNT": str(count),
+                             "REQUESTS_PER_SECOND": str(args.rps), "REQUESTS_PER_SECOND_MAX": str(args.rps),
+                             "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))},
+                    )
+                    for i in range(count)
+                ]
+                if any(child.wait() for child in children):
+                    sys.exit(f"Algún shard terminó con error (shards={count})")
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ls.merge_shards(tmp)
+                    ls.finalize_outputs()
+                    ls.stage_metrics = ls.StageMetrics()
+                    report = ls.merge_run_reports(tmp)
+                elapsed = time.perf_counter() - t0
+                with open(ls.RESULTS_CSV, "r", encoding="utf-8-sig", newline="") as f:
+                    rows = list(csv.DictReader(f))
+            if report["items"] != len(codes):
+                sys.exit(f"El reporte combinado cuenta {report['items']} ítems, no {len(codes)}")
+            if [r["SKU"] for r in rows] != codes or any(r["STATUS"] != "OK" for r in rows):
+                sys.exit(f"El merge con {count} shards no cubre los {len(codes)} códigos en orden")
+            print(f"{count:>6} {elapsed:>9.1f} {len(rows):>6} {60 * len(rows) / elapsed:>10.1f}")
+
+
+# ============================================================
+# catalog: arranque con INPUT_CODES gigante vs catálogo de texto / SQLite
+# ============================================================
+def _time_items(make_iter):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    it = make_iter()
+    next(it)
+    first = time.perf_counter() - t0
+    n = 1 + sum(1 for _ in it)
+    total = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return first, total, n, peak
+
+
+def bench_catalog(args):
+    codes = [str(1000000000 + i) for i in range(args.skus)]
+    saved = ls.INPUT_CODES, ls.INPUT_URLS
+    with tempfile.TemporaryDirectory() as tmp:
+        txt = os.path.join(tmp, "catalogo.txt")
+        with open(txt, "w", encoding="utf-8") as f:
+            for i, code in enumerate(codes):
+                f.write(code + ("\telectronics\n" if i % args.tag_every == 0 else "\thogar\n"))
+        db = os.path.join(tmp, "catalogo.db")
+        with contextlib.redirect_stdout(io.StringIO()):
+            ls.import_catalog(db, txt)
+        catalog = ls.SkuCatalog(db)
+        cases = [
+            ("INPUT_CODES", lambda: ls.dedupe_items(ls.builtin_items())),
+            ("texto", lambda: ls.dedupe_items(ls.iter_catalog_file(txt))),
+            ("texto tag", lambda: ls.dedupe_items(ls.iter_catalog_file(txt, ["electronics"]))),
+            ("sqlite", lambda: ls.dedupe_items(catalog.iter_items())),
+            ("sqlite tag", lambda: ls.dedupe_items(catalog.iter_items(["electronics"]))),
+        ]
+        print(f"{args.skus} SKUs (1 de cada {args.tag_every} con tag=electronics)")
+        print(f"{'fuente':>12} {'1er ítem ms':>12} {'total ms':>9} {'ítems':>7} {'pico MB':>8}")
+        try:
+            ls.INPUT_CODES, ls.INPUT_URLS = "\n".join(codes), []
+            for name, make_iter in cases:
+                first, total, n, peak = _time_items(make_iter)
+                print(f"{name:>12} {first * 1e3:>12.2f} {total * 1e3:>9.1f} {n:>7} {peak:>8.1f}")
+        finally:
+            ls.INPUT_CODES, ls.INPUT_URLS = saved
+            catalog.close()
+
+
+# ============================================================
+# metrics: costo de la instrumentación por etapa
+# ============================================================
+def bench_metrics(args):
+    n = args.observations
+    print(f"{n} mediciones por hilo")
+    print(f"{'hilos':>5} {'observe ns':>11} {'timed ns':>9}")
+    for threads in args.threads:
+        metrics = ls.StageMetrics()
+
+        def observe_loop(_):
+            for i in range(n):
+                metrics.observe("red", (i % 1000) * 1e-4)
+
+        def timed_loop(_):
+            for _ in range(n):
+                with metrics.timed("parseo"):
+                    pass
+
+        row = []
+        for fn in (observe_loop, timed_loop):
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(threads) as pool:
+                list(pool.map(fn, range(threads)))
+            row.append((time.perf_counter() - t0) / (n * threads) * 1e9)
+        print(f"{threads:>5} {row[0]:>11.0f} {row[1]:>9.0f}")
+    ls.stage_metrics = metrics
+    t0 = time.perf_counter()
+    text = ls.render_prometheus()
+    print(f"render_prometheus: {(time.perf_counter() - t0) * 1e3:.2f} ms, {len(text.splitlines())} líneas")
+    hist = metrics.stages["red"]
+    print(f"p50/p95/p99 de 'red' (uniforme 0-0.1s): "
+          f"{hist.quantile(0.5):.4f} / {hist.quantile(0.95):.4f} / {hist.quantile(0.99):.4f}")
+
+
+# ============================================================
+# suite: main() de punta a punta, determinista, para comparar commits
+# ============================================================
+def _suite_child(args):
+    codes = json.loads(os.environ["BENCH_CODES"])
+    ls.INPUT_CODES = "\n".join(codes)
+    ls.INPUT_URLS = []
+    ls.PDP_URL_TEMPLATE = args.template
+    cpu0 = resource.getrusage(resource.RUSAGE_SELF)
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ls.main()
+    elapsed = time.perf_counter() - t0
+    cpu1 = resource.getrusage(resource.RUSAGE_SELF)
+    with open(ls.RUN_REPORT_JSON, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    print(json.dumps({
+        "segundos": elapsed,
+        "cpu_s": (cpu1.ru_utime - cpu0.ru_utime) + (cpu1.ru_stime - cpu0.ru_stime),
+        "rss_pico_mb": peak_rss_mb(),
+        "reporte": report,
+    }))
+
+
+def bench_suite(args):
+    codes = [str(1086000000 + i) for i in range(args.items)]
+    if args.fixtures:
+        # PDP grabadas: se reparten en orden entre los códigos.
+        recorded = load_fixtures(args.fixtures)
+        pages = {code: recorded[i % len(recorded)] for i, code in enumerate(codes)}
+        variants = {code: "grabada" for code in codes}
+    else:
+        variants = assign_variants(codes, args.seed)
+        pages = {}
+        for code in codes:
+            builder = PDP_VARIANTS[variants[code]][1]
+            pages[code] = builder(code) if builder else None
+    fault_rates = {k: v for k, v in (("429", args.rate_429), ("403", args.rate_403),
+                                     ("500", args.rate_5xx / 2), ("503", args.rate_5xx / 2)) if v}
+
+    with MockLiverpoolServer(latency=args.latency, retry_after="1", pages=pages, fault_rates=fault_rates) as server:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {
+                **os.environ,
+                "BENCH_CODES": json.dumps(codes),
+                "CONCURRENCY": str(args.concurrency),
+                "MAX_LOOPS": "1",
+                "REQUESTS_PER_SECOND": str(args.rps),
+                "REQUESTS_PER_SECOND_MAX": str(args.rps),
+                "SLEEP_SCALE": str(args.time_scale),
+                "PYTHONPATH": os.path.dirname(os.path.abspath(__file__)),
+            }
+            for var in ("CATALOG", "SHARD_COUNT", "SHARD_INDEX", "JOURNAL_DB", "SNAPSHOT_DB", "HTTP_CACHE_DIR",
+                        "PARSE_CACHE_DB", "PARQUET_DIR", "METRICS_TEXTFILE", "METRICS_PORT"):
+                env.pop(var, None)
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "suite", "--child", "--template", server.pdp_url_template],
+                cwd=tmp, env=env, capture_output=True, text=True, check=True,
+            ).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            with open(os.path.join(tmp, ls.RESULTS_CSV), "r", encoding="utf-8-sig", newline="") as f:
+                rows = {row["SKU"]: row for row in csv.DictReader(f)}
+
+    # Cada variante debe terminar con su STATUS y sus columnas llenas (salvo fallas inyectadas).
+    mismatches = []
+    if not args.fixtures:
+        for code, name in variants.items():
+            _, _, expected, filled = PDP_VARIANTS[name]
+            row = rows.get(code, {})
+            if row.get("STATUS", "").startswith("HTTP error"):
+                continue
+            if row.get("STATUS") != expected or any(not row.get(col) for col in filled):
+                mismatches.append((code, name, row.get("STATUS")))
+
+    report = result["reporte"]
+    summary = {
+        "items": len(codes),
+        "segundos": round(result["segundos"], 2),
+        "items_por_s": round(len(codes) / result["segundos"], 2),
+        "cpu_s": round(result["cpu_s"], 2),
+        "cpu_ms_por_item": round(1000 * result["cpu_s"] / len(codes), 2),
+        "rss_pico_mb": round(result["rss_pico_mb"], 1),
+        "status": report["status"],
+        "http": {str(k): v for k, v in sorted(server.status_counts.items())},
+        "etapas": {name: {k: st[k] for k in ("n", "p50_s", "p95_s", "p99_s", "suma_s")}
+                   for name, st in report["etapas"].items()},
+        "config": {k: v for k, v in vars(args).items() if k not in ("child", "template", "out", "baseline")},
+    }
+
+    print(f"{len(codes)} ítems, latencia {args.latency}s, sleeps x{args.time_scale}, "
+          f"fallas {fault_rates or 'ninguna'}")
+    print(f"{summary['items_por_s']} ítems/s  CPU {summary['cpu_s']}s ({summary['cpu_ms_por_item']} ms/ítem)  "
+          f"RSS pico {summary['rss_pico_mb']} MB  en {summary['segundos']}s")
+    print("status:", summary["status"], " respuestas HTTP:", summary["http"])
+    print(f"{'etapa':<18} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'total s':>8}")
+    for name, st in summary["etapas"].items():
+        print(f"{name:<18} {st['n']:>6} {st['p50_s'] * 1e3:>8.1f} {st['p95_s'] * 1e3:>8.1f} "
+              f"{st['p99_s'] * 1e3:>8.1f} {st['suma_s']:>8.2f}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            base = json.load(f)
+        print(f"\ncontra {args.baseline}:")
+        for key in ("items_por_s", "cpu_ms_por_item", "rss_pico_mb"):
+            old, new = base.get(key), summary[key]
+            if old:
+                print(f"  {key:<16} {old:>9} -> {new:<9} ({100 * (new - old) / old:+.1f}%)")
+        for name, st in summary["etapas"].items():
+            old = base.get("etapas", {}).get(name)
+            if old and old["p50_s"]:
+                print(f"  p50 {name:<12} {old['p50_s'] * 1e3:>8.2f} -> {st['p50_s'] * 1e3:<8.2f} ms "
+                      f"({100 * (st['p50_s'] - old['p50_s']) / old['p50_s']:+.1f}%)")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"\nResultados en {args.out}")
+    if mismatches:
+        sys.exit(f"❌ {len(mismatches)} ítems no dieron el resultado esperado, p. ej. {mismatches[:3]}")
+
+
+# ============================================================
+# rows: memoria de all_results con dicts por fila vs ResultRow (slots)
+# ============================================================
+def _dict_row(i: int) -> Dict[str, Any]:
+    return {
+        "TIMESTAMP": "2026-10-18 05:00:00", "SKU": str(1086000000 + i),
+        "URL_PDP": ls.PDP_URL_TEMPLATE.format(code=1086000000 + i),
+        "CODIGO_PRODUCTO": str(1086000000 + i), "TITULO": f"Producto de prueba {i}",
+        "PRECIO_REGULAR_NUM": 1299.0 + i, "PRECIO_DESCUENTO_NUM": 999.0 + i, "VENDEDOR": "Liverpool",
+        "STATUS": "OK", "INTENTOS": 1, "SEGUNDOS_FETCH": 0.4,
+    }
+
+
+def _slot_row(i: int):
+    info = {"CODIGO_PRODUCTO": str(1086000000 + i), "TITULO": f"Producto de prueba {i}",
+            "PRECIO_REGULAR_NUM": 1299.0 + i, "PRECIO_DESCUENTO_NUM": 999.0 + i, "VENDEDOR": "Liverpool"}
+    return ls.make_result_row("2026-10-18 05:00:00", str(1086000000 + i),
+                              ls.PDP_URL_TEMPLATE.format(code=1086000000 + i), "OK", info,
+                              {"attempts": 1, "seconds": 0.4})
+
+
+def _dict_tsv(row: Dict[str, Any]) -> str:
+    # row_to_tsv tal como era con filas dict.
+    def fmt(x):
+        if x is None:
+            return ""
+        s = str(x)
+        return s.replace("\t", " ").replace("\r", " ").replace("\n", " ").strip()
+    return "\t".join(fmt(row.get(col, "")) for col in ls.COLUMNS)
+
+
+def bench_rows(args):
+    import pandas as pd
+
+    cases = [
+        ("dict", _dict_row, _dict_tsv, lambda rows: pd.DataFrame(rows, columns=ls.COLUMNS)),
+        ("ResultRow", _slot_row, ls.row_to_tsv,
+         lambda rows: pd.DataFrame([row.values() for row in rows], columns=ls.COLUMNS)),
+    ]
+    print(f"{args.rows} filas")
+    print(f"{'fila':>10} {'MB filas':>9} {'pico DF MB':>11} {'armar s':>8} {'tsv s':>7} {'DataFrame s':>12}")
+    for name, make, to_tsv, to_df in cases:
+        # Memoria (con tracemalloc) y tiempos (sin él) en pasadas separadas.
+        tracemalloc.start()
+        rows = [make(i) for i in range(args.rows)]
+        held = tracemalloc.get_traced_memory()[0] / 1e6
+        tracemalloc.reset_peak()
+        df = to_df(rows)
+        peak = tracemalloc.get_traced_memory()[1] / 1e6 - held
+        tracemalloc.stop()
+        del rows, df
+
+        t0 = time.perf_counter()
+        rows = [make(i) for i in range(args.rows)]
+        build = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for row in rows:
+            to_tsv(row)
+        tsv = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        df = to_df(rows)
+        frame = time.perf_counter() - t0
+        assert len(df) == args.rows
+        del rows, df
+        print(f"{name:>10} {held:>9.1f} {peak:>11.1f} {build:>8.2f} {tsv:>7.2f} {frame:>12.2f}")
+
+
+# ============================================================
+# importtime: costo de importar el scraper (python -X importtime)
+# ============================================================
+HEAVY_MODULES = ("requests", "urllib3", "bs4", "lxml", "pandas", "numpy", "xlsxwriter", "pyarrow",
+                 "httpx", "asyncio", "multiprocessing", "smtplib", "ssl")
+
+_IMPORT_CHILD = """
+import json, sys
+import liverpool_scraper as ls
+if sys.argv[1] == "csv":
+    with open(sys.argv[2], "rb") as f:
+        info = ls.parse_product_from_html(f.read())
+    sink = ls.ResultSink(sys.argv[3])
+    sink.write(ls.make_result_row("2026-10-18 05:00:00", info["CODIGO_PRODUCTO"], "", "OK", info))
+    sink.close()
+print(json.dumps(sorted(m for m in json.loads(sys.argv[4]) if m in sys.modules)))
+"""
+
+def _parse_importtime(stderr: str):
+    """(µs acumulados de liverpool_scraper, [(µs, módulo)] de sus imports directos)."""
+    direct = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        if depth == 0:
+            if name.strip() == "liverpool_scraper":
+                return int(cumulative), sorted(direct, reverse=True)
+            direct = []
+        elif depth == 1:
+            direct.append((int(cumulative), name.strip()))
+    raise RuntimeError("python -X importtime no reportó liverpool_scraper")
+
+def bench_importtime(args):
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))}
+    env.pop("PYTHONPROFILEIMPORTTIME", None)
+    with tempfile.TemporaryDirectory() as tmp:
+        html_path = os.path.join(tmp, "pdp.html")
+        with open(html_path, "w", encoding="utf-8") as f:
+            f.write(make_pdp_html("1086327259"))
+        summary = {}
+        print(f"{'camino':<8} {'import ms':>10} {'mín ms':>8} {'proceso ms':>11}  módulos pesados cargados")
+        for mode in ("import", "csv"):
+            cmd = [sys.executable, "-X", "importtime", "-c", _IMPORT_CHILD, mode, html_path,
+                   os.path.join(tmp, "out.csv"), json.dumps(HEAVY_MODULES)]
+            imports, walls = [], []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                proc = subprocess.run(cmd, cwd=tmp, env=env, capture_output=True, text=True, check=True)
+                walls.append(time.perf_counter() - t0)
+                total, direct = _parse_importtime(proc.stderr)
+                imports.append(total)
+            loaded = json.loads(proc.stdout.strip().splitlines()[-1])
+            imports.sort()
+            walls.sort()
+            summary[mode] = {
+                "import_ms": round(imports[len(imports) // 2] / 1e3, 1),
+                "proceso_ms": round(1e3 * walls[len(walls) // 2], 1),
+                "cargados": loaded,
+            }
+            print(f"{mode:<8} {summary[mode]['import_ms']:>10} {imports[0] / 1e3:>8.1f} "
+                  f"{summary[mode]['proceso_ms']:>11}  {', '.join(loaded) or '(ninguno)'}")
+        print("\nimports directos más caros de liverpool_scraper (última corrida):")
+        for us, name in direct[:args.top]:
+            print(f"  {us / 1e3:>7.1f} ms  {name}")
+
+    if "pandas" in summary["csv"]["cargados"]:
+        print("⚠️ El camino parse + CSV cargó pandas")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            base = json.load(f)
+        print(f"\ncontra {args.baseline}:")
+        for mode, st in summary.items():
+            old = base.get(mode, {}).get("import_ms")
+            if old:
+                print(f"  {mode:<8} {old:>8} -> {st['import_ms']:<8} ms ({100 * (st['import_ms'] - old) / old:+.1f}%)")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"\nResultados en {args.out}")
+
+
+# ============================================================
+# transport: requests vs httpx (HTTP/1.1 y HTTP/2), con y sin compresión
+# ============================================================
+def bench_transport(args):
+    codes = [str(1086000000 + i) for i in range(args.items)]
+    identity = {**ls.HTTP_HEADERS, "Accept-Encoding": "identity"}
+    cases = [
+        ("requests h1 identity", lambda: ls.RequestsTransport(args.pool, headers=identity), "h1"),
+        (f"requests h1 {ls.ACCEPT_ENCODING.split(',')[0]}", lambda: ls.RequestsTransport(args.pool), "h1"),
+    ]
+    if importlib.util.find_spec("httpx"):
+        cases.append(("httpx h1", lambda: ls.HttpxTransport(args.pool, http2=False), "h1"))
+        if importlib.util.find_spec("h2"):
+            cases.append(("httpx h2", lambda: ls.HttpxTransport(args.pool, http2="prior"), "h2"))
+    else:
+        print("(sin httpx instalado: solo se mide requests)")
+
+    print(f"{args.items} PDP, {args.threads} hilos, latencia {args.latency}s, Accept-Encoding '{ls.ACCEPT_ENCODING}'")
+    print(f"{'transporte':<22} {'seg':>6} {'PDP/s':>7} {'conexiones':>10} {'MB red':>7} {'MB cuerpo':>9}  versión")
+    with MockLiverpoolServer(latency=args.latency, compress=True) as h1:
+        h2_server = H2MockServer(h1, latency=args.latency) if importlib.util.find_spec("h2") else None
+        with h2_server or contextlib.nullcontext():
+            for name, make, proto in cases:
+                server = h1 if proto == "h1" else h2_server
+                t = make()
+                t.get(server.pdp_url_template.format(code="calentamiento"))
+                before = server.connections
+                wire = decoded = 0
+                versions = set()
+                lock = threading.Lock()
+
+                def fetch(code):
+                    nonlocal wire, decoded
+                    r = t.get(server.pdp_url_template.format(code=code))
+                    info = ls.parse_product_from_html(r.content)
+                    if r.status_code != 200 or info.get("CODIGO_PRODUCTO") != code:
+                        raise RuntimeError(f"{name}: respuesta inesperada para {code}")
+                    with lock:
+                        wire += t.wire_bytes(r)
+                        decoded += len(r.content)
+                        versions.add(t.http_version(r))
+
+                t0 = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(args.threads) as pool:
+                    list(pool.map(fetch, codes))
+                elapsed = time.perf_counter() - t0
+                t.close()
+                print(f"{name:<22} {elapsed:>6.2f} {len(codes) / elapsed:>7.1f} {server.connections - before:>10} "
+                      f"{wire / 1e6:>7.1f} {decoded / 1e6:>9.1f}  {', '.join(sorted(versions))}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("parse", help="BeautifulSoup vs extractor rápido de __NEXT_DATA__")
+    p.add_argument("--fixtures", default="", help="carpeta con PDP guardadas (*.html)")
+    p.add_argument("--repeat", type=int, default=20)
+    p.add_argument("--child", default="", help=argparse.SUPPRESS)
+
+    p = sub.add_parser("json", help="json.loads completo vs decodificación selectiva")
+    p.add_argument("--fixtures", default="", help="carpeta con PDP guardadas (*.html)")
+    p.add_argument("--repeat", type=int, default=50)
+
+    p = sub.add_parser("nextjson", help="bytes y parseo por PDP: HTML vs /_next/data/<buildId>/...json")
+    p.add_argument("--fixtures", default="", help="carpeta con PDP guardadas (*.html, y opcional <nombre>.json)")
+    p.add_argument("--repeat", type=int, default=20)
+    p.add_argument("--items", type=int, default=40)
+    p.add_argument("--latency", type=float, default=0.02)
+
+    p = sub.add_parser("engine", help="items/minuto con concurrencia 1, 4 y 16")
+    p.add_argument("--items", type=int, default=40)
+    p.add_argument("--latency", type=float, default=1.0, help="segundos por respuesta del servidor")
+    p.add_argument("--rps", type=float, default=ls.REQUESTS_PER_SECOND_DEFAULT * 10,
+                   help="límite global de peticiones/segundo (default: 10x el de producción)")
+    p.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+
+    p = sub.add_parser("listing", help="peticiones por corrida: listados + PDP de lo no cubierto vs solo PDP")
+    p.add_argument("--skus", type=int, default=400)
+    p.add_argument("--per-page", type=int, default=48)
+    p.add_argument("--coverage", type=float, default=0.9, help="fracción de SKUs que aparece en algún listado")
+    p.add_argument("--stale", type=int, default=5, help="SKUs cuyo precio en el listado no coincide con la PDP")
+    p.add_argument("--verify", type=int, default=ls.LISTING_VERIFY_DEFAULT)
+    p.add_argument("--seed", type=int, default=3)
+    p.add_argument("--latency", type=float, default=0.01)
+    p.add_argument("--rps", type=float, default=200.0)
+    p.add_argument("--concurrency", type=int, default=8)
+
+    p = sub.add_parser("variants", help="peticiones y precio correcto con SKUs hermanos de un mismo producto")
+    p.add_argument("--products", type=int, default=40)
+    p.add_argument("--per-product", type=int, default=5)
+    p.add_argument("--seed", type=int, default=5)
+    p.add_argument("--latency", type=float, default=0.02)
+    p.add_argument("--rps", type=float, default=200.0)
+    p.add_argument("--concurrency", type=int, default=4)
+
+    p = sub.add_parser("negative", help="peticiones por día con SKUs muertos: sin vs con caché negativa")
+    p.add_argument("--skus", type=int, default=200)
+    p.add_argument("--dead", type=float, default=0.2, help="fracción de SKUs que dan 404")
+    p.add_argument("--days", type=int, default=12)
+    p.add_argument("--revive-day", type=int, default=6, help="día en que uno de los muertos vuelve a existir")
+    p.add_argument("--seed", type=int, default=9)
+    p.add_argument("--latency", type=float, default=0.005)
+    p.add_argument("--rps", type=float, default=500.0)
+    p.add_argument("--concurrency", type=int, default=8)
+
+    p = sub.add_parser("throttle", help="control AIMD contra ráfagas de 429 inyectadas")
+    p.add_argument("--items", type=int, default=50)
+    p.add_argument("--latency", type=float, default=0.05)
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--rps", type=float, default=2.0, help="ritmo inicial")
+    p.add_argument("--max-rps", type=float, default=10.0)
+    p.add_argument("--increase", type=float, default=0.05, help="aumento aditivo por respuesta limpia")
+    p.add_argument("--burst-every", type=int, default=25)
+    p.add_argument("--burst-len", type=int, default=3)
+    p.add_argument("--retry-after", default="", help="valor del header Retry-After en los 429")
+    p.add_argument("--backoff-base", type=float, default=0.1, help="BACKOFF_BASE escalado para el bench")
+
+    p = sub.add_parser("faults", help="peor tiempo por SKU con 5xx, cuelgues y resets")
+    p.add_argument("--deadline", type=float, default=6.0)
+    p.add_argument("--budget", type=int, default=50)
+    p.add_argument("--items", type=int, default=8, help="SKUs sanos que acompañan a los rotos")
+
+    p = sub.add_parser("cache", help="hits/304/descargas con la caché HTTP en disco")
+    p.add_argument("--items", type=int, default=30)
+    p.add_argument("--changed", type=int, default=5, help="páginas que cambian en la tercera corrida")
+    p.add_argument("--max-mb", type=float, default=200)
+
+    p = sub.add_parser("formats", help="carga y tamaño: CSV vs Parquet particionado por fecha")
+    p.add_argument("--days", type=int, default=90)
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--skus", type=int, default=400)
+
+    p = sub.add_parser("schedule", help="tasa de cambios capturados: prioridad vs round-robin")
+    p.add_argument("--history", default="", help="CSV fecha,SKU,PRECIO con historial real")
+    p.add_argument("--skus", type=int, default=400)
+    p.add_argument("--days", type=int, default=60)
+    p.add_argument("--volatile", type=float, default=0.1, help="fracción de SKUs volátiles (sintético)")
+    p.add_argument("--budget", type=int, default=150)
+
+    p = sub.add_parser("pool", help="páginas/s parseadas con 0 (en línea), 1, 2, 4... procesos")
+    p.add_argument("--fixtures", default="", help="carpeta con PDP guardadas (*.html)")
+    p.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4])
+    p.add_argument("--fetchers", type=int, default=16)
+    p.add_argument("--repeat", type=int, default=3)
+
+    p = sub.add_parser("shards", help="N shards como procesos aparte contra el servidor local + merge")
+    p.add_argument("--items", type=int, default=40)
+    p.add_argument("--latency", type=float, default=0.2)
+    p.add_argument("--rps", type=float, default=4.0, help="límite total de peticiones/segundo (se reparte entre shards)")
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    p.add_argument("--template", default="", help=argparse.SUPPRESS)
+
+    p = sub.add_parser("catalog", help="tiempo al primer ítem: INPUT_CODES vs catálogo texto/SQLite")
+    p.add_argument("--skus", type=int, default=50000)
+    p.add_argument("--tag-every", type=int, default=20)
+
+    p = sub.add_parser("metrics", help="ns por medición de stage_metrics (observe / timed)")
+    p.add_argument("--observations", type=int, default=200000)
+    p.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16])
+
+    p = sub.add_parser("rows", help="memoria/tiempo de 100k filas: dict por fila vs ResultRow")
+    p.add_argument("--rows", type=int, default=100000)
+
+    p = sub.add_parser("transport", help="requests vs httpx h1/h2, bytes en la red vs decodificados")
+    p.add_argument("--items", type=int, default=60)
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--pool", type=int, default=ls.HTTP_POOL_MAXSIZE)
+    p.add_argument("--latency", type=float, default=0.05)
+
+    p = sub.add_parser("importtime", help="ms de importar el scraper y qué dependencias pesadas carga")
+    p.add_argument("--repeat", type=int, default=7)
+    p.add_argument("--top", type=int, default=8, help="imports directos a listar")
+    p.add_argument("--out", default="", help="guardar el resumen en JSON")
+    p.add_argument("--baseline", default="", help="JSON de una corrida anterior para comparar")
+
+    p = sub.add_parser("suite", help="main() de punta a punta contra PDP variadas, con CPU/RSS/etapas")
+    p.add_argument("--items", type=int, default=120)
+    p.add_argument("--fixtures", default="", help="carpeta con PDP grabadas (*.html) en lugar de las sintéticas")
+    p.add_argument("--seed", type=int, default=7, help="semilla del reparto de variantes")
+    p.add_argument("--latency", type=float, default=0.05)
+    p.add_argument("--rps", type=float, default=40.0)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--rate-429", type=float, default=0.03)
+    p.add_argument("--rate-403", type=float, default=0.01)
+    p.add_argument("--rate-5xx", type=float, default=0.03)
+    p.add_argument("--time-scale", type=float, default=0.02,
+                   help="SLEEP_SCALE del scraper: factor para pausas por 429/403 y esperas entre reintentos")
+    p.add_argument("--out", default="", help="guardar el resumen en JSON")
+    p.add_argument("--baseline", default="", help="JSON de una corrida anterior para comparar")
+    p.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    p.add_argument("--template", default="", help=argparse.SUPPRESS)
+
+    args = ap.parse_args()
+    if args.cmd == "parse":
+        if args.child:
+            _parse_child(args.child, args.fixtures, args.repeat)
+        else:
+            bench_parse(args)
+    elif args.cmd == "json":
+        bench_json(args)
+    elif args.cmd == "nextjson":
+        bench_nextjson(args)
+    elif args.cmd == "engine":
+        bench_engine(args)
+    elif args.cmd == "listing":
+        bench_listing(args)
+    elif args.cmd == "variants":
+        bench_variants(args)
+    elif args.cmd == "negative":
+        bench_negative(args)
+    elif args.cmd == "throttle":
+        bench_throttle(args)
+    elif args.cmd == "faults":
+        bench_faults(args)
+    elif args.cmd == "cache":
+        bench_cache(args)
+    elif args.cmd == "formats":
+        bench_formats(args)
+    elif args.cmd == "schedule":
+        bench_schedule(args)
+    elif args.cmd == "pool":
+        bench_pool(args)
+    elif args.cmd == "transport":
+        bench_transport(args)
+    elif args.cmd == "importtime":
+        bench_importtime(args)
+    elif args.cmd == "rows":
+        bench_rows(args)
+    elif args.cmd == "suite":
+        if args.child:
+            _suite_child(args)
+        else:
+            bench_suite(args)
+    elif args.cmd == "metrics":
+        bench_metrics(args)
+    elif args.cmd == "catalog":
+        bench_catalog(args)
+    elif args.cmd == "shards":
+        if args.child:
+            _shard_child(args)
+        else:
+            bench_shards(args)
+
+
+if __name__ == "__main__":
+    main()
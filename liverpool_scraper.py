@@ -1,16 +1,32 @@
 import os
 import sys
+import csv
 import time
+import threading
 import json
+import gzip
+import hashlib
+import sqlite3
 import random
+import math
+import uuid
+import re
+import glob
+import bisect
+import contextlib
+import dataclasses
+import zlib
+import importlib.util
+from collections import Counter, deque
+from operator import attrgetter
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from urllib.parse import urlsplit, urlunsplit
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Tuple, Union
 
-import requests
-import pandas as pd
-from bs4 import BeautifulSoup
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+# requests, bs4, xlsxwriter, asyncio, pandas, pyarrow, httpx y smtplib se
+# importan dentro de las funciones que los usan: importar el módulo (p. ej.
+# solo para parse_product_from_html, o en un shard corto) no paga su costo.
 
 # ============================================================
 # 1) CÓDIGOS DE LIVERPOOL (uno por línea, puedes comentar con #)
@@ -386,6 +402,9 @@ INPUT_CODES = """
 
 """.strip()
 
+# Para listas grandes usa un catálogo externo (CATALOG=catalogo.db o .txt, ver 7e);
+# si está definido, INPUT_CODES / INPUT_URLS se ignoran.
+
 # Si algún día quieres pasar URLs PDP directas, puedes llenarlo:
 INPUT_URLS: List[str] = [
     # "https://www.liverpool.com.mx/tienda/pdp/lo-que-sea/1175413363",
@@ -408,8 +427,38 @@ MAX_RETRIES = 7
 BACKOFF_BASE = 4.0
 BACKOFF_CAP = 90.0
 
+# Tope de tiempo por ítem (esperas + intentos) y de reintentos por corrida.
+ITEM_DEADLINE_SECONDS_DEFAULT = 180.0
+RETRY_BUDGET_DEFAULT = 300
+
+HTTP_CACHE_MAX_MB_DEFAULT = 200
+PARSE_CACHE_MAX_AGE_DAYS_DEFAULT = 30
+PARSE_CACHE_VERSION = 2  # súbelo si cambia lo que regresa parse_product_from_record
+
+# Planificador: los SKUs estables se refrescan cada vez menos seguido.
+PRIORITY_MAX_INTERVAL_DAYS = 7.0
+PRIORITY_STABLE_DAYS_PER_STEP = 14.0
+PRIORITY_HIGH_DISCOUNT = 0.2
+
 ROLLING_WINDOW = 6
-ALPHA_SENSITIVITY = 1.2
+
+# Motor concurrente: varias PDP en vuelo, pero el ritmo global de peticiones
+# lo marca un token bucket compartido. El default equivale a la espera
+# inicial promedio de antes (1 petición cada ~4.5 s).
+CONCURRENCY_DEFAULT = 4
+REQUESTS_PER_SECOND_DEFAULT = 2.0 / sum(INITIAL_WAIT_RANGE)
+HTTP_POOL_MAXSIZE = 16
+HTTP_KEEPALIVE_SECONDS = 60.0
+
+# Control adaptativo (AIMD): sube el ritmo poco a poco mientras el sitio
+# responde limpio y lo parte a la mitad con cada ráfaga de 429/403.
+REQUESTS_PER_SECOND_MIN = 0.05
+REQUESTS_PER_SECOND_MAX_DEFAULT = 1.0
+AIMD_INCREASE = 0.01   # req/s que se suman por respuesta limpia
+AIMD_DECREASE = 0.5    # factor al recibir 429/403
+
+# Solo para benchmarks locales: escala las pausas por 429/403 y las esperas entre reintentos.
+SLEEP_SCALE = float(os.getenv("SLEEP_SCALE", "1"))
 
 UA = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
@@ -418,27 +467,441 @@ UA = (
 )
 
 # ============================================================
-# 3) Sesión HTTP con retry básico (5xx)
+# 3) Transporte HTTP (los reintentos los decide retry_policy, no el cliente)
 # ============================================================
-session = requests.Session()
-session.headers.update({
+def _module_available(*names: str) -> bool:
+    return any(importlib.util.find_spec(name) is not None for name in names)
+
+# br solo si hay decodificador instalado; si no, el servidor nos mandaría algo ilegible.
+ACCEPT_ENCODING = "br, gzip, deflate" if _module_available("brotli", "brotlicffi") else "gzip, deflate"
+
+HTTP_HEADERS = {
     "User-Agent": UA,
     "Accept-Language": "es-MX,es;q=0.9,en;q=0.8",
     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Encoding": ACCEPT_ENCODING,
     "Referer": "https://www.liverpool.com.mx/",
     "Cache-Control": "no-cache",
-})
-retry = Retry(
-    total=MAX_RETRIES,
-    connect=MAX_RETRIES,
-    read=MAX_RETRIES,
-    backoff_factor=0.5,
-    status_forcelist=[500, 502, 503, 504],
-    allowed_methods=["GET", "HEAD"],
-    raise_on_status=False,
-)
-session.mount("http://", HTTPAdapter(max_retries=retry))
-session.mount("https://", HTTPAdapter(max_retries=retry))
+}
+
+class RequestsTransport:
+    """requests/urllib3 (HTTP/1.1) con keep-alive y un pool por host.
+
+    `pool_block=True`: si los hilos rebasan el pool esperan una conexión libre
+    en lugar de abrir conexiones de usar y tirar.
+    """
+
+    name = "requests"
+
+    def __init__(self, pool_maxsize: int = HTTP_POOL_MAXSIZE, headers: Optional[Dict[str, str]] = None):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.errors = (requests.RequestException,)
+        self.session = requests.Session()
+        self.session.headers.update(headers or HTTP_HEADERS)
+        adapter = HTTPAdapter(max_retries=0, pool_connections=4, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.headers = self.session.headers
+
+    def get(self, url: str, headers: Optional[Dict[str, str]] = None, allow_redirects: bool = True,
+            timeout: float = 40):
+        return self.session.get(url, headers=headers, allow_redirects=allow_redirects, timeout=timeout)
+
+    @staticmethod
+    def wire_bytes(r) -> int:
+        # urllib3 cuenta lo leído del socket antes de descomprimir.
+        return r.raw.tell() if r.raw is not None else len(r.content)
+
+    @staticmethod
+    def http_version(r) -> str:
+        return "HTTP/1.1" if getattr(r.raw, "version", 11) == 11 else "HTTP/1.0"
+
+    def close(self):
+        self.session.close()
+
+class HttpxTransport:
+    """httpx con HTTP/2 (opcional: pip install httpx[http2]).
+
+    Con HTTP/2 todas las peticiones al mismo host van multiplexadas sobre una
+    conexión. `http2="prior"` habla HTTP/2 sin negociar (h2c, p. ej. contra un
+    servidor local sin TLS).
+    """
+
+    name = "httpx"
+
+    def __init__(self, pool_maxsize: int = HTTP_POOL_MAXSIZE, headers: Optional[Dict[str, str]] = None,
+                 http2: Union[bool, str] = True, keepalive: float = HTTP_KEEPALIVE_SECONDS):
+        import httpx
+
+        self.errors = (httpx.HTTPError,)
+        self.client = httpx.Client(
+            http1=http2 != "prior",
+            http2=bool(http2),
+            headers=headers or HTTP_HEADERS,
+            limits=httpx.Limits(
+                max_connections=pool_maxsize,
+                max_keepalive_connections=pool_maxsize,
+                keepalive_expiry=keepalive,
+            ),
+        )
+        self.headers = self.client.headers
+
+    def get(self, url: str, headers: Optional[Dict[str, str]] = None, allow_redirects: bool = True,
+            timeout: float = 40):
+        return self.client.get(url, headers=headers, follow_redirects=allow_redirects, timeout=timeout)
+
+    @staticmethod
+    def wire_bytes(r) -> int:
+        return r.num_bytes_downloaded
+
+    @staticmethod
+    def http_version(r) -> str:
+        return r.http_version
+
+    def close(self):
+        self.client.close()
+
+def build_transport() -> Union[RequestsTransport, HttpxTransport]:
+    """HTTP_TRANSPORT=requests (default) | httpx; con httpx, HTTP2=1 (default) | 0 | prior."""
+    pool_maxsize = int(os.getenv("HTTP_POOL_MAXSIZE", str(HTTP_POOL_MAXSIZE)))
+    if os.getenv("HTTP_TRANSPORT", "requests") == "httpx":
+        http2 = os.getenv("HTTP2", "1")
+        if http2 != "0" and not _module_available("h2"):
+            print("⚠️ HTTP2 pedido pero falta el paquete h2 (pip install httpx[http2]); se usa HTTP/1.1.")
+            http2 = "0"
+        return HttpxTransport(pool_maxsize, http2="prior" if http2 == "prior" else http2 != "0")
+    return RequestsTransport(pool_maxsize)
+
+# Se crea en la primera petición (get_transport), no al importar.
+transport: Optional[Union[RequestsTransport, HttpxTransport]] = None
+_transport_lock = threading.Lock()
+
+def get_transport() -> Union[RequestsTransport, HttpxTransport]:
+    global transport
+    if transport is None:
+        with _transport_lock:
+            if transport is None:
+                transport = build_transport()
+    return transport
+
+# ============================================================
+# 3b) Métricas por etapa (siempre activas: un lock y un bisect por medición)
+# ============================================================
+# Cubetas fijas de 0.5 ms a ~7 min, cada una 2^(1/4) ≈ 19% más ancha que la anterior.
+STAGE_BUCKETS = tuple(0.0005 * 2 ** (i / 4) for i in range(80))
+RUN_REPORT_JSON = "liverpool_reporte.json"
+
+class Histogram:
+    """Conteos por cubeta (`value <= bound`) más suma y máximo; percentiles interpolados."""
+
+    def __init__(self, bounds: Tuple[float, ...] = STAGE_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lo = self.bounds[i - 1] if i > 0 else 0.0
+                hi = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(self.max, lo + (hi - lo) * (rank - seen) / n)
+            seen += n
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "n": self.count,
+            "suma_s": round(self.total, 3),
+            "p50_s": round(self.quantile(0.50), 4),
+            "p95_s": round(self.quantile(0.95), 4),
+            "p99_s": round(self.quantile(0.99), 4),
+            "max_s": round(self.max, 4),
+            # Cubetas no vacías, para poder combinar reportes de varios shards.
+            "cubetas": {str(i): n for i, n in enumerate(self.counts) if n},
+        }
+
+    def merge_dict(self, d: Dict[str, Any]):
+        for i, n in d.get("cubetas", {}).items():
+            self.counts[int(i)] += n
+        self.count += d.get("n", 0)
+        self.total += d.get("suma_s", 0.0)
+        self.max = max(self.max, d.get("max_s", 0.0))
+
+class StageMetrics:
+    """Tiempos por etapa, contadores y status de la corrida (compartido entre hilos).
+
+    Las subetapas de parseo (extraer_next_data, decodificar_json, bs4_fallback)
+    solo se miden cuando se parsea en el mismo proceso; con PARSE_WORKERS queda
+    el total de "parseo" visto desde el hilo de descarga.
+    """
+
+    SLEEP_STAGES = ("espera_turno", "pausa_429", "espera_reintento")
+    WORK_STAGES = ("red", "parseo", "guardar")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self.statuses: Dict[str, int] = {}
+        # (nombre, etiquetas) -> valor; avance por loop para el exportador.
+        self.gauges: Dict[tuple, float] = {}
+
+    def observe(self, stage: str, seconds: float):
+        with self.lock:
+            hist = self.stages.get(stage)
+            if hist is None:
+                hist = self.stages[stage] = Histogram()
+            hist.observe(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, stage: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    def add(self, counter: str, n: float = 1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def add_gauge(self, name: str, n: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + n
+
+    def count_status(self, status: str):
+        # "Error: <detalle>" se agrupa como "Error".
+        key = str(status).split(":", 1)[0]
+        with self.lock:
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def report(self, wall_seconds: float) -> Dict[str, Any]:
+        with self.lock:
+            stages = {name: hist.to_dict() for name, hist in sorted(self.stages.items())}
+            counters = dict(self.counters)
+            statuses = dict(self.statuses)
+        sleep_s = sum(stages[s]["suma_s"] for s in self.SLEEP_STAGES if s in stages)
+        work_s = sum(stages[s]["suma_s"] for s in self.WORK_STAGES if s in stages)
+        items = int(counters.get("items", 0))
+        return {
+            "generado": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "segundos": round(wall_seconds, 1),
+            "items": items,
+            "items_por_min": round(60 * items / wall_seconds, 2) if wall_seconds > 0 else 0.0,
+            "bytes_descargados": int(counters.get("bytes", 0)),
+            "bytes_en_red": int(counters.get("bytes_wire", 0)),
+            "peticiones": int(counters.get("requests", 0)),
+            "sleep_s": round(sleep_s, 1),
+            "trabajo_s": round(work_s, 1),
+            "ratio_sleep_trabajo": round(sleep_s / work_s, 2) if work_s > 0 else None,
+            "status": statuses,
+            "etapas": stages,
+        }
+
+    def merge_report(self, report: Dict[str, Any]):
+        """Suma un reporte ya escrito (p. ej. de otro shard) a estas métricas."""
+        with self.lock:
+            for name, d in report.get("etapas", {}).items():
+                self.stages.setdefault(name, Histogram()).merge_dict(d)
+            for counter, key in (("items", "items"), ("bytes", "bytes_descargados"),
+                                 ("bytes_wire", "bytes_en_red"), ("requests", "peticiones")):
+                self.counters[counter] = self.counters.get(counter, 0) + report.get(key, 0)
+            for status, n in report.get("status", {}).items():
+                self.statuses[status] = self.statuses.get(status, 0) + n
+
+stage_metrics = StageMetrics()
+
+# ============================================================
+# 3c) Exportador Prometheus (opt-in: METRICS_TEXTFILE y/o METRICS_PORT)
+# ============================================================
+METRICS_INTERVAL_DEFAULT = 15.0
+# Solo local por default; METRICS_HOST=0.0.0.0 para exponerlo en todas las interfaces.
+METRICS_HOST_DEFAULT = "127.0.0.1"
+# Para Prometheus basta una cubeta de cada cuatro (cada una el doble de la anterior).
+METRICS_BUCKET_STEP = 4
+
+def _prom_labels(labels) -> str:
+    if not labels:
+        return ""
+    inner = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+    return "{" + inner + "}"
+
+def render_prometheus() -> str:
+    """Métricas actuales en formato de texto de Prometheus (0.0.4)."""
+    lines: List[str] = []
+
+    def metric(name: str, kind: str, help_text: str, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            lines.append(f"{name}{suffix}{_prom_labels(labels)} {value}")
+
+    with stage_metrics.lock:
+        counters = dict(stage_metrics.counters)
+        statuses = dict(stage_metrics.statuses)
+        gauges = dict(stage_metrics.gauges)
+        stages = {name: (list(h.counts), h.count, h.total) for name, h in stage_metrics.stages.items()}
+
+    metric("liverpool_items_total", "counter", "Ítems terminados por status.",
+           [("", (("status", st),), n) for st, n in sorted(statuses.items())])
+    metric("liverpool_requests_total", "counter", "Peticiones HTTP hechas.",
+           [("", (), int(counters.get("requests", 0)))])
+    metric("liverpool_bytes_fetched_total", "counter", "Bytes de cuerpos HTTP recibidos (ya descomprimidos).",
+           [("", (), int(counters.get("bytes", 0)))])
+    metric("liverpool_bytes_wire_total", "counter", "Bytes de cuerpos HTTP tal como llegaron por la red.",
+           [("", (), int(counters.get("bytes_wire", 0)))])
+    by_name: Dict[str, list] = {}
+    for (name, labels), value in sorted(gauges.items()):
+        by_name.setdefault(name, []).append(("", labels, value))
+    for name, samples in by_name.items():
+        metric(f"liverpool_{name}", "gauge", f"Avance de la corrida ({name}).", samples)
+    metric("liverpool_ratio_429", "gauge", "Fracción de 429/403 en la ventana reciente.",
+           [("", (), round(current_429_ratio(), 4))])
+    metric("liverpool_rate_rps", "gauge", "Ritmo actual del token bucket (req/s).",
+           [("", (), round(rate_controller.rate, 4))])
+    metric("liverpool_throttle_pause_seconds", "gauge", "Pausa global restante por 429/403.",
+           [("", (), round(rate_controller.pause_remaining(), 2))])
+    metric("liverpool_retries_used", "gauge", "Reintentos gastados del presupuesto de la corrida.",
+           [("", (), retry_policy.retries_used)])
+
+    samples = []
+    for name, (counts, count, total) in sorted(stages.items()):
+        cumulative = 0
+        for i, n in enumerate(counts[:-1]):
+            cumulative += n
+            if i % METRICS_BUCKET_STEP == METRICS_BUCKET_STEP - 1:
+                samples.append(("_bucket", (("le", f"{STAGE_BUCKETS[i]:.4g}"), ("stage", name)), cumulative))
+        samples.append(("_bucket", (("le", "+Inf"), ("stage", name)), count))
+        samples.append(("_sum", (("stage", name),), round(total, 6)))
+        samples.append(("_count", (("stage", name),), count))
+    metric("liverpool_stage_seconds", "histogram", "Duración por etapa del pipeline.", samples)
+
+    metric("liverpool_last_update_timestamp_seconds", "gauge", "Momento en que se generaron estas métricas.",
+           [("", (), round(time.time(), 3))])
+    return "\n".join(lines) + "\n"
+
+class MetricsExporter:
+    """Publica render_prometheus() en un archivo (textfile collector) y/o por HTTP.
+
+    El archivo se reescribe cada `interval` segundos de forma atómica
+    (escribir a .tmp + os.replace) para que node_exporter nunca lea uno a medias.
+    """
+
+    def __init__(
+        self,
+        textfile: str = "",
+        port: int = 0,
+        interval: float = METRICS_INTERVAL_DEFAULT,
+        host: str = METRICS_HOST_DEFAULT,
+    ):
+        self.textfile = textfile
+        self.port = port
+        self.host = host
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.httpd = None
+
+    def write_textfile(self):
+        tmp = self.textfile + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(render_prometheus())
+        os.replace(tmp, self.textfile)
+
+    def _loop(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.write_textfile()
+            except OSError as e:
+                print(f"⚠️ No pude escribir métricas en {self.textfile}: {e}")
+
+    def start(self):
+        if self.textfile:
+            self.write_textfile()
+            self.thread = threading.Thread(target=self._loop, name="metrics-textfile", daemon=True)
+            self.thread.start()
+            print(f"📈 Métricas cada {self.interval:.0f}s en '{self.textfile}'.")
+        if self.port:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+                        self.send_error(404)
+                        return
+                    body = render_prometheus().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+            self.httpd.daemon_threads = True
+            threading.Thread(target=self.httpd.serve_forever, name="metrics-http", daemon=True).start()
+            print(f"📈 Métricas en http://{self.host}:{self.httpd.server_address[1]}/metrics")
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.write_textfile()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+metrics_exporter: Optional[MetricsExporter] = None  # se arma en init_runtime()
+
+def write_run_report(report: Dict[str, Any], path: str = RUN_REPORT_JSON):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+def format_run_report(report: Dict[str, Any]) -> str:
+    """Resumen legible del reporte (para la consola y el cuerpo del correo)."""
+    lines = [
+        f"Resumen de la corrida: {report['items']} ítems en {report['segundos'] / 60:.1f} min "
+        f"({report['items_por_min']:.1f} ítems/min), {report['peticiones']} peticiones, "
+        f"{report['bytes_descargados'] / 1e6:.1f} MB descargados "
+        f"({report.get('bytes_en_red', 0) / 1e6:.1f} MB comprimidos en la red).",
+        f"Esperas {report['sleep_s']:.0f}s vs trabajo {report['trabajo_s']:.0f}s "
+        f"(ratio {report['ratio_sleep_trabajo']}), sumando todos los hilos.",
+        "Status: " + ", ".join(f"{k}={v}" for k, v in sorted(report["status"].items())),
+    ]
+    if "reintentos" in report:
+        r = report["reintentos"]
+        lines.append(f"Reintentos: {r['retries_used']} de {r['retry_budget']} del presupuesto; "
+                     f"límite por ítem {r['item_deadline_s']:.0f}s.")
+    lines += [
+        "",
+        f"{'etapa':<18} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'total':>9}",
+    ]
+    for name, st in report["etapas"].items():
+        lines.append(f"{name:<18} {st['n']:>6} {st['p50_s']:>7.3f}s {st['p95_s']:>7.3f}s "
+                     f"{st['p99_s']:>7.3f}s {st['suma_s']:>8.1f}s")
+    return "\n".join(lines)
 
 # ============================================================
 # 4) Helpers de tiempos y backoff
@@ -451,69 +914,806 @@ def sleep_range(a: float, b: float) -> float:
     time.sleep(t)
     return t
 
-recent_429: List[bool] = []
+class TokenBucket:
+    """Token bucket compartido entre hilos para limitar peticiones/segundo.
+
+    Cada `acquire()` reserva su turno bajo el lock y duerme fuera de él, así
+    que varios hilos esperando se reparten los turnos en orden de llegada.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate: float):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+    def acquire(self, cost: float = 1.0) -> float:
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= cost
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+class RateController:
+    """Ritmo global de peticiones con AIMD sobre un token bucket.
+
+    Toda petición pasa por `acquire()`. Las respuestas limpias suben el ritmo
+    de forma aditiva; un 429/403 lo recorta multiplicativamente y pausa a
+    todos los hilos (respetando Retry-After si viene).
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        min_rate: float = REQUESTS_PER_SECOND_MIN,
+        max_rate: float = REQUESTS_PER_SECOND_MAX_DEFAULT,
+        increase: float = AIMD_INCREASE,
+        decrease: float = AIMD_DECREASE,
+        window: int = ROLLING_WINDOW,
+    ):
+        self.bucket = TokenBucket(rate)
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.recent = deque(maxlen=window)
+        self.paused_until = 0.0
+        self.consecutive_throttles = 0
+        self.ok_total = 0
+        self.throttled_total = 0
+        self.lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    def acquire(self) -> float:
+        waited = 0.0
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            time.sleep(pause)
+            waited += pause
+        if waited:
+            stage_metrics.observe("pausa_429", waited)
+        turn = self.bucket.acquire(jitter(0.8, 1.2))
+        stage_metrics.observe("espera_turno", turn)
+        return waited + turn
+
+    def on_success(self):
+        with self.lock:
+            self.recent.append(False)
+            self.ok_total += 1
+            self.consecutive_throttles = 0
+            self.bucket.set_rate(min(self.max_rate, self.rate + self.increase))
+
+    def on_throttle(self, retry_after: Optional[float] = None) -> float:
+        """Registra un 429/403 y regresa la pausa global que queda."""
+        with self.lock:
+            now = time.monotonic()
+            self.recent.append(True)
+            self.throttled_total += 1
+            self.consecutive_throttles += 1
+            # Si ya estábamos en pausa es la misma ráfaga: no recortamos dos veces.
+            if now >= self.paused_until:
+                self.bucket.set_rate(max(self.min_rate, self.rate * self.decrease))
+            backoff = min(BACKOFF_BASE * (2 ** (self.consecutive_throttles - 1)), BACKOFF_CAP)
+            pause = max(backoff + jitter(1.0, 4.0), retry_after or 0.0) * SLEEP_SCALE
+            self.paused_until = max(self.paused_until, now + pause)
+            return self.paused_until - now
+
+    def split(self, parts: int):
+        """Reparte el ritmo entre `parts` procesos que golpean el mismo sitio.
+
+        REQUESTS_PER_SECOND(_MAX) son el total hacia liverpool.com.mx: con N
+        shards cada uno se queda con 1/N para no multiplicar el tráfico.
+        """
+        if parts <= 1:
+            return
+        with self.lock:
+            self.min_rate /= parts
+            self.max_rate /= parts
+            self.bucket.set_rate(self.rate / parts)
+
+    def pause_remaining(self) -> float:
+        return max(0.0, self.paused_until - time.monotonic())
+
+    def ratio_429(self) -> float:
+        if not self.recent:
+            return 0.0
+        return sum(1 for x in self.recent if x) / len(self.recent)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "rate_rps": round(self.rate, 4),
+            "paused_for_s": round(self.pause_remaining(), 2),
+            "consecutive_throttles": self.consecutive_throttles,
+            "ratio_429": round(self.ratio_429(), 3),
+            "ok_total": self.ok_total,
+            "throttled_total": self.throttled_total,
+        }
+
+rate_controller = RateController(
+    rate=float(os.getenv("REQUESTS_PER_SECOND", str(REQUESTS_PER_SECOND_DEFAULT))),
+    max_rate=float(os.getenv("REQUESTS_PER_SECOND_MAX", str(REQUESTS_PER_SECOND_MAX_DEFAULT))),
+)
 
 def current_429_ratio() -> float:
-    if not recent_429:
-        return 0.0
-    return sum(1 for x in recent_429 if x) / len(recent_429)
+    return rate_controller.ratio_429()
 
-def planned_initial_wait() -> float:
-    base = jitter(*INITIAL_WAIT_RANGE)
-    ratio = current_429_ratio()
-    multiplier = 1.0 + ALPHA_SENSITIVITY * ratio
-    return base * multiplier
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After puede venir en segundos o como fecha HTTP."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    from email.utils import parsedate_to_datetime
+
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+class RetryPolicy:
+    """Única política de reintentos para todas las peticiones.
+
+    Decide según el status (o el error de red), respeta Retry-After, corta
+    cuando el ítem agota su deadline y lleva un presupuesto global de
+    reintentos por corrida para que unas cuantas URLs rotas no se coman el loop.
+    """
+
+    OK_STATUS = (200, 304, 404)
+    THROTTLE_STATUS = (429, 403)
+    RETRY_STATUS = (408, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        max_attempts: int = MAX_RETRIES,
+        item_deadline: float = ITEM_DEADLINE_SECONDS_DEFAULT,
+        retry_budget: int = RETRY_BUDGET_DEFAULT,
+    ):
+        self.max_attempts = max_attempts
+        self.item_deadline = item_deadline
+        self.retry_budget = retry_budget
+        self.retries_used = 0
+        self.lock = threading.Lock()
+
+    def _take_retry(self) -> bool:
+        with self.lock:
+            if self.retries_used >= self.retry_budget:
+                return False
+            self.retries_used += 1
+            return True
+
+    def next_wait(
+        self,
+        attempt: int,
+        elapsed: float,
+        status: Optional[int] = None,
+        retry_after: Optional[float] = None,
+    ) -> Optional[float]:
+        """Segundos a esperar antes del siguiente intento, o None para rendirse.
+
+        `status=None` significa error de red/timeout. En 429/403 la pausa ya
+        la aplica rate_controller, así que aquí solo se decide si reintentar.
+        """
+        if attempt + 1 >= self.max_attempts:
+            return None
+        if status in self.THROTTLE_STATUS:
+            wait = 0.0
+            pending_pause = rate_controller.pause_remaining()
+        elif status is None:
+            wait = 2.0 + attempt * 1.25
+            pending_pause = 0.0
+        elif status in self.RETRY_STATUS:
+            wait = max(1.5 + attempt * 0.5, retry_after or 0.0)
+            pending_pause = 0.0
+        else:
+            return None
+        wait *= SLEEP_SCALE
+        if elapsed + wait + pending_pause >= self.item_deadline:
+            return None
+        if not self._take_retry():
+            return None
+        return wait
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "retries_used": self.retries_used,
+            "retry_budget": self.retry_budget,
+            "item_deadline_s": self.item_deadline,
+        }
+
+retry_policy = RetryPolicy(
+    item_deadline=float(os.getenv("ITEM_DEADLINE_SECONDS", str(ITEM_DEADLINE_SECONDS_DEFAULT))),
+    retry_budget=int(os.getenv("RETRY_BUDGET", str(RETRY_BUDGET_DEFAULT))),
+)
 
 def get_with_backoff(
     url: str,
     allow_redirects: bool = True,
     timeout: int = 40,
-    mark_429_flag: Optional[list] = None
-) -> Optional[requests.Response]:
+    stats: Optional[Dict[str, Any]] = None,
+    headers: Optional[Dict[str, str]] = None,
+) -> Optional[Any]:
+    """GET con ritmo global y reintentos de retry_policy.
+
+    Si se pasa `stats`, ahí quedan los intentos hechos y los segundos que se
+    fueron en este ítem (esperas incluidas). El plazo de item_deadline corre
+    desde que se concede el primer turno: la espera en la cola global no
+    cuenta, así que cada ítem tiene al menos un intento.
+    """
+    transport = get_transport()
+    start = time.monotonic()
+    deadline_start = None
     last_status = None
-    for i in range(MAX_RETRIES):
+    attempt = 0
+    result = None
+    while True:
+        waited = rate_controller.acquire()
+        if attempt == 0:
+            print(f"   ⏳ Espera de turno para {url}: {waited:.1f}s "
+                  f"(ritmo {rate_controller.rate:.2f} req/s, ratio 429 reciente: {current_429_ratio():.2f})")
+            deadline_start = time.monotonic()
+        remaining = retry_policy.item_deadline - (time.monotonic() - deadline_start)
+        if remaining <= 0:
+            break
+
+        status = None
+        retry_after = None
         try:
-            r = session.get(url, allow_redirects=allow_redirects, timeout=timeout)
-            last_status = r.status_code
-
-            if r.status_code in (200, 404):
-                return r
-
-            if r.status_code in (429, 403):
-                if mark_429_flag is not None:
-                    mark_429_flag[0] = True
-                wait = min(BACKOFF_BASE * (2 ** i), BACKOFF_CAP) + jitter(1.0, 4.0)
-                print(f"   HTTP {r.status_code} en {url} -> backoff {wait:.1f}s (reintento {i+1}/{MAX_RETRIES})")
-                time.sleep(wait)
-                continue
+            t0 = time.perf_counter()
+            try:
+                r = transport.get(url, headers=headers, allow_redirects=allow_redirects, timeout=min(timeout, remaining))
+            finally:
+                stage_metrics.observe("red", time.perf_counter() - t0)
+                stage_metrics.add("requests")
+            stage_metrics.add("bytes", len(r.content))
+            stage_metrics.add("bytes_wire", transport.wire_bytes(r))
+            status = last_status = r.status_code
+            retry_after = parse_retry_after(r.headers.get("Retry-After"))
+
+            if status in RetryPolicy.OK_STATUS:
+                rate_controller.on_success()
+                result = r
+                break
 
-            time.sleep(1.5 + i * 0.5)
+            if status in RetryPolicy.THROTTLE_STATUS:
+                pause = rate_controller.on_throttle(retry_after)
+                print(f"   HTTP {status} en {url} -> pausa global {pause:.1f}s, "
+                      f"ritmo {rate_controller.rate:.2f} req/s (intento {attempt+1}/{retry_policy.max_attempts})")
+        except transport.errors as e:
+            print(f"   Error de red en {url}: {e} (intento {attempt+1}/{retry_policy.max_attempts})")
 
-        except requests.RequestException as e:
-            wait = 2.0 + i * 1.25
-            print(f"   Error de red en {url}: {e} -> esperando {wait:.1f}s (reintento {i+1}/{MAX_RETRIES})")
+        wait = retry_policy.next_wait(attempt, time.monotonic() - deadline_start, status, retry_after)
+        attempt += 1
+        if wait is None:
+            break
+        if wait > 0:
+            print(f"   ↻ Reintentando {url} en {wait:.1f}s")
             time.sleep(wait)
+            stage_metrics.observe("espera_reintento", wait)
+
+    if stats is not None:
+        stats["attempts"] = attempt + (1 if result is not None else 0)
+        stats["seconds"] = time.monotonic() - start
+    if result is None:
+        print(f"   ❌ No se pudo obtener {url} tras {attempt} intentos (último status={last_status})")
+    return result
+
+# ============================================================
+# 4b) Caché HTTP en disco con revalidación (opt-in: HTTP_CACHE_DIR)
+# ============================================================
+class ResponseCache:
+    """Caché por URL: cuerpo comprimido + validadores + registro ya parseado.
+
+    Cada entrada son dos archivos: `<sha1>.json` (ETag, Last-Modified, fecha y
+    el registro parseado) y `<sha1>.html.gz` (el cuerpo). El mtime del .json
+    funciona como último acceso para el desalojo LRU cuando se pasa de
+    `max_bytes`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_age: float = 0.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.counts = {"hits": 0, "not_modified": 0, "refetched": 0, "misses": 0}
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(
+            os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+        )
+
+    def _paths(self, url: str) -> tuple:
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.directory, key)
+        return base + ".json", base + ".html.gz"
+
+    def count(self, what: str):
+        with self.lock:
+            self.counts[what] += 1
+
+    def lookup(self, url: str) -> Optional[Dict[str, Any]]:
+        meta_path, _ = self._paths(url)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("url") == url else None
+
+    def is_fresh(self, entry: Dict[str, Any]) -> bool:
+        return self.max_age > 0 and time.time() - entry.get("stored_at", 0) < self.max_age
+
+    def conditional_headers(self, entry: Optional[Dict[str, Any]]) -> Dict[str, str]:
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def entry_info(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        """Registro guardado; si quedó vacío o es de antes de VARIANTES, se vuelve a parsear el cuerpo."""
+        self.touch(entry)
+        if entry.get("info") and "VARIANTES" in entry["info"]:
+            return entry["info"]
+        _, body_path = self._paths(entry["url"])
+        try:
+            with open(body_path, "rb") as f:
+                body = gzip.decompress(f.read())
+        except OSError:
+            return {}
+        if body.lstrip()[:1] == b"{":
+            return parse_product_from_next_json(body)
+        return parse_product_cached(body)
+
+    def touch(self, entry: Dict[str, Any]):
+        meta_path, _ = self._paths(entry["url"])
+        try:
+            os.utime(meta_path)
+        except OSError:
+            pass
+
+    def has_body(self, entry: Dict[str, Any]) -> bool:
+        return os.path.exists(self._paths(entry["url"])[1])
+
+    def store(self, url: str, response: Any, info: Dict[str, Any]) -> bool:
+        """Guarda la respuesta; False si no trae validadores (no se podría revalidar)."""
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return False
+        meta_path, body_path = self._paths(url)
+        meta = json.dumps({
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "stored_at": time.time(),
+            "info": info,
+        }, ensure_ascii=False).encode("utf-8")
+        body = gzip.compress(response.content, compresslevel=6)
+
+        with self.lock:
+            old_size = sum(os.path.getsize(p) for p in (meta_path, body_path) if os.path.exists(p))
+            for path, data in ((body_path, body), (meta_path, meta)):
+                tmp = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            self.total_bytes += len(meta) + len(body) - old_size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+        return True
+
+    def _evict(self):
+        metas = [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".json")
+        ]
+        metas.sort(key=lambda p: os.path.getmtime(p))
+        # Bajamos al 90% del tope para no desalojar en cada escritura.
+        target = self.max_bytes * 0.9
+        for meta_path in metas:
+            if self.total_bytes <= target:
+                break
+            for path in (meta_path, meta_path[:-len(".json")] + ".html.gz"):
+                try:
+                    self.total_bytes -= os.path.getsize(path)
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def summary(self) -> str:
+        c = self.counts
+        return (f"{c['hits']} hits, {c['not_modified']} revalidadas (304), "
+                f"{c['refetched']} descargadas de nuevo, {c['misses']} nuevas "
+                f"({self.total_bytes / 1e6:.1f} MB en disco)")
+
+response_cache: Optional[ResponseCache] = None  # se arma en init_runtime()
+
+# ============================================================
+# 4c) Caché de registros parseados por hash (opt-in: PARSE_CACHE_DB)
+# ============================================================
+def connect_sqlite(path: str) -> sqlite3.Connection:
+    """Conexión compartida entre hilos (protegerla con un lock) en modo WAL."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+class ParseCache:
+    """Registros ya parseados indexados por el sha1 de records[0].
+
+    Aunque la PDP se vuelva a descargar, si el subárbol del producto es
+    idéntico al de otra corrida nos ahorramos decodificarlo. Las entradas que
+    no se usan en `max_age_days` se borran al abrir.
+    """
+
+    def __init__(self, path: str, max_age_days: float):
+        self.conn = connect_sqlite(path)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS parsed ("
+            " hash TEXT PRIMARY KEY, info TEXT NOT NULL,"
+            " parse_seconds REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "DELETE FROM parsed WHERE last_used < ?",
+            (time.time() - max_age_days * 86400,),
+        )
 
-    print(f"   ❌ No se pudo obtener {url} tras {MAX_RETRIES} intentos (último status={last_status})")
-    return None
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT info, parse_seconds FROM parsed WHERE hash = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE parsed SET last_used = ? WHERE hash = ?", (time.time(), key))
+            self.hits += 1
+            self.saved_seconds += row[1]
+        return json.loads(row[0])
+
+    def put(self, key: str, info: Dict[str, Any], parse_seconds: float):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO parsed (hash, info, parse_seconds, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(info, ensure_ascii=False), parse_seconds, time.time()),
+            )
+
+    def summary(self) -> str:
+        return (f"{self.hits} hits, {self.misses} parseadas, "
+                f"{self.saved_seconds:.2f}s de parseo ahorrados")
+
+parse_cache: Optional[ParseCache] = None
+if os.getenv("PARSE_CACHE_DB"):
+    parse_cache = ParseCache(
+        os.environ["PARSE_CACHE_DB"],
+        max_age_days=float(os.getenv("PARSE_CACHE_MAX_AGE_DAYS", str(PARSE_CACHE_MAX_AGE_DAYS_DEFAULT))),
+    )
 
 # ============================================================
 # 5) Parseo desde __NEXT_DATA__
 # ============================================================
-def parse_product_from_html(html: str) -> Dict[str, Any]:
+# Ruta rápida: buscamos la etiqueta directamente en los bytes crudos sin
+# construir el árbol DOM completo (las PDP pesan varios cientos de KB).
+# El id tiene que ser exactamente __NEXT_DATA__, igual que en la búsqueda de
+# BeautifulSoup: ni data-id= ni id="__NEXT_DATA__-cfg".
+NEXT_DATA_OPEN_RE = re.compile(
+    rb"<script[^>]*?(?<![\w-])id\s*=\s*([\"']?)__NEXT_DATA__\1(?=[\s/>])[^>]*>",
+    re.IGNORECASE,
+)
+NEXT_DATA_CLOSE = b"</script"
+
+def extract_next_data(html: Union[str, bytes]) -> Optional[bytes]:
+    """Regresa solo el payload de __NEXT_DATA__ (o None si la página no lo trae).
+
+    Se busca sobre el cuerpo ya descargado: la caché HTTP y el fallback con
+    BeautifulSoup necesitan la página completa, así que no vale la pena
+    cortar la descarga al ver el cierre del <script>.
+    """
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    m = NEXT_DATA_OPEN_RE.search(html)
+    if not m:
+        return None
+    end = html.find(NEXT_DATA_CLOSE, m.end())
+    if end < 0:
+        return None
+    return html[m.end():end]
+
+# Decodificación selectiva: de todo el estado de Next.js (navegación,
+# recomendaciones, reseñas, CMS...) solo nos interesa records[0]. Recorremos
+# el JSON crudo saltando lo demás sin crear objetos de Python.
+NEXT_DATA_RECORD_PATH = ("query", "data", "mainContent", "records", 0)
+RECORD_KEYS = ("allMeta", "_t")
+
+_JSON_WS_RE = re.compile(rb"[ \t\n\r]*")
+_JSON_STRING_RE = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+_JSON_SCALAR_RE = re.compile(rb"[^,:\]\}\s]+")
+# Todo lo que no es corchete/llave (incluyendo strings completos) de un jalón.
+_JSON_FILLER = rb'[^"\[\]{}]*+(?:"[^"\\]*+(?:\\.[^"\\]*+)*+"[^"\[\]{}]*+)*+'
+_JSON_FILLER_RE = re.compile(_JSON_FILLER)
+# Contenedor balanceado hasta JSON_SKIP_MAX_DEPTH niveles en una sola llamada
+# a `re` (grupos atómicos, sin backtracking). Si se anida más, caemos al loop.
+JSON_SKIP_MAX_DEPTH = 32
+
+def _build_container_re(max_depth: int):
+    level = rb"[\[{]" + _JSON_FILLER + rb"[\]}]"
+    for _ in range(max_depth - 1):
+        level = rb"[\[{]" + _JSON_FILLER + rb"(?:" + level + _JSON_FILLER + rb")*+[\]}]"
+    return re.compile(level)
+
+_JSON_CONTAINER_RE = _build_container_re(JSON_SKIP_MAX_DEPTH)
+
+def _json_ws(buf: bytes, pos: int) -> int:
+    return _JSON_WS_RE.match(buf, pos).end()
+
+def _json_skip_value(buf: bytes, pos: int) -> int:
+    """Regresa la posición justo después del valor JSON que empieza en pos."""
+    c = buf[pos:pos + 1]
+    if c == b'"':
+        m = _JSON_STRING_RE.match(buf, pos)
+        if not m:
+            raise ValueError(f"string sin cerrar en {pos}")
+        return m.end()
+    if c not in (b"{", b"["):
+        m = _JSON_SCALAR_RE.match(buf, pos)
+        if not m:
+            raise ValueError(f"valor inválido en {pos}")
+        return m.end()
+    m = _JSON_CONTAINER_RE.match(buf, pos)
+    if m:
+        return m.end()
+    depth = 0
+    n = len(buf)
+    while pos < n:
+        c = buf[pos]
+        if c in b"{[":
+            depth += 1
+        elif c in b"}]":
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+        pos = _JSON_FILLER_RE.match(buf, pos + 1).end()
+    raise ValueError("JSON truncado")
+
+def _json_key(raw: bytes) -> str:
+    if b"\\" in raw:
+        return json.loads(raw)
+    return raw[1:-1].decode("utf-8")
+
+def _json_object_members(buf: bytes, pos: int, stop_at: Optional[str] = None):
+    """Itera (llave, inicio, fin) de cada miembro del objeto que empieza en pos.
+
+    Si la llave es `stop_at` se entrega con fin=-1 sin recorrer su valor y se
+    termina ahí (para descender sin pagar el salto dos veces).
+    """
+    if buf[pos:pos + 1] != b"{":
+        raise KeyError("se esperaba un objeto")
+    pos = _json_ws(buf, pos + 1)
+    if buf[pos:pos + 1] == b"}":
+        return
+    while True:
+        m = _JSON_STRING_RE.match(buf, pos)
+        if not m:
+            raise ValueError(f"llave inválida en {pos}")
+        key = _json_key(m.group())
+        pos = _json_ws(buf, m.end())
+        if buf[pos:pos + 1] != b":":
+            raise ValueError(f"se esperaba ':' en {pos}")
+        start = _json_ws(buf, pos + 1)
+        if key == stop_at:
+            yield key, start, -1
+            return
+        end = _json_skip_value(buf, start)
+        yield key, start, end
+        pos = _json_ws(buf, end)
+        c = buf[pos:pos + 1]
+        if c == b"}":
+            return
+        if c != b",":
+            raise ValueError(f"se esperaba ',' en {pos}")
+        pos = _json_ws(buf, pos + 1)
+
+def _json_array_item(buf: bytes, pos: int, index: int) -> int:
+    if buf[pos:pos + 1] != b"[":
+        raise KeyError("se esperaba un arreglo")
+    pos = _json_ws(buf, pos + 1)
+    for _ in range(index):
+        if buf[pos:pos + 1] == b"]":
+            raise KeyError(index)
+        pos = _json_ws(buf, _json_skip_value(buf, pos))
+        if buf[pos:pos + 1] != b",":
+            raise KeyError(index)
+        pos = _json_ws(buf, pos + 1)
+    if buf[pos:pos + 1] == b"]":
+        raise KeyError(index)
+    return pos
+
+def _json_array_items(buf: bytes, pos: int) -> Iterator[tuple]:
+    """Itera (inicio, fin) de cada elemento del arreglo que empieza en pos."""
+    if buf[pos:pos + 1] != b"[":
+        raise KeyError("se esperaba un arreglo")
+    pos = _json_ws(buf, pos + 1)
+    if buf[pos:pos + 1] == b"]":
+        return
+    while True:
+        end = _json_skip_value(buf, pos)
+        yield pos, end
+        pos = _json_ws(buf, end)
+        c = buf[pos:pos + 1]
+        if c == b"]":
+            return
+        if c != b",":
+            raise ValueError(f"se esperaba ',' en {pos}")
+        pos = _json_ws(buf, pos + 1)
+
+def find_json_path(buf: bytes, path) -> tuple:
+    """Regresa (inicio, fin) del valor en `path` sin decodificar lo demás."""
+    pos = _json_ws(buf, 0)
+    for step in path:
+        if isinstance(step, int):
+            pos = _json_array_item(buf, pos, step)
+            continue
+        for key, start, _end in _json_object_members(buf, pos, stop_at=step):
+            if key == step:
+                pos = start
+                break
+        else:
+            raise KeyError(step)
+    return pos, _json_skip_value(buf, pos)
+
+def decode_record_from_next_data(payload: bytes, start: Optional[int] = None) -> Dict[str, Any]:
+    """Decodifica solo allMeta y _t de query.data.mainContent.records[0]."""
+    if start is None:
+        start, _end = find_json_path(payload, NEXT_DATA_RECORD_PATH)
+    record: Dict[str, Any] = {}
+    for key, vstart, vend in _json_object_members(payload, start):
+        if key in RECORD_KEYS:
+            record[key] = json.loads(payload[vstart:vend])
+    return record
+
+def _load_next_data_soup(html: Union[str, bytes]) -> Optional[Dict[str, Any]]:
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html, "lxml")
 
     script_tag = soup.find("script", id="__NEXT_DATA__")
     if not script_tag:
         print("⚠️ No encontré <script id='__NEXT_DATA__'> en el HTML.")
-        return {}
+        return None
 
     try:
-        data = json.loads(script_tag.string)
+        return json.loads(script_tag.string)
     except Exception as e:
         print("⚠️ Error al parsear JSON de __NEXT_DATA__:", e)
-        return {}
+        return None
 
+def parse_product_from_html(html: Union[str, bytes]) -> Dict[str, Any]:
+    data = None
+    with stage_metrics.timed("extraer_next_data"):
+        payload = extract_next_data(html)
+    if payload is not None:
+        try:
+            with stage_metrics.timed("decodificar_json"):
+                rec0 = decode_record_from_next_data(payload)
+            return parse_product_from_record(rec0)
+        except (KeyError, ValueError, IndexError):
+            # Forma inesperada: decodificamos todo para dar el diagnóstico completo.
+            try:
+                data = json.loads(payload)
+            except ValueError:
+                data = None
+
+    if not _has_next_data_records(data):
+        # Fallback: BeautifulSoup es más tolerante con HTML raro, y si la ruta
+        # rápida tomó otro <script> que sí era JSON aquí se busca el bueno.
+        with stage_metrics.timed("bs4_fallback"):
+            soup_data = _load_next_data_soup(html)
+        if isinstance(soup_data, dict):
+            data = soup_data
+        if not isinstance(data, dict):
+            return {}
+
+    return parse_product_from_next_data(data)
+
+def _has_next_data_records(data: Any) -> bool:
+    try:
+        return bool(data["query"]["data"]["mainContent"]["records"])
+    except (KeyError, TypeError, IndexError):
+        return False
+
+def parse_product_cached(html: Union[str, bytes]) -> Dict[str, Any]:
+    """parse_product_from_html memoizado por el hash de records[0] en parse_cache."""
+    if parse_cache is None:
+        return parse_product_from_html(html)
+
+    with stage_metrics.timed("extraer_next_data"):
+        payload = extract_next_data(html)
+    try:
+        start, end = find_json_path(payload, NEXT_DATA_RECORD_PATH)
+    except (TypeError, KeyError, ValueError, IndexError):
+        # Sin __NEXT_DATA__ o con forma rara: camino normal con sus diagnósticos.
+        return parse_product_from_html(html)
+
+    try:
+        return _parse_record_cached(payload, start, end)
+    except (KeyError, ValueError, IndexError):
+        return parse_product_from_html(html)
+
+def _parse_record_cached(payload: bytes, start: int, end: int) -> Dict[str, Any]:
+    """Parsea records[0] ya ubicado en payload[start:end], con parse_cache si está activa."""
+    key = None
+    if parse_cache is not None:
+        key = f"v{PARSE_CACHE_VERSION}:{hashlib.sha1(payload[start:end]).hexdigest()}"
+    if key is not None:
+        info = parse_cache.get(key)
+        if info is not None:
+            return info
+
+    t0 = time.perf_counter()
+    info = parse_product_from_record(decode_record_from_next_data(payload, start))
+    elapsed = time.perf_counter() - t0
+    stage_metrics.observe("decodificar_json", elapsed)
+    if key is not None:
+        parse_cache.put(key, info, elapsed)
+    return info
+
+# Respuesta de /_next/data/<buildId>/<ruta>.json: trae las props de la página
+# sin el HTML alrededor. Según cómo arme la página sus props, records[0] puede
+# venir bajo pageProps.data, pageProps.query.data o (si es el __NEXT_DATA__
+# completo) bajo query.data; se prueban en ese orden.
+NEXT_JSON_RECORD_PATHS = (
+    ("pageProps",) + NEXT_DATA_RECORD_PATH[1:],
+    ("pageProps",) + NEXT_DATA_RECORD_PATH,
+    NEXT_DATA_RECORD_PATH,
+)
+
+def parse_product_from_next_json(body: Union[str, bytes]) -> Dict[str, Any]:
+    """Como parse_product_from_html, pero con el JSON de la ruta de datos de Next.js.
+
+    Regresa {} si el cuerpo no es JSON o no trae records[0] (p. ej. una
+    redirección o la página de error); quien llama decide si baja el HTML.
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    for path in NEXT_JSON_RECORD_PATHS:
+        try:
+            start, end = find_json_path(body, path)
+        except (KeyError, ValueError, IndexError, TypeError):
+            continue
+        try:
+            return _parse_record_cached(body, start, end)
+        except (KeyError, ValueError, IndexError):
+            return {}
+    return {}
+
+def parse_product_from_next_data(data: Dict[str, Any]) -> Dict[str, Any]:
     try:
         records = data["query"]["data"]["mainContent"]["records"]
         if not records:
@@ -523,28 +1723,103 @@ def parse_product_from_html(html: str) -> Dict[str, Any]:
         print("⚠️ No encontré records[0] en __NEXT_DATA__:", e)
         return {}
 
-    all_meta = rec0.get("allMeta") or {}
-    variants = all_meta.get("variants") or []
-    variant0 = variants[0] if variants else {}
+    return parse_product_from_record(rec0)
+
+def parse_listing_from_html(html: Union[str, bytes]) -> Dict[str, Dict[str, Any]]:
+    """Código -> info de cada producto de una página de listado o de búsqueda.
+
+    Los listados traen muchos productos en el mismo
+    query.data.mainContent.records que una PDP; cada registro se parsea como
+    records[0]. Cada variante se indexa por su código; si el producto tiene
+    una sola, también por su productId.
+    """
+    found: Dict[str, Dict[str, Any]] = {}
+    with stage_metrics.timed("extraer_next_data"):
+        payload = extract_next_data(html)
+    if payload is None:
+        return found
+    try:
+        start, _end = find_json_path(payload, NEXT_DATA_RECORD_PATH[:-1])
+        items = list(_json_array_items(payload, start))
+    except (KeyError, ValueError, IndexError):
+        return found
+
+    with stage_metrics.timed("decodificar_json"):
+        for item_start, _item_end in items:
+            try:
+                rec = decode_record_from_next_data(payload, item_start)
+            except (KeyError, ValueError):
+                continue  # banners y demás registros que no son productos
+            info = parse_product_from_record(rec)
+            if not info["CODIGO_PRODUCTO"]:
+                continue
+            if info["VARIANTES"]:
+                for code in info["VARIANTES"]:
+                    found.setdefault(code, select_variant(info, code))
+                continue
+            found.setdefault(str(info["CODIGO_PRODUCTO"]), info)
+            if info["PRODUCTO_ID"]:
+                found.setdefault(info["PRODUCTO_ID"], info)
+    return found
+
+def parse_product_from_record(rec0: Dict[str, Any]) -> Dict[str, Any]:
+    """Info de variants[0], más PRODUCTO_ID y VARIANTES (código -> info de cada variante).
 
+    VARIANTES solo viene cuando hay más de una; select_variant() toma de ahí
+    la del SKU pedido.
+    """
+    all_meta = rec0.get("allMeta") or {}
+    variants = [v for v in (all_meta.get("variants") or []) if isinstance(v, dict)]
+    info = _variant_info(rec0, all_meta, variants[0] if variants else {})
+    info["PRODUCTO_ID"] = str(all_meta.get("productId") or "")
+    info["VARIANTES"] = None
+    if len(variants) > 1:
+        by_code: Dict[str, Dict[str, Any]] = {}
+        for variant in variants:
+            vinfo = _variant_info(rec0, all_meta, variant)
+            for key in (variant.get("skuId"), variant.get("sellerSkuId")):
+                if key:
+                    by_code.setdefault(str(key), vinfo)
+        info["VARIANTES"] = by_code
+    return info
+
+def select_variant(info: Dict[str, Any], sku: str, pdp_code: str = "") -> Optional[Dict[str, Any]]:
+    """Info de la variante `sku` del producto, o None si no es una de sus variantes.
+
+    Sin VARIANTES (una sola variante) la página solo vale para su propio
+    código o para el SKU con el que se pidió (`pdp_code`); una hermana que
+    siga en el índice después de que el producto se quedó con una variante
+    no se lleva ese precio.
+    """
+    variants = info.get("VARIANTES")
+    if not variants:
+        if str(sku) in (str(info.get("CODIGO_PRODUCTO") or ""), pdp_code):
+            return info
+        return None
+    vinfo = variants.get(str(sku))
+    if vinfo is None:
+        return None
+    return {**vinfo, "PRODUCTO_ID": info.get("PRODUCTO_ID", ""), "VARIANTES": variants}
+
+def _variant_info(rec0: Dict[str, Any], all_meta: Dict[str, Any], variant: Dict[str, Any]) -> Dict[str, Any]:
     title = (
         all_meta.get("TituloSinMarca")
         or all_meta.get("productDisplayName")
         or all_meta.get("productName")
         or all_meta.get("productTitle")
-        or variant0.get("skuName")
+        or variant.get("skuName")
         or rec0.get("_t")
         or ""
     )
 
     code = (
-        variant0.get("skuId")
-        or variant0.get("sellerSkuId")
+        variant.get("skuId")
+        or variant.get("sellerSkuId")
         or all_meta.get("productId")
         or ""
     )
 
-    prices_variant = variant0.get("prices") or {}
+    prices_variant = variant.get("prices") or {}
     list_price = (
         prices_variant.get("listPrice")
         or prices_variant.get("regularPrice")
@@ -572,12 +1847,12 @@ def parse_product_from_html(html: str) -> Dict[str, Any]:
             or all_meta.get("offerPrice")
         )
 
-    offers = variant0.get("offers") or {}
+    offers = variant.get("offers") or {}
     best_offer = offers.get("bestOffer") or {}
 
     seller = best_offer.get("sellerName")
     if not seller:
-        sellernames = variant0.get("sellernames")
+        sellernames = variant.get("sellernames")
         if isinstance(sellernames, list) and sellernames:
             seller = sellernames[0]
         else:
@@ -599,297 +1874,1860 @@ def parse_product_from_html(html: str) -> Dict[str, Any]:
         "VENDEDOR": seller,
     }
 
+# ============================================================
+# 5b) Parseo en procesos aparte (opt-in: PARSE_WORKERS)
+# ============================================================
+INFO_FIELDS = ("CODIGO_PRODUCTO", "TITULO", "PRECIO_REGULAR_NUM", "PRECIO_DESCUENTO_NUM", "VENDEDOR")
+PRODUCT_FIELDS = INFO_FIELDS + ("PRODUCTO_ID", "VARIANTES")
+
+def _parse_cache_counters() -> tuple:
+    if parse_cache is None:
+        return (0, 0, 0.0)
+    return (parse_cache.hits, parse_cache.misses, parse_cache.saved_seconds)
+
+def parse_body_to_tuple(body: bytes, parser=None) -> tuple:
+    """Corre en el proceso hijo: regresa (tupla de PRODUCT_FIELDS o None, contadores de caché)."""
+    before = _parse_cache_counters()
+    info = (parser or parse_product_cached)(body)
+    after = _parse_cache_counters()
+    row = tuple(info.get(field, "") for field in PRODUCT_FIELDS) if info else None
+    return row, tuple(b - a for a, b in zip(before, after))
+
+class ParseStage:
+    """Saca el parseo (lxml/json, que retienen el GIL) de los hilos de descarga.
+
+    Es una descarga síncrona del trabajo de CPU, no una etapa aparte: el hilo
+    entrega el cuerpo crudo y espera el resultado antes de pedir otra página,
+    porque el resto del ítem (variantes, buildId, reintentos) depende del
+    registro parseado. Así hay a lo más CONCURRENCY cuerpos en vuelo y la
+    memoria queda acotada sin otra cola.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # spawn: los hijos no heredan sockets ni conexiones SQLite del padre.
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self.pool
+
+    def parse(self, body: bytes, parser=None) -> Dict[str, Any]:
+        """`parser` recibe el cuerpo y regresa el info (default: parse_product_cached)."""
+        parser = parser or parse_product_cached
+        if self.workers <= 0:
+            return parser(body)
+        row, cache_delta = self._get_pool().submit(parse_body_to_tuple, body, parser).result()
+        if parse_cache is not None:
+            with parse_cache.lock:
+                parse_cache.hits += cache_delta[0]
+                parse_cache.misses += cache_delta[1]
+                parse_cache.saved_seconds += cache_delta[2]
+        return dict(zip(PRODUCT_FIELDS, row)) if row else {}
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+parse_stage = ParseStage(workers=int(os.getenv("PARSE_WORKERS", "0")))
+
+# ============================================================
+# 5c) Ruta de datos de Next.js en lugar del HTML (opt-in: NEXT_DATA_ROUTE=1)
+# ============================================================
+NEXT_BUILD_ID_TTL_DEFAULT = 1800.0
+NEXT_DATA_ROUTE_MAX_MISSES_DEFAULT = 5
+NEXT_DATA_HEADERS = {"Accept": "application/json", "x-nextjs-data": "1"}
+
+def next_data_url(page_url: str, build_id: str) -> str:
+    """/tienda/pdp/x/123 -> /_next/data/<buildId>/tienda/pdp/x/123.json (mismo host y query)."""
+    parts = urlsplit(page_url)
+    path = parts.path.rstrip("/") or "/index"
+    return urlunsplit((parts.scheme, parts.netloc, f"/_next/data/{build_id}{path}.json", parts.query, ""))
+
+class NextDataRoute:
+    """buildId vigente del sitio y contadores de la ruta /_next/data.
+
+    El buildId se aprende del __NEXT_DATA__ de una PDP bajada como HTML (la
+    primera de la corrida, o la de un fallback) y se reusa durante `ttl`
+    segundos. Si el JSON da 404 o no trae el registro se baja el HTML, que
+    además trae el buildId nuevo cuando hubo un deploy. Tras `max_misses`
+    fallbacks seguidos con el mismo buildId la ruta se apaga para la corrida.
+    """
+
+    BUILD_ID_RE = re.compile(rb'"buildId"\s*:\s*"([^"\\]+)"')
+
+    def __init__(self, ttl: float, max_misses: int):
+        self.ttl = ttl
+        self.max_misses = max_misses
+        self.lock = threading.Lock()
+        self.build_id: Optional[str] = None
+        self.learned_at = 0.0
+        self.misses = 0
+        self.enabled = True
+        self.counts = {"json": 0, "fallback_404": 0, "fallback_formato": 0, "build_ids": 0}
+
+    def current(self) -> Optional[str]:
+        """buildId a usar, o None si hay que bajar el HTML (sin aprender, vencido o apagada)."""
+        with self.lock:
+            if self.enabled and self.build_id and time.monotonic() - self.learned_at < self.ttl:
+                return self.build_id
+        return None
+
+    def learn(self, html: bytes):
+        m = self.BUILD_ID_RE.search(html)
+        if not m:
+            return
+        build_id = m.group(1).decode("utf-8", "replace")
+        with self.lock:
+            if build_id != self.build_id:
+                self.counts["build_ids"] += 1
+                print(f"   ⚡ buildId de Next.js: {build_id}")
+                self.misses = 0
+            self.build_id = build_id
+            self.learned_at = time.monotonic()
+
+    def on_json(self):
+        with self.lock:
+            self.counts["json"] += 1
+            self.misses = 0
+
+    def on_fallback(self, used: str, json_status: int, html_status: Optional[int], html: Optional[bytes]):
+        with self.lock:
+            self.counts["fallback_404" if json_status == 404 else "fallback_formato"] += 1
+        if html_status == 404 or html is None:
+            # El SKU tampoco existe como HTML: el buildId no tiene la culpa.
+            return
+        self.learn(html)
+        with self.lock:
+            if self.build_id != used:
+                return
+            self.misses += 1
+            if self.enabled and self.misses >= self.max_misses:
+                self.enabled = False
+                print(f"⚠️ /_next/data falló {self.misses} veces seguidas con el buildId {used}; "
+                      "el resto de la corrida se baja en HTML.")
+
+    def summary(self) -> str:
+        c = self.counts
+        return (f"{c['json']} PDP por JSON, {c['fallback_404'] + c['fallback_formato']} con fallback a HTML "
+                f"({c['fallback_404']} por 404, {c['fallback_formato']} por formato), "
+                f"{c['build_ids']} buildId aprendidos"
+                + ("" if self.enabled else ", ruta apagada"))
+
+next_data_route: Optional[NextDataRoute] = None
+if os.getenv("NEXT_DATA_ROUTE") == "1":
+    next_data_route = NextDataRoute(
+        ttl=float(os.getenv("NEXT_BUILD_ID_TTL_SECONDS", str(NEXT_BUILD_ID_TTL_DEFAULT))),
+        max_misses=int(os.getenv("NEXT_DATA_ROUTE_MAX_MISSES", str(NEXT_DATA_ROUTE_MAX_MISSES_DEFAULT))),
+    )
+
 # ============================================================
 # 6) Helpers de salida
 # ============================================================
-COLUMNS = [
-    "TIMESTAMP",
-    "SKU",
-    "URL_PDP",
-    "CODIGO_PRODUCTO",
-    "TITULO",
-    "PRECIO_REGULAR_NUM",
-    "PRECIO_DESCUENTO_NUM",
-    "VENDEDOR",
-    "STATUS",
-]
+@dataclasses.dataclass(slots=True)
+class ResultRow:
+    """Una fila de resultados; el orden de los campos es el de las columnas.
+
+    Con slots no hay un dict por fila, que es lo que pesa cuando all_results
+    junta decenas de miles de ítems. `row["STATUS"]` / `row.get(...)` siguen
+    funcionando para el código que las trata como dict.
+    """
+
+    TIMESTAMP: str = ""
+    SKU: str = ""
+    URL_PDP: str = ""
+    CODIGO_PRODUCTO: str = ""
+    TITULO: str = ""
+    PRECIO_REGULAR_NUM: Any = ""
+    PRECIO_DESCUENTO_NUM: Any = ""
+    VENDEDOR: str = ""
+    STATUS: str = ""
+    INTENTOS: Any = ""
+    SEGUNDOS_FETCH: Any = ""
+
+    def __getitem__(self, col: str):
+        return getattr(self, col)
+
+    def get(self, col: str, default: Any = None):
+        return getattr(self, col, default)
+
+    def values(self) -> tuple:
+        return _row_values(self)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(zip(COLUMNS, _row_values(self)))
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "ResultRow":
+        return cls(*(d.get(col, "") for col in COLUMNS))
+
+COLUMNS = [f.name for f in dataclasses.fields(ResultRow)]
+_row_values = attrgetter(*COLUMNS)
+
+def make_result_row(
+    ts: str,
+    sku: str,
+    url: str,
+    status: str,
+    info: Optional[Dict[str, Any]] = None,
+    fetch_stats: Optional[Dict[str, Any]] = None,
+) -> ResultRow:
+    """Fila para cualquier camino (código, URL o error); sin `info` quedan vacíos los datos."""
+    info = info or {}
+    row = ResultRow(
+        ts, sku, url,
+        info.get("CODIGO_PRODUCTO", ""),
+        info.get("TITULO", ""),
+        info.get("PRECIO_REGULAR_NUM", ""),
+        info.get("PRECIO_DESCUENTO_NUM", ""),
+        info.get("VENDEDOR", ""),
+        status,
+    )
+    if fetch_stats is not None:
+        row.INTENTOS = fetch_stats.get("attempts", "")
+        row.SEGUNDOS_FETCH = round(fetch_stats.get("seconds", 0.0), 1)
+    return row
+
+NUMERIC_COLUMNS = ["PRECIO_REGULAR_NUM", "PRECIO_DESCUENTO_NUM", "INTENTOS", "SEGUNDOS_FETCH"]
 
-def row_to_tsv(row: Dict[str, Any]) -> str:
+RESULTS_CSV = "liverpool_datos.csv"
+RESULTS_XLSX = "liverpool_datos.xlsx"
+RESULTS_FSYNC_EVERY = 20
+
+def row_to_tsv(row: ResultRow) -> str:
     def fmt(x):
         if x is None:
             return ""
         s = str(x)
         return s.replace("\t", " ").replace("\r", " ").replace("\n", " ").strip()
-    return "\t".join(fmt(row.get(col, "")) for col in COLUMNS)
+    return "\t".join(fmt(x) for x in row.values())
 
 def print_header_once():
     print("\t".join(COLUMNS))
     sys.stdout.flush()
 
-def save_results(rows: List[Dict[str, Any]]):
-    if not rows:
-        print("⚠️ No hay resultados para guardar todavía.")
-        return
+class ResultSink:
+    """Escribe cada fila al CSV en cuanto se produce (modo append).
+
+    Se hace flush por fila y fsync cada `fsync_every` filas, así que si el
+    proceso muere a media corrida las filas terminadas ya están en disco.
+    """
+
+    def __init__(self, path: str, fsync_every: int = RESULTS_FSYNC_EVERY):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.rows_written = 0
+        self.f = open(path, "w", encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(COLUMNS)
+        self.f.flush()
+
+    def write(self, row: ResultRow):
+        self.writer.writerow(["" if x is None else x for x in row.values()])
+        self.f.flush()
+        self.rows_written += 1
+        if self.rows_written % self.fsync_every == 0:
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        if not self.f.closed:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.f.close()
+
+def build_xlsx_from_csv(csv_path: str, xlsx_path: str):
+    """Genera el XLSX una sola vez al final, fila por fila (constant_memory)."""
+    numeric_cols = {COLUMNS.index(c) for c in NUMERIC_COLUMNS}
+    url_col = COLUMNS.index("URL_PDP")
+
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(xlsx_path, {"constant_memory": True})
+    ws = workbook.add_worksheet("Datos")
+    header_fmt = workbook.add_format({"bold": True, "border": 1, "align": "center"})
+    with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, COLUMNS)
+        for c, name in enumerate(header):
+            ws.write_string(0, c, name, header_fmt)
+        for r, values in enumerate(reader, start=1):
+            for c, val in enumerate(values):
+                if val == "":
+                    continue
+                if c == url_col and val.startswith("http"):
+                    ws.write_url(r, c, val, string=val)
+                elif c in numeric_cols:
+                    try:
+                        ws.write_number(r, c, float(val))
+                    except ValueError:
+                        ws.write_string(r, c, val)
+                else:
+                    ws.write_string(r, c, val)
+    workbook.close()
+
+def parquet_schema():
+    import pyarrow as pa
+
+    types = {
+        "TIMESTAMP": pa.timestamp("s"),
+        "PRECIO_REGULAR_NUM": pa.float64(),
+        "PRECIO_DESCUENTO_NUM": pa.float64(),
+        "INTENTOS": pa.int16(),
+        "SEGUNDOS_FETCH": pa.float32(),
+        "VENDEDOR": pa.dictionary(pa.int32(), pa.string()),
+        "STATUS": pa.dictionary(pa.int32(), pa.string()),
+    }
+    return pa.schema([(col, types.get(col, pa.string())) for col in COLUMNS])
+
+def _parquet_value(col: str, val: str):
+    if val == "":
+        return None
+    if col == "TIMESTAMP":
+        return datetime.strptime(val, "%Y-%m-%d %H:%M:%S")
+    if col == "INTENTOS":
+        return int(val)
+    if col in NUMERIC_COLUMNS:
+        try:
+            return float(val)
+        except ValueError:
+            return None
+    return val
+
+def _parquet_keys(partition: str) -> set:
+    """(TIMESTAMP, SKU o URL) de las filas que ya están en la partición."""
+    import pyarrow.parquet as pq
+
+    keys = set()
+    for fn in glob.glob(os.path.join(partition, "*.parquet")):
+        table = pq.read_table(fn, columns=["TIMESTAMP", "SKU", "URL_PDP"])
+        ts, skus, urls = (table.column(col).to_pylist() for col in ("TIMESTAMP", "SKU", "URL_PDP"))
+        keys.update((t, sku or url) for t, sku, url in zip(ts, skus, urls))
+    return keys
+
+def write_parquet_partition(csv_path: str, dataset_dir: str, run_date: Optional[str] = None) -> Optional[str]:
+    """Agrega las filas nuevas del CSV como un archivo en <dir>/fecha=AAAA-MM-DD/.
+
+    Nunca reescribe particiones anteriores: cada corrida deja su propio
+    part-*.parquet con columnas tipadas según COLUMNS. Las filas que ya están
+    en la partición (las que una corrida reanudada copia de la bitácora) no
+    se vuelven a escribir; si no queda ninguna nueva no se crea archivo.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("⚠️ PARQUET_DIR está configurado pero falta pyarrow; no se escribe Parquet.")
+        return None
+
+    run_date = run_date or datetime.now().strftime("%Y-%m-%d")
+    partition = os.path.join(dataset_dir, f"fecha={run_date}")
+    seen = _parquet_keys(partition)
+    columns: Dict[str, list] = {col: [] for col in COLUMNS}
+    repeated = 0
+    with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            values = {col: _parquet_value(col, row.get(col) or "") for col in COLUMNS}
+            if (values["TIMESTAMP"], values["SKU"] or values["URL_PDP"]) in seen:
+                repeated += 1
+                continue
+            for col in COLUMNS:
+                columns[col].append(values[col])
+    if repeated:
+        print(f"💾 Parquet: {repeated} filas ya estaban en '{partition}' (corrida reanudada); no se repiten.")
+    if not columns["SKU"]:
+        return None
+
+    os.makedirs(partition, exist_ok=True)
+    path = os.path.join(partition, f"part-{datetime.now():%H%M%S}-{uuid.uuid4().hex[:8]}.parquet")
+
+    table = pa.table(columns, schema=parquet_schema())
+    pq.write_table(table, path + ".tmp", compression="zstd")
+    os.replace(path + ".tmp", path)
+    print(f"💾 Parquet: {table.num_rows} filas en '{path}'.")
+    return path
 
-    df = pd.DataFrame(rows, columns=COLUMNS)
-    df.to_csv("liverpool_datos.csv", index=False, encoding="utf-8-sig")
+# ============================================================
+# 6b) Delta de precios contra la corrida anterior (opt-in: SNAPSHOT_DB)
+# ============================================================
+DELTA_CSV = "liverpool_delta.csv"
+DELTA_COLUMNS = [
+    "SKU",
+    "URL_PDP",
+    "TITULO",
+    "CAMBIO",
+    "PRECIO_REGULAR_ANT",
+    "PRECIO_REGULAR_NUM",
+    "PRECIO_DESCUENTO_ANT",
+    "PRECIO_DESCUENTO_NUM",
+    "VENDEDOR_ANT",
+    "VENDEDOR",
+]
+SNAPSHOT_FIELDS = ["PRECIO_REGULAR_NUM", "PRECIO_DESCUENTO_NUM", "VENDEDOR", "TITULO", "URL_PDP"]
+
+def _snapshot_key(df):
+    # Las URLs directas no traen SKU: las identificamos por su URL.
+    return df["SKU"].where(df["SKU"] != "", df["URL_PDP"])
+
+def _ensure_history_table(conn: sqlite3.Connection):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sku_history ("
+        " key TEXT PRIMARY KEY, last_fetch REAL, last_status TEXT,"
+        " failures INTEGER NOT NULL DEFAULT 0, last_change REAL,"
+        " changes INTEGER NOT NULL DEFAULT 0, discount REAL)"
+    )
 
-    with pd.ExcelWriter("liverpool_datos.xlsx", engine="xlsxwriter") as writer:
-        df.to_excel(writer, index=False, sheet_name="Datos")
-        ws = writer.sheets["Datos"]
-        col = "URL_PDP"
-        c = df.columns.get_loc(col)
-        for r, val in enumerate(df[col].fillna(""), start=1):
-            if isinstance(val, str) and val.startswith("http"):
-                ws.write_url(r, c, val, string=val)
+def compute_delta(csv_path: str, snapshot_path: str, delta_path: str = DELTA_CSV):
+    """Compara la corrida contra el snapshot anterior y escribe solo lo que cambió.
+
+    Tipos de cambio: NUEVO, ELIMINADO (antes OK, hoy 404), VENDEDOR_CAMBIA y,
+    por cada columna de precio por separado, <COLUMNA>_SUBE / _BAJA, o
+    _APARECE / _DESAPARECE cuando pasa de vacío a valor o al revés (p. ej.
+    PRECIO_DESCUENTO_DESAPARECE al terminar una promoción). Los SKUs que no se
+    alcanzaron a procesar no cuentan como eliminados, y si más de la mitad de
+    lo pedido sale 404 se asume falla del sitio y no se elimina nada. Al final
+    el snapshot queda con la corrida actual.
+    """
+    import pandas as pd
+
+    current = pd.read_csv(csv_path, encoding="utf-8-sig", dtype=str, keep_default_na=False)
+    if current.empty:
+        print("⚠️ Sin filas para calcular el delta.")
+        return None
+    for col in ("PRECIO_REGULAR_NUM", "PRECIO_DESCUENTO_NUM"):
+        current[col] = pd.to_numeric(current[col], errors="coerce")
+    current["KEY"] = _snapshot_key(current)
+    current = current.drop_duplicates("KEY", keep="last").set_index("KEY")
+    ok = current[current["STATUS"] == "OK"]
+    # Igual que la caché negativa: solo un 404 dice que el ítem ya no existe,
+    # y si casi todo sale 404 el problema es del sitio, no del catálogo.
+    fetched = ~current["STATUS"].str.startswith(SKIPPED_STATUS)
+    dead = current["STATUS"].isin(NEGATIVE_STATUSES)
+    gone_keys = current.index[dead]
+    if fetched.any() and dead.sum() / fetched.sum() > NEGATIVE_MAX_FAILURE_RATIO_DEFAULT:
+        print(f"⚠️ Delta: {int(dead.sum())}/{int(fetched.sum())} ítems con 404 en esta corrida; "
+              "parece falla del sitio, no se marcan como eliminados.")
+        gone_keys = current.index[:0]
+
+    conn = connect_sqlite(snapshot_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS snapshot ("
+        " key TEXT PRIMARY KEY, PRECIO_REGULAR_NUM REAL, PRECIO_DESCUENTO_NUM REAL,"
+        " VENDEDOR TEXT, TITULO TEXT, URL_PDP TEXT, updated_at TEXT)"
+    )
+    previous = pd.read_sql_query(
+        "SELECT key AS KEY, " + ", ".join(SNAPSHOT_FIELDS) + " FROM snapshot", conn
+    ).set_index("KEY")
+    for col in ("PRECIO_REGULAR_NUM", "PRECIO_DESCUENTO_NUM"):
+        previous[col] = pd.to_numeric(previous[col], errors="coerce")
+
+    merged = ok[SNAPSHOT_FIELDS].join(previous[SNAPSHOT_FIELDS], how="outer", rsuffix="_ANT")
+    in_now = merged.index.isin(ok.index)
+    in_before = merged.index.isin(previous.index)
+
+    both = in_now & in_before
+    changes = {
+        "NUEVO": in_now & ~in_before,
+        "ELIMINADO": merged.index.isin(gone_keys) & in_before,
+    }
+    # Cada precio se compara por separado: subir el regular con la misma
+    # promoción, o quitar una promoción, también es un cambio. Dos NaN son iguales.
+    for col in ("PRECIO_REGULAR_NUM", "PRECIO_DESCUENTO_NUM"):
+        now_v, before_v = merged[col], merged[col + "_ANT"]
+        name = col[:-len("_NUM")]
+        changes[name + "_SUBE"] = both & (now_v > before_v)
+        changes[name + "_BAJA"] = both & (now_v < before_v)
+        changes[name + "_APARECE"] = both & now_v.notna() & before_v.isna()
+        changes[name + "_DESAPARECE"] = both & now_v.isna() & before_v.notna()
+    changes["VENDEDOR_CAMBIA"] = both & (merged["VENDEDOR"].fillna("") != merged["VENDEDOR_ANT"].fillna(""))
+    labels = pd.Series("", index=merged.index)
+    for name, mask in changes.items():
+        labels = labels.where(~mask, labels + ";" + name)
+    merged["CAMBIO"] = labels.str.lstrip(";")
+
+    delta = merged[merged["CAMBIO"] != ""].copy()
+    delta["SKU"] = delta.index.where(~delta.index.str.startswith("http"), "")
+    delta["URL_PDP"] = delta["URL_PDP"].fillna(delta["URL_PDP_ANT"])
+    delta["TITULO"] = delta["TITULO"].fillna(delta["TITULO_ANT"])
+    delta = delta.rename(columns={
+        "PRECIO_REGULAR_NUM_ANT": "PRECIO_REGULAR_ANT",
+        "PRECIO_DESCUENTO_NUM_ANT": "PRECIO_DESCUENTO_ANT",
+    })
+    delta[DELTA_COLUMNS].to_csv(delta_path, index=False, encoding="utf-8-sig")
+
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT OR REPLACE INTO snapshot (key, " + ", ".join(SNAPSHOT_FIELDS) + ", updated_at)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (key, *(None if pd.isna(v) else v for v in values), now)
+            for key, values in zip(ok.index, ok[SNAPSHOT_FIELDS].itertuples(index=False))
+        ],
+    )
+    conn.executemany("DELETE FROM snapshot WHERE key = ?", [(k,) for k in gone_keys])
+
+    # Historial por SKU para el planificador por prioridad.
+    _ensure_history_table(conn)
+    changed = pd.Series(False, index=merged.index)
+    for name, mask in changes.items():
+        if name != "ELIMINADO":
+            changed |= mask
+    changed_keys = set(merged.index[changed])
+    promo = ok["PRECIO_DESCUENTO_NUM"].fillna(ok["PRECIO_REGULAR_NUM"])
+    discount = (1 - promo / ok["PRECIO_REGULAR_NUM"]).clip(lower=0)
+    fetched_at = time.time()
+    conn.executemany(
+        "INSERT INTO sku_history (key, last_fetch, last_status, failures, last_change, changes, discount)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)"
+        " ON CONFLICT(key) DO UPDATE SET"
+        "  last_fetch = excluded.last_fetch,"
+        "  last_status = excluded.last_status,"
+        "  failures = CASE WHEN excluded.failures = 0 THEN 0 ELSE sku_history.failures + 1 END,"
+        "  last_change = COALESCE(excluded.last_change, sku_history.last_change),"
+        "  changes = sku_history.changes + excluded.changes,"
+        "  discount = COALESCE(excluded.discount, sku_history.discount)",
+        [
+            (
+                key,
+                fetched_at,
+                status,
+                0 if status == "OK" else 1,
+                fetched_at if key in changed_keys else None,
+                1 if key in changed_keys else 0,
+                None if pd.isna(discount.get(key)) else float(discount.get(key)),
+            )
+            for key, status in current["STATUS"].items()
+            # Los omitidos por la caché negativa no se pidieron: ni falla ni visita.
+            if not status.startswith(SKIPPED_STATUS)
+        ],
+    )
+    conn.execute("COMMIT")
+    conn.close()
 
-    print("💾 Guardados 'liverpool_datos.csv' y 'liverpool_datos.xlsx'.")
+    counts = {name: int(mask.sum()) for name, mask in changes.items() if mask.any()}
+    print(f"📈 Delta: {len(delta)} SKUs con cambios {counts} -> '{delta_path}'.")
+    return delta_path
 
 # ============================================================
 # 7) Procesar un código o una URL
 # ============================================================
-def process_code(code: str) -> Dict[str, Any]:
+def fetch_product_info(
+    url: str,
+    stats: Optional[Dict[str, Any]] = None,
+) -> Tuple[Optional[int], Dict[str, Any]]:
+    """Descarga y parsea una PDP, pasando por response_cache si está activa.
+
+    Con NEXT_DATA_ROUTE=1 primero se pide el JSON de /_next/data y solo se
+    baja el HTML si no hay buildId vigente o el JSON no sirvió.
+
+    Regresa (status, info): status None si no se pudo obtener, 404 si no
+    existe y 200 en otro caso (info vacío = formato desconocido).
+    """
+    route = next_data_route
+    build_id = route.current() if route else None
+    json_stats: Dict[str, Any] = {}
+    if build_id:
+        json_status, info, _ = _fetch_and_parse(
+            next_data_url(url, build_id), json_stats, parse_product_from_next_json,
+            headers=NEXT_DATA_HEADERS, cache_empty=False,
+        )
+        if json_status is None or info:
+            _add_fetch_stats(stats, json_stats)
+            if info:
+                route.on_json()
+            return json_status, info
+
+    status, info, body = _fetch_and_parse(url, stats)
+    _add_fetch_stats(stats, json_stats)
+    if build_id:
+        route.on_fallback(build_id, json_status, status, body)
+    elif route and body is not None:
+        route.learn(body)
+    return status, info
+
+def _add_fetch_stats(stats: Optional[Dict[str, Any]], extra: Dict[str, Any]):
+    if stats is not None and extra:
+        stats["attempts"] = stats.get("attempts", 0) + extra.get("attempts", 0)
+        stats["seconds"] = stats.get("seconds", 0.0) + extra.get("seconds", 0.0)
+
+def _fetch_and_parse(
+    url: str,
+    stats: Optional[Dict[str, Any]],
+    parser=None,
+    headers: Optional[Dict[str, str]] = None,
+    cache_empty: bool = True,
+) -> Tuple[Optional[int], Dict[str, Any], Optional[bytes]]:
+    """(status, info, cuerpo) de una URL; cuerpo None si vino de la caché o no se obtuvo."""
+    entry = response_cache.lookup(url) if response_cache else None
+    if entry is not None and response_cache.is_fresh(entry):
+        response_cache.count("hits")
+        if stats is not None:
+            stats.update(attempts=0, seconds=0.0)
+        return 200, response_cache.entry_info(entry), None
+
+    if response_cache:
+        headers = {**(headers or {}), **response_cache.conditional_headers(entry)}
+    r = get_with_backoff(url, stats=stats, headers=headers)
+    if r is None:
+        return None, {}, None
+    if r.status_code == 304:
+        if entry is not None and response_cache.has_body(entry):
+            response_cache.count("not_modified")
+            return 200, response_cache.entry_info(entry), None
+        # 304 sin entrada que lo respalde (desalojada o perdida): la pedimos
+        # completa, sin validadores, en lugar de parsear un cuerpo vacío.
+        headers = {k: v for k, v in (headers or {}).items()
+                   if k not in ("If-None-Match", "If-Modified-Since")}
+        headers["Cache-Control"] = "no-cache"
+        entry = None
+        full_stats: Dict[str, Any] = {}
+        r = get_with_backoff(url, stats=full_stats, headers=headers)
+        _add_fetch_stats(stats, full_stats)
+        if r is None:
+            return None, {}, None
+    if r.status_code == 404:
+        return 404, {}, None
+
+    with stage_metrics.timed("parseo"):
+        info = parse_stage.parse(r.content, parser)
+    if response_cache and (info or cache_empty) and response_cache.store(url, r, info):
+        response_cache.count("refetched" if entry is not None else "misses")
+    return 200, info, r.content
+
+def process_code(code: str) -> ResultRow:
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    sku = code
     url_pdp = PDP_URL_TEMPLATE.format(code=code)
-    status = "OK"
 
-    saw_429 = [False]
-
-    initial_wait = planned_initial_wait()
-    print(f"   ⏳ Espera inicial antes de abrir '{sku}': {initial_wait:.1f}s (ratio 429 reciente: {current_429_ratio():.2f})")
-    time.sleep(initial_wait)
-
-    r = get_with_backoff(url_pdp, mark_429_flag=saw_429)
-    if not r:
+    fetch_stats: Dict[str, Any] = {}
+    status_code, info = variant_resolver.fetch(code, fetch_stats)
+    if status_code is None:
         status = "HTTP error PDP"
-        row = {
-            "TIMESTAMP": ts,
-            "SKU": sku,
-            "URL_PDP": url_pdp,
-            "CODIGO_PRODUCTO": "",
-            "TITULO": "",
-            "PRECIO_REGULAR_NUM": "",
-            "PRECIO_DESCUENTO_NUM": "",
-            "VENDEDOR": "",
-            "STATUS": status,
-        }
-    elif r.status_code == 404:
+    elif status_code == 404:
         status = "404 PDP"
-        row = {
-            "TIMESTAMP": ts,
-            "SKU": sku,
-            "URL_PDP": url_pdp,
-            "CODIGO_PRODUCTO": "",
-            "TITULO": "",
-            "PRECIO_REGULAR_NUM": "",
-            "PRECIO_DESCUENTO_NUM": "",
-            "VENDEDOR": "",
-            "STATUS": status,
-        }
+    elif not info:
+        status = "Formato PDP desconocido"
     else:
-        info = parse_product_from_html(r.text)
-        if not info:
-            status = "Formato PDP desconocido"
-            row = {
-                "TIMESTAMP": ts,
-                "SKU": sku,
-                "URL_PDP": url_pdp,
-                "CODIGO_PRODUCTO": "",
-                "TITULO": "",
-                "PRECIO_REGULAR_NUM": "",
-                "PRECIO_DESCUENTO_NUM": "",
-                "VENDEDOR": "",
-                "STATUS": status,
-            }
-        else:
-            row = {
-                "TIMESTAMP": ts,
-                "SKU": sku,
-                "URL_PDP": url_pdp,
-                "CODIGO_PRODUCTO": info.get("CODIGO_PRODUCTO", ""),
-                "TITULO": info.get("TITULO", ""),
-                "PRECIO_REGULAR_NUM": info.get("PRECIO_REGULAR_NUM", ""),
-                "PRECIO_DESCUENTO_NUM": info.get("PRECIO_DESCUENTO_NUM", ""),
-                "VENDEDOR": info.get("VENDEDOR", ""),
-                "STATUS": status,
-            }
+        status = "OK"
+    return make_result_row(ts, code, url_pdp, status, info, fetch_stats)
 
-    recent_429.append(bool(saw_429[0]))
-    if len(recent_429) > ROLLING_WINDOW:
-        recent_429.pop(0)
+def process_url(url: str) -> ResultRow:
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    return row
+    fetch_stats: Dict[str, Any] = {}
+    status_code, info = fetch_product_info(url, stats=fetch_stats)
+    if status_code is None:
+        status = "HTTP error URL"
+    elif status_code == 404:
+        status = "404 URL"
+    elif not info:
+        status = "Formato PDP desconocido"
+    else:
+        status = "OK"
+    return make_result_row(ts, "", url, status, info, fetch_stats)
 
-def process_url(url: str) -> Dict[str, Any]:
-    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    status = "OK"
-    sku = ""
+# ============================================================
+# 7b) Bitácora de trabajo para reanudar corridas (opt-in: JOURNAL_DB)
+# ============================================================
+# Estados que valen como "ya capturado"; los demás se vuelven a intentar.
+RETRYABLE_STATUS_PREFIXES = ("HTTP error", "Error")
+
+class WorkJournal:
+    """Estado de cada ítem por día: pending, in_flight, done o failed.
+
+    Si el job se cancela, la siguiente corrida del mismo día lee la bitácora,
+    vuelve a escribir las filas ya capturadas y solo procesa lo que falta
+    (los in_flight que quedaron colgados cuentan como pendientes).
+    """
+
+    def __init__(self, path: str):
+        self.conn = connect_sqlite(path)
+        self.lock = threading.Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS journal ("
+            " run_date TEXT NOT NULL, kind TEXT NOT NULL, payload TEXT NOT NULL,"
+            " state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+            " row TEXT, updated_at REAL NOT NULL,"
+            " PRIMARY KEY (run_date, kind, payload))"
+        )
 
-    saw_429 = [False]
+    def resume(self, items: List[tuple], run_date: str) -> Dict[tuple, ResultRow]:
+        """Registra los ítems del día y regresa las filas ya terminadas."""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO journal (run_date, kind, payload, state, updated_at)"
+                " VALUES (?, ?, ?, 'pending', ?)",
+                [(run_date, kind, payload, now) for kind, payload in items],
+            )
+            self.conn.execute("COMMIT")
+            done = self.conn.execute(
+                "SELECT kind, payload, row FROM journal WHERE run_date = ? AND state = 'done'",
+                (run_date,),
+            ).fetchall()
+        self.run_date = run_date
+        return {(kind, payload): ResultRow.from_dict(json.loads(row)) for kind, payload, row in done}
+
+    def mark_in_flight(self, kind: str, payload: str):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE journal SET state = 'in_flight', updated_at = ?"
+                " WHERE run_date = ? AND kind = ? AND payload = ?",
+                (time.time(), self.run_date, kind, payload),
+            )
 
-    initial_wait = planned_initial_wait()
-    print(f"   ⏳ Espera inicial antes de abrir URL directa: {initial_wait:.1f}s (ratio 429 reciente: {current_429_ratio():.2f})")
-    time.sleep(initial_wait)
+    def mark_result(self, kind: str, payload: str, row: ResultRow):
+        state = "failed" if str(row.get("STATUS", "")).startswith(RETRYABLE_STATUS_PREFIXES) else "done"
+        with self.lock:
+            self.conn.execute(
+                "UPDATE journal SET state = ?, attempts = attempts + 1, row = ?, updated_at = ?"
+                " WHERE run_date = ? AND kind = ? AND payload = ?",
+                (state, json.dumps(row.as_dict(), ensure_ascii=False), time.time(), self.run_date, kind, payload),
+            )
 
-    r = get_with_backoff(url, mark_429_flag=saw_429)
-    if not r:
-        status = "HTTP error URL"
-        row = {
-            "TIMESTAMP": ts,
-            "SKU": sku,
-            "URL_PDP": url,
-            "CODIGO_PRODUCTO": "",
-            "TITULO": "",
-            "PRECIO_REGULAR_NUM": "",
-            "PRECIO_DESCUENTO_NUM": "",
-            "VENDEDOR": "",
-            "STATUS": status,
-        }
-    elif r.status_code == 404:
-        status = "404 URL"
-        row = {
-            "TIMESTAMP": ts,
-            "SKU": sku,
-            "URL_PDP": url,
-            "CODIGO_PRODUCTO": "",
-            "TITULO": "",
-            "PRECIO_REGULAR_NUM": "",
-            "PRECIO_DESCUENTO_NUM": "",
-            "VENDEDOR": "",
-            "STATUS": status,
-        }
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT state, COUNT(*) FROM journal WHERE run_date = ? GROUP BY state",
+                (self.run_date,),
+            ).fetchall()
+        return dict(rows)
+
+work_journal: Optional[WorkJournal] = None  # se arma en init_runtime()
+
+# ============================================================
+# 7c) Planificador por prioridad (opt-in: PRIORITY_SCHEDULER=1 + SNAPSHOT_DB)
+# ============================================================
+def refresh_interval_days(stats: Optional[Dict[str, Any]], now: float) -> float:
+    """Cada cuántos días conviene volver a abrir un SKU según su historial.
+
+    Nuevos, fallidos o con descuento fuerte: cada corrida. Los estables se
+    van espaciando hasta PRIORITY_MAX_INTERVAL_DAYS.
+    """
+    if not stats or stats.get("failures") or (stats.get("discount") or 0) >= PRIORITY_HIGH_DISCOUNT:
+        return 0.0
+    last_change = stats.get("last_change") or stats.get("last_fetch") or now
+    days_stable = max(0.0, (now - last_change) / 86400)
+    return min(PRIORITY_MAX_INTERVAL_DAYS, max(1.0, days_stable / PRIORITY_STABLE_DAYS_PER_STEP))
+
+def priority_score(stats: Optional[Dict[str, Any]], now: float) -> float:
+    if not stats:
+        return 4.0
+    score = 3.0 * min(stats.get("failures") or 0, 3)
+    if stats.get("last_change"):
+        score += 2.0 * math.exp(-(now - stats["last_change"]) / (7 * 86400))
+    score += stats.get("discount") or 0.0
+    return score
+
+def plan_refresh(
+    keys: List[str],
+    history: Dict[str, Dict[str, Any]],
+    now: float,
+) -> Tuple[List[str], List[str]]:
+    """Regresa (los que ya toca refrescar, el resto), cada lista por score."""
+    due, later = [], []
+    for key in keys:
+        stats = history.get(key)
+        since_fetch = (now - stats["last_fetch"]) / 86400 if stats and stats.get("last_fetch") else math.inf
+        # Las corridas son diarias a la misma hora: unas horas de holgura.
+        bucket = due if since_fetch >= refresh_interval_days(stats, now) - 0.25 else later
+        bucket.append((-priority_score(stats, now), len(bucket), key))
+    return [key for _, _, key in sorted(due)], [key for _, _, key in sorted(later)]
+
+def load_sku_history(snapshot_path: str) -> Dict[str, Dict[str, Any]]:
+    conn = connect_sqlite(snapshot_path)
+    try:
+        _ensure_history_table(conn)
+        rows = conn.execute(
+            "SELECT key, last_fetch, last_status, failures, last_change, changes, discount FROM sku_history"
+        ).fetchall()
+    finally:
+        conn.close()
+    fields = ("last_fetch", "last_status", "failures", "last_change", "changes", "discount")
+    return {row[0]: dict(zip(fields, row[1:])) for row in rows}
+
+def schedule_items(items: List[tuple], snapshot_path: str) -> List[tuple]:
+    by_key = {payload: (kind, payload) for kind, payload in items}
+    due, later = plan_refresh(list(by_key), load_sku_history(snapshot_path), time.time())
+    print(f"🗓️ Planificador: {len(due)} ítems tocan hoy, {len(later)} después si alcanza el tiempo.")
+    return [by_key[key] for key in due + later]
+
+# ============================================================
+# 7d) Reparto en shards para correr en varios jobs (SHARD_INDEX / SHARD_COUNT)
+# ============================================================
+PENDING_TXT = "liverpool_pendientes.txt"
+
+def shard_config() -> Tuple[int, int]:
+    """(índice, total) de shards según el entorno; (0, 1) = corrida completa."""
+    count = max(1, int(os.getenv("SHARD_COUNT", "1")))
+    index = int(os.getenv("SHARD_INDEX", "0"))
+    if not 0 <= index < count:
+        raise ValueError(f"SHARD_INDEX={index} fuera de rango para SHARD_COUNT={count}")
+    return index, count
+
+def shard_of(payload: str, count: int) -> int:
+    # crc32 y no hash(): hash() cambia entre procesos (PYTHONHASHSEED) y el
+    # reparto tiene que ser el mismo en todos los jobs.
+    return zlib.crc32(payload.encode("utf-8")) % count
+
+def select_shard(items: Iterable[tuple], index: int, count: int) -> List[tuple]:
+    if count <= 1:
+        return list(items)
+    return [(kind, payload) for kind, payload in items if shard_of(payload, count) == index]
+
+def shard_path(path: str, index: int, count: int) -> str:
+    """'liverpool_datos.csv' -> 'liverpool_datos.shard-1-of-4.csv' (sin cambios si count <= 1)."""
+    if count <= 1:
+        return path
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.shard-{index}-of-{count}{ext}"
+
+def _find_shard_files(shard_dir: str, path: str) -> Dict[int, str]:
+    stem, ext = os.path.splitext(os.path.basename(path))
+    pattern = re.compile(re.escape(stem) + r"\.shard-(\d+)-of-(\d+)" + re.escape(ext) + "$")
+    found: Dict[int, str] = {}
+    expected = 0
+    # Recursivo: download-artifact deja cada shard en su propia carpeta.
+    for fn in sorted(glob.glob(os.path.join(shard_dir, "**", f"{stem}.shard-*{ext}"), recursive=True)):
+        m = pattern.search(fn)
+        if m:
+            found[int(m.group(1))] = fn
+            expected = max(expected, int(m.group(2)))
+    missing = [i for i in range(expected) if i not in found]
+    if missing:
+        print(f"⚠️ Faltan shards de '{os.path.basename(path)}': {missing}")
+    return found
+
+def merge_shards(shard_dir: str = ".", csv_path: str = RESULTS_CSV, pending_path: str = PENDING_TXT) -> int:
+    """Junta los CSV de cada shard en `csv_path`, en el orden de INPUT_CODES/INPUT_URLS.
+
+    También concatena los pendientes de cada shard en `pending_path`.
+    Regresa el número de filas escritas.
+    """
+    order = {payload: i for i, (_, payload) in enumerate(build_items())}
+    shard_files = _find_shard_files(shard_dir, csv_path)
+    if not shard_files:
+        print(f"⚠️ No encontré CSV de shards en '{shard_dir}'; se deja '{csv_path}' como está.")
+        return 0
+    rows: List[ResultRow] = []
+    for index, fn in sorted(shard_files.items()):
+        with open(fn, "r", encoding="utf-8-sig", newline="") as f:
+            shard_rows = [ResultRow.from_dict(row) for row in csv.DictReader(f)]
+        print(f"🧩 Shard {index}: {len(shard_rows)} filas ({fn})")
+        rows.extend(shard_rows)
+    rows.sort(key=lambda row: order.get(row.SKU or row.URL_PDP, len(order)))
+
+    sink = ResultSink(csv_path)
+    for row in rows:
+        sink.write(row)
+    sink.close()
+
+    pending: List[str] = []
+    for _, fn in sorted(_find_shard_files(shard_dir, pending_path).items()):
+        with open(fn, "r", encoding="utf-8") as f:
+            pending.extend(ln.strip() for ln in f if ln.strip())
+    if pending:
+        with open(pending_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(pending) + "\n")
+        print(f"⚠️ {len(pending)} ítems pendientes entre todos los shards -> '{pending_path}'.")
+
+    # Cada ítem debe salir de exactamente un shard: repetidos o ausentes
+    # indican que los jobs no vieron la misma lista de entrada.
+    seen = Counter(row.SKU or row.URL_PDP for row in rows)
+    duplicated = sorted(key for key, n in seen.items() if n > 1)
+    if duplicated:
+        print(f"⚠️ {len(duplicated)} ítems aparecen en más de un shard: {duplicated[:10]}")
+    pending_keys = set(pending)
+    missing = [key for key in order if key not in seen and key not in pending_keys]
+    if missing:
+        print(f"⚠️ {len(missing)} ítems no salieron de ningún shard: {missing[:10]}")
+
+    print(f"💾 {sink.rows_written} filas combinadas en '{csv_path}'.")
+    return sink.rows_written
+
+def merge_run_reports(shard_dir: str = ".", started: Optional[float] = None) -> Dict[str, Any]:
+    """Combina los reportes de cada shard en stage_metrics y escribe RUN_REPORT_JSON.
+
+    Los shards corren en paralelo, así que la duración es la del más lento
+    (más lo que tarde el merge desde `started`).
+    """
+    wall = 0.0
+    retries: Dict[str, Any] = {}
+    files = [fn for _, fn in sorted(_find_shard_files(shard_dir, RUN_REPORT_JSON).items())]
+    if not files and os.path.exists(RUN_REPORT_JSON):
+        # Corrida sin shards: el reporte ya es el canónico.
+        files = [RUN_REPORT_JSON]
+    for fn in files:
+        with open(fn, "r", encoding="utf-8") as f:
+            shard_report = json.load(f)
+        stage_metrics.merge_report(shard_report)
+        wall = max(wall, shard_report.get("segundos", 0.0))
+        # Cada shard tiene su propio presupuesto de reintentos: se suman.
+        shard_retries = shard_report.get("reintentos")
+        if shard_retries:
+            for key in ("retries_used", "retry_budget"):
+                retries[key] = retries.get(key, 0) + shard_retries[key]
+            retries["item_deadline_s"] = max(retries.get("item_deadline_s", 0.0), shard_retries["item_deadline_s"])
+    if started is not None:
+        wall += time.time() - started
+    report = stage_metrics.report(wall)
+    if retries:
+        report["reintentos"] = retries
+    write_run_report(report)
+    return report
+
+# ============================================================
+# 7e) Catálogo externo de SKUs (opt-in: CATALOG=archivo.db | archivo.txt)
+# ============================================================
+CATALOG_SQLITE_EXTS = (".db", ".sqlite", ".sqlite3")
+CATALOG_FETCH_SIZE = 1000
+
+def is_sqlite_catalog(path: str) -> bool:
+    return path.lower().endswith(CATALOG_SQLITE_EXTS)
+
+def item_kind(payload: str) -> str:
+    return "url" if payload.startswith(("http://", "https://")) else "code"
+
+def dedupe_items(items: Iterable[tuple]) -> Iterator[tuple]:
+    """Deja pasar cada payload una sola vez (conserva la primera aparición)."""
+    seen = set()
+    dups = 0
+    for kind, payload in items:
+        if payload in seen:
+            dups += 1
+            continue
+        seen.add(payload)
+        yield kind, payload
+    if dups:
+        print(f"⚠️ Se ignoraron {dups} ítems duplicados en la lista de entrada.")
+
+def builtin_items() -> Iterator[tuple]:
+    for ln in INPUT_CODES.splitlines():
+        ln = ln.strip()
+        if ln and not ln.startswith("#"):
+            yield "code", ln
+    for u in INPUT_URLS:
+        if u.strip():
+            yield "url", u.strip()
+
+def _catalog_lines(path: str) -> Iterator[Tuple[str, str]]:
+    """(payload, campo de tags sin separar) por cada línea útil del catálogo de texto."""
+    with open(path, "r", encoding="utf-8") as f:
+        for ln in f:
+            ln = ln.strip()
+            if not ln or ln[0] == "#":
+                continue
+            payload, _, tag_field = ln.partition("\t")
+            yield payload.rstrip(), tag_field
+
+def read_catalog_file(path: str) -> Iterator[tuple]:
+    """Lee un catálogo de texto línea por línea: `payload[<TAB>tag1,tag2]`.
+
+    El payload es un código o una URL PDP; las líneas con # se ignoran.
+    Regresa (kind, payload, tags).
+    """
+    for payload, tag_field in _catalog_lines(path):
+        yield item_kind(payload), payload, {t.strip() for t in tag_field.split(",") if t.strip()}
+
+def iter_catalog_file(path: str, tags: Iterable[str] = ()) -> Iterator[tuple]:
+    """(kind, payload) del catálogo de texto; con `tags`, solo los que tengan alguna.
+
+    Sin `tags` el campo de etiquetas ni se separa: es la mayor parte del costo por línea.
+    """
+    wanted = set(tags)
+    for payload, tag_field in _catalog_lines(path):
+        if wanted and wanted.isdisjoint(t.strip() for t in tag_field.split(",")):
+            continue
+        yield item_kind(payload), payload
+
+class SkuCatalog:
+    """Catálogo de SKUs/URLs en SQLite con prioridad, etiquetas y último estado.
+
+    `catalog` guarda un renglón por payload (la llave primaria evita
+    duplicados) y `catalog_tags` la relación etiqueta -> payload, indexada
+    para filtrar sin recorrer todo el catálogo.
+    """
+
+    def __init__(self, path: str):
+        self.conn = connect_sqlite(path)
+        self.lock = threading.Lock()
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS catalog ("
+            " payload TEXT PRIMARY KEY, kind TEXT NOT NULL CHECK (kind IN ('code', 'url')),"
+            " priority REAL NOT NULL DEFAULT 0, last_seen TEXT, last_status TEXT);"
+            "CREATE INDEX IF NOT EXISTS catalog_priority ON catalog (priority DESC);"
+            "CREATE INDEX IF NOT EXISTS catalog_status ON catalog (last_status);"
+            "CREATE TABLE IF NOT EXISTS catalog_tags ("
+            " tag TEXT NOT NULL, payload TEXT NOT NULL, PRIMARY KEY (tag, payload)) WITHOUT ROWID;"
+        )
+
+    def add(self, entries: Iterable[tuple], priority: float = 0.0) -> Tuple[int, int]:
+        """Agrega (kind, payload, tags); regresa (nuevos, ya existentes).
+
+        Los que ya existían conservan prioridad y estado, pero suman etiquetas.
+        """
+        added = existing = 0
+        with self.lock:
+            self.conn.execute("BEGIN")
+            for kind, payload, tags in entries:
+                cur = self.conn.execute(
+                    "INSERT OR IGNORE INTO catalog (payload, kind, priority) VALUES (?, ?, ?)",
+                    (payload, kind, priority),
+                )
+                if cur.rowcount:
+                    added += 1
+                else:
+                    existing += 1
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO catalog_tags (tag, payload) VALUES (?, ?)",
+                    [(tag, payload) for tag in tags],
+                )
+            self.conn.execute("COMMIT")
+        return added, existing
+
+    def iter_items(self, tags: Iterable[str] = (), only_failed: bool = False) -> Iterator[tuple]:
+        """(kind, payload) por prioridad descendente, leídos del cursor en bloques.
+
+        `tags` filtra a los que tengan alguna de esas etiquetas; `only_failed`
+        a los que terminaron con error en la última corrida registrada.
+        """
+        tags = list(tags)
+        sql = "SELECT kind, payload FROM catalog"
+        where, params = [], []
+        if tags:
+            where.append(
+                "payload IN (SELECT payload FROM catalog_tags WHERE tag IN (%s))" % ",".join("?" * len(tags))
+            )
+            params.extend(tags)
+        if only_failed:
+            where.append("(%s)" % " OR ".join("last_status LIKE ?" for _ in RETRYABLE_STATUS_PREFIXES))
+            params.extend(prefix + "%" for prefix in RETRYABLE_STATUS_PREFIXES)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY priority DESC, rowid"
+        # Cursor propio: no se queda con el lock mientras el llamador consume.
+        cur = self.conn.cursor()
+        cur.execute(sql, params)
+        while True:
+            batch = cur.fetchmany(CATALOG_FETCH_SIZE)
+            if not batch:
+                break
+            yield from batch
+
+    def record_results(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """Guarda TIMESTAMP y STATUS de cada fila como last_seen / last_status."""
+        updated = 0
+        with self.lock:
+            self.conn.execute("BEGIN")
+            for row in rows:
+                payload = row.get("SKU") or row.get("URL_PDP")
+                cur = self.conn.execute(
+                    "UPDATE catalog SET last_seen = ?, last_status = ? WHERE payload = ?",
+                    (row.get("TIMESTAMP", ""), row.get("STATUS", ""), payload),
+                )
+                updated += cur.rowcount
+            self.conn.execute("COMMIT")
+        return updated
+
+    def close(self):
+        self.conn.close()
+
+def import_catalog(db_path: str, source: str = "", tags: Iterable[str] = ()) -> Tuple[int, int]:
+    """Carga un archivo de texto (o INPUT_CODES/INPUT_URLS si no hay `source`) al catálogo SQLite."""
+    tags = set(tags)
+    if source:
+        entries = ((kind, payload, line_tags | tags) for kind, payload, line_tags in read_catalog_file(source))
     else:
-        info = parse_product_from_html(r.text)
-        if not info:
-            status = "Formato PDP desconocido"
-            row = {
-                "TIMESTAMP": ts,
-                "SKU": sku,
-                "URL_PDP": url,
-                "CODIGO_PRODUCTO": "",
-                "TITULO": "",
-                "PRECIO_REGULAR_NUM": "",
-                "PRECIO_DESCUENTO_NUM": "",
-                "VENDEDOR": "",
-                "STATUS": status,
+        entries = ((kind, payload, tags) for kind, payload in builtin_items())
+    catalog = SkuCatalog(db_path)
+    try:
+        added, existing = catalog.add(entries)
+    finally:
+        catalog.close()
+    print(f"📚 Catálogo '{db_path}': {added} nuevos, {existing} ya existían.")
+    return added, existing
+
+# ============================================================
+# 7f) Precios por páginas de listado (opt-in: LISTING_URLS=archivo.txt)
+# ============================================================
+LISTING_MAX_PAGES_DEFAULT = 20
+LISTING_VERIFY_DEFAULT = 10
+LISTING_REPORT_JSON = "liverpool_listados.json"
+LISTING_PRICES_JSON = "liverpool_listados_precios.json"
+LISTING_PRICE_TOLERANCE = 0.005
+
+def read_listing_urls(path: str) -> List[str]:
+    """URLs de listados, una por línea (# comenta). `{page}` en la URL se pagina 1, 2, 3..."""
+    with open(path, "r", encoding="utf-8") as f:
+        return [ln.strip() for ln in f if ln.strip() and not ln.strip().startswith("#")]
+
+def fetch_listing(url: str, max_pages: int) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, str], int]:
+    """Recorre un listado: (código -> info, código -> página donde salió, páginas pedidas).
+
+    Con `{page}` se avanza hasta `max_pages`, un 404, una página sin
+    productos o una que ya no trae códigos nuevos.
+    """
+    found: Dict[str, Dict[str, Any]] = {}
+    pages: Dict[str, str] = {}
+    fetched = 0
+    for page in range(1, max_pages + 1 if "{page}" in url else 2):
+        page_url = url.replace("{page}", str(page))
+        r = get_with_backoff(page_url)
+        fetched += 1
+        if r is None or r.status_code == 404:
+            break
+        with stage_metrics.timed("parseo"):
+            records = parse_listing_from_html(r.content)
+        new = {code: info for code, info in records.items() if code not in found}
+        print(f"   📄 {page_url}: {len(records)} productos ({len(new)} nuevos)")
+        if not new:
+            break
+        found.update(new)
+        pages.update(dict.fromkeys(new, page_url))
+    return found, pages, fetched
+
+def discover_listing_prices(urls: List[str], concurrency: int, max_pages: int):
+    """Baja todos los listados (un hilo por URL base) y junta lo encontrado."""
+    found: Dict[str, Dict[str, Any]] = {}
+    pages: Dict[str, str] = {}
+    fetched = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(urls)))) as pool:
+        for url_found, url_pages, url_fetched in pool.map(lambda u: fetch_listing(u, max_pages), urls):
+            for code, info in url_found.items():
+                if code not in found:
+                    found[code] = info
+                    pages[code] = url_pages[code]
+            fetched += url_fetched
+    return found, pages, fetched
+
+def save_listing_prices(path: str, found: Dict[str, Dict[str, Any]], pages: Dict[str, str], fetched: int):
+    """Guarda lo encontrado en los listados para que cada shard lo lea sin volver a pedirlo."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"generado": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                   "paginas_pedidas": fetched, "precios": found, "paginas": pages},
+                  f, ensure_ascii=False)
+
+def load_listing_prices(path: str) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, str], int]:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return data["precios"], data["paginas"], data["paginas_pedidas"]
+
+def apply_listing_prices(
+    items: List[tuple],
+    found: Dict[str, Dict[str, Any]],
+    verify: int,
+) -> Tuple[List[tuple], List[tuple], Dict[str, Dict[str, Any]]]:
+    """Reparte los ítems: (cubiertos por listados, los que van a PDP, muestra a verificar).
+
+    La muestra (elegida por crc32 del código, estable entre corridas) se
+    baja también por PDP; su info de listado se guarda para compararla.
+    """
+    covered = [item for item in items if item[0] == "code" and item[1] in found]
+    sample = set(sorted((item[1] for item in covered), key=lambda c: zlib.crc32(c.encode("utf-8")))[:verify])
+    bulk = [item for item in covered if item[1] not in sample]
+    bulk_set = set(bulk)
+    to_fetch = [item for item in items if item not in bulk_set]
+    return bulk, to_fetch, {code: found[code] for code in sample}
+
+def listing_row(code: str, info: Dict[str, Any]) -> ResultRow:
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return make_result_row(ts, code, PDP_URL_TEMPLATE.format(code=code), "OK", info, {"attempts": 0, "seconds": 0.0})
+
+def _listing_field_matches(field: str, listed: Any, pdp: Any) -> bool:
+    if field in ("PRECIO_REGULAR_NUM", "PRECIO_DESCUENTO_NUM"):
+        try:
+            return abs(float(listed) - float(pdp)) <= LISTING_PRICE_TOLERANCE
+        except (TypeError, ValueError):
+            return listed in (None, "") and pdp in (None, "")
+    return str(listed or "").strip() == str(pdp or "").strip()
+
+def listing_report(
+    items: List[tuple],
+    found: Dict[str, Dict[str, Any]],
+    pages: Dict[str, str],
+    pages_fetched: int,
+    bulk: List[tuple],
+    sample: Dict[str, Dict[str, Any]],
+    rows: Iterable[ResultRow],
+) -> Dict[str, Any]:
+    """Cobertura de los listados y coincidencia campo por campo contra la PDP de la muestra."""
+    codes = [payload for kind, payload in items if kind == "code"]
+    fields = [f for f in INFO_FIELDS if f != "CODIGO_PRODUCTO"]
+    matches = dict.fromkeys(fields, 0)
+    differences = []
+    verified = 0
+    for row in rows:
+        listed = sample.get(row["SKU"])
+        if listed is None or row["STATUS"] != "OK":
+            continue
+        verified += 1
+        for field in fields:
+            if _listing_field_matches(field, listed.get(field), row[field]):
+                matches[field] += 1
+            else:
+                differences.append({"SKU": row["SKU"], "campo": field, "listado": listed.get(field),
+                                    "pdp": row[field], "pagina": pages.get(row["SKU"], "")})
+    per_page: Dict[str, int] = {}
+    for code in codes:
+        if code in pages:
+            per_page[pages[code]] = per_page.get(pages[code], 0) + 1
+    covered = sum(1 for code in codes if code in found)
+    return {
+        "generado": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "paginas_pedidas": pages_fetched,
+        "productos_en_listados": len(found),
+        "codigos": len(codes),
+        "cubiertos": covered,
+        "cobertura": round(covered / len(codes), 4) if codes else 0.0,
+        "desde_listado": len(bulk),
+        "verificados_por_pdp": verified,
+        "coincidencias": {f: (round(n / verified, 4) if verified else None) for f, n in matches.items()},
+        "diferencias": differences,
+        "sin_cubrir": [code for code in codes if code not in found],
+        "codigos_por_pagina": dict(sorted(per_page.items())),
+    }
+
+def format_listing_report(report: Dict[str, Any]) -> str:
+    lines = [
+        f"Listados: {report['paginas_pedidas']} páginas, {report['productos_en_listados']} productos; "
+        f"cubren {report['cubiertos']}/{report['codigos']} códigos ({100 * report['cobertura']:.1f}%), "
+        f"{report['desde_listado']} sin pedir su PDP.",
+        f"Muestra verificada por PDP: {report['verificados_por_pdp']} ítems, coincidencia "
+        + ", ".join(f"{f}={'-' if v is None else f'{100 * v:.0f}%'}" for f, v in report["coincidencias"].items()),
+    ]
+    for diff in report["diferencias"][:10]:
+        lines.append(f"   ≠ {diff['SKU']} {diff['campo']}: listado={diff['listado']!r} pdp={diff['pdp']!r}")
+    return "\n".join(lines)
+
+# ============================================================
+# 7g) Variantes hermanas: una PDP por producto (índice persistente: SKU_INDEX_DB)
+# ============================================================
+class VariantResolver:
+    """SKU -> (producto, código con el que se pide su PDP).
+
+    Todas las variantes de un producto (tallas, colores...) comparten la
+    misma página. Al bajar una PDP se registran todas sus variantes; las
+    hermanas que lleguen después en la corrida salen de esa página sin otra
+    petición, con los precios de su propia variante. Con `path` el índice se
+    guarda en SQLite y desde la siguiente corrida los SKUs se agrupan por
+    producto desde el principio. El reparto en shards sigue siendo por SKU
+    (estable entre jobs); cada shard resuelve sus propias hermanas.
+    """
+
+    def __init__(self, path: str = ""):
+        self.lock = threading.Lock()
+        self.index: Dict[str, Tuple[str, str]] = {}
+        self.products: Dict[str, Dict[str, Any]] = {}
+        self.inflight: Dict[str, threading.Event] = {}
+        self.counts = {"pdp": 0, "reusadas": 0, "aprendidas": 0}
+        self.conn = None
+        if path:
+            self.conn = connect_sqlite(path)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS sku_index ("
+                " sku TEXT PRIMARY KEY, product_id TEXT NOT NULL,"
+                " pdp_code TEXT NOT NULL, updated TEXT NOT NULL) WITHOUT ROWID"
+            )
+            self.index = {
+                sku: (product_id, pdp_code)
+                for sku, product_id, pdp_code in self.conn.execute(
+                    "SELECT sku, product_id, pdp_code FROM sku_index")
             }
-        else:
-            row = {
-                "TIMESTAMP": ts,
-                "SKU": sku,
-                "URL_PDP": url,
-                "CODIGO_PRODUCTO": info.get("CODIGO_PRODUCTO", ""),
-                "TITULO": info.get("TITULO", ""),
-                "PRECIO_REGULAR_NUM": info.get("PRECIO_REGULAR_NUM", ""),
-                "PRECIO_DESCUENTO_NUM": info.get("PRECIO_DESCUENTO_NUM", ""),
-                "VENDEDOR": info.get("VENDEDOR", ""),
-                "STATUS": status,
+
+    def new_run(self):
+        """Los precios son de esta corrida: las páginas ya bajadas no pasan a la siguiente."""
+        with self.lock:
+            self.products.clear()
+            self.counts = {"pdp": 0, "reusadas": 0, "aprendidas": 0}
+
+    def fetch(self, code: str, stats: Dict[str, Any]) -> Tuple[Optional[int], Dict[str, Any]]:
+        """Como fetch_product_info para el SKU `code`, pero con el info de su variante."""
+        with self.lock:
+            product_id, pdp_code = self.index.get(code, ("", code))
+        owner = False
+        while product_id:
+            with self.lock:
+                info = self.products.get(product_id)
+                event = self.inflight.get(product_id)
+                if info is None and event is None:
+                    self.inflight[product_id] = threading.Event()
+                    owner = True
+            if info is not None:
+                vinfo = select_variant(info, code)
+                if vinfo is not None:
+                    with self.lock:
+                        self.counts["reusadas"] += 1
+                    stats.update(attempts=0, seconds=0.0)
+                    return 200, vinfo
+                self.forget(code)  # ya no es variante de ese producto
+                pdp_code = code
+                break
+            if owner:
+                break
+            # Otra variante del mismo producto ya va en camino: esperamos su página.
+            event.wait()
+
+        try:
+            status, info = fetch_product_info(PDP_URL_TEMPLATE.format(code=pdp_code), stats)
+            vinfo = select_variant(info, code, pdp_code) if info else None
+            if pdp_code != code and (status == 404 or (info and vinfo is None)):
+                # La PDP de la hermana ya no sirve para este SKU: pedimos la suya.
+                self.forget(code)
+                own_stats: Dict[str, Any] = {}
+                status, info = fetch_product_info(PDP_URL_TEMPLATE.format(code=code), own_stats)
+                _add_fetch_stats(stats, own_stats)
+                pdp_code = code
+                vinfo = select_variant(info, code, pdp_code) if info else None
+            if info:
+                self.learn(pdp_code, info)
+        finally:
+            if owner:
+                with self.lock:
+                    self.inflight.pop(product_id).set()
+        with self.lock:
+            self.counts["pdp"] += 1
+        # Si su propia página no lo lista como variante, se queda variants[0].
+        return status, vinfo or info
+
+    def learn(self, pdp_code: str, info: Dict[str, Any]):
+        product_id = info.get("PRODUCTO_ID")
+        if not product_id:
+            return
+        codes = set(info.get("VARIANTES") or ()) | {pdp_code}
+        if info.get("CODIGO_PRODUCTO"):
+            codes.add(str(info["CODIGO_PRODUCTO"]))
+        today = datetime.now().strftime("%Y-%m-%d")
+        with self.lock:
+            self.products[product_id] = info
+            # Los que ya apuntan a este producto conservan su código de PDP.
+            new = [(sku, product_id, pdp_code, today) for sku in sorted(codes)
+                   if self.index.get(sku, ("",))[0] != product_id]
+            for sku, _, _, _ in new:
+                self.index[sku] = (product_id, pdp_code)
+            self.counts["aprendidas"] += len(new)
+            if self.conn is not None and new:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO sku_index (sku, product_id, pdp_code, updated) VALUES (?, ?, ?, ?)",
+                    new,
+                )
+                self.conn.commit()
+
+    def forget(self, sku: str):
+        """Saca `sku` del índice: la página de su producto ya no lo trae."""
+        with self.lock:
+            if self.index.pop(sku, None) is None:
+                return
+            if self.conn is not None:
+                self.conn.execute("DELETE FROM sku_index WHERE sku = ?", (sku,))
+                self.conn.commit()
+
+    def summary(self) -> str:
+        c = self.counts
+        return (f"{c['pdp']} PDP pedidas, {c['reusadas']} SKUs resueltos con la página de una hermana, "
+                f"{c['aprendidas']} SKUs nuevos en el índice ({len(self.index)} en total)")
+
+# Sin índice en disco hasta init_runtime() (SKU_INDEX_DB).
+variant_resolver = VariantResolver()
+
+# ============================================================
+# 7h) Caché negativa de SKUs muertos (opt-in: NEGATIVE_CACHE_DB)
+# ============================================================
+# Solo un 404 dice que el ítem no existe; un formato desconocido suele ser
+# un reto anti-bot o un rediseño que afecta a todo el sitio.
+NEGATIVE_STATUSES = ("404 PDP", "404 URL")
+SKIPPED_STATUS = "Omitido"
+NEGATIVE_MIN_FAILURES_DEFAULT = 2
+NEGATIVE_TTL_BASE_DAYS_DEFAULT = 1.0
+NEGATIVE_TTL_MAX_DAYS_DEFAULT = 30.0
+NEGATIVE_PROBE_MAX_DEFAULT = 25
+NEGATIVE_MAX_FAILURE_RATIO_DEFAULT = 0.5
+
+def _row_item(row: ResultRow) -> tuple:
+    """(kind, payload) de una fila: las de código traen SKU, las de URL solo URL_PDP."""
+    return ("code", row["SKU"]) if row["SKU"] else ("url", row["URL_PDP"])
+
+class NegativeCache:
+    """Ítems que dan 404 corrida tras corrida.
+
+    Cuenta fallas seguidas (una por día como máximo). Desde `min_failures` el
+    ítem se omite durante un TTL que se duplica con cada falla (base_days,
+    2 * base_days, ... hasta max_days). Al vencer se vuelve a probar en una
+    pasada de baja prioridad al final de la corrida; un OK lo saca de la tabla.
+    Si en una corrida más de `max_failure_ratio` de lo pedido sale muerto, el
+    problema es del sitio y no de los ítems: esas fallas no se registran.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        min_failures: int,
+        base_days: float,
+        max_days: float,
+        max_failure_ratio: float = NEGATIVE_MAX_FAILURE_RATIO_DEFAULT,
+    ):
+        self.conn = connect_sqlite(path)
+        self.lock = threading.Lock()
+        self.min_failures = min_failures
+        self.base_days = base_days
+        self.max_days = max_days
+        self.max_failure_ratio = max_failure_ratio
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS negative ("
+            " kind TEXT NOT NULL, payload TEXT NOT NULL, last_status TEXT NOT NULL,"
+            " failures INTEGER NOT NULL, last_seen REAL NOT NULL, skip_until REAL NOT NULL,"
+            " PRIMARY KEY (kind, payload)) WITHOUT ROWID"
+        )
+
+    def ttl_seconds(self, failures: int) -> float:
+        if failures < self.min_failures:
+            return 0.0
+        return min(self.base_days * 2 ** (failures - self.min_failures), self.max_days) * 86400
+
+    def _load(self) -> Dict[tuple, tuple]:
+        with self.lock:
+            return {
+                (kind, payload): (last_status, failures, last_seen, skip_until)
+                for kind, payload, last_status, failures, last_seen, skip_until in self.conn.execute(
+                    "SELECT kind, payload, last_status, failures, last_seen, skip_until FROM negative")
             }
 
-    recent_429.append(bool(saw_429[0]))
-    if len(recent_429) > ROLLING_WINDOW:
-        recent_429.pop(0)
+    def split(self, items: List[tuple], now: float) -> Tuple[List[tuple], List[tuple], List[tuple]]:
+        """(ítems vivos, [(ítem, último status)] a omitir, [(ítem, último status)] a volver a probar)."""
+        known = self._load()
+        live, skipped, due = [], [], []
+        for item in items:
+            entry = known.get(item)
+            if entry is None or entry[1] < self.min_failures:
+                live.append(item)
+            elif entry[3] > now:
+                skipped.append((item, entry[0]))
+            else:
+                due.append((item, entry[0]))
+        return live, skipped, due
+
+    def record_results(self, rows: Iterable[ResultRow], now: Optional[float] = None) -> Tuple[int, int]:
+        """Suma una falla a los ítems muertos y borra los que dieron OK: (fallas, revividos)."""
+        now = time.time() if now is None else now
+        today = datetime.fromtimestamp(now).date()
+        rows = list(rows)
+        # Las filas omitidas no se pidieron: no cuentan para la proporción.
+        fetched = [row for row in rows if not row["STATUS"].startswith(SKIPPED_STATUS)]
+        dead = sum(1 for row in fetched if row["STATUS"] in NEGATIVE_STATUSES)
+        site_down = bool(fetched) and dead / len(fetched) > self.max_failure_ratio
+        if site_down:
+            print(f"⚠️ Caché negativa: {dead}/{len(fetched)} ítems muertos en esta corrida "
+                  f"(> {self.max_failure_ratio:.0%}); parece falla del sitio, no se registran.")
+        known = self._load()
+        upserts, revived = [], []
+        for row in rows:
+            item = _row_item(row)
+            status = row["STATUS"]
+            if status == "OK":
+                if item in known:
+                    revived.append(item)
+            elif status in NEGATIVE_STATUSES and not site_down:
+                _, failures, last_seen, skip_until = known.get(item, ("", 0, 0.0, 0.0))
+                if failures and datetime.fromtimestamp(last_seen).date() == today:
+                    continue  # ya se contó hoy (p. ej. otra corrida del mismo día)
+                failures += 1
+                upserts.append((*item, status, failures, now, now + self.ttl_seconds(failures)))
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO negative (kind, payload, last_status, failures, last_seen, skip_until)"
+                " VALUES (?, ?, ?, ?, ?, ?)", upserts,
+            )
+            self.conn.executemany("DELETE FROM negative WHERE kind = ? AND payload = ?", revived)
+            self.conn.commit()
+        return len(upserts), len(revived)
 
-    return row
+negative_cache: Optional[NegativeCache] = None  # se arma en init_runtime()
+
+def skipped_row(kind: str, payload: str, last_status: str) -> ResultRow:
+    """Fila para un ítem omitido: aparece en la salida sin costar una petición."""
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    status = f"{SKIPPED_STATUS} ({last_status})"
+    no_fetch = {"attempts": 0, "seconds": 0.0}
+    if kind == "code":
+        return make_result_row(ts, payload, PDP_URL_TEMPLATE.format(code=payload), status, None, no_fetch)
+    return make_result_row(ts, "", payload, status, None, no_fetch)
 
 # ============================================================
 # 8) MAIN CON LOOPS Y GUARDADO POR LOOP
 # ============================================================
-def main() -> List[Dict[str, Any]]:
-    codes = [
-        ln.strip()
-        for ln in INPUT_CODES.splitlines()
-        if ln.strip() and not ln.strip().startswith("#")
-    ]
-    urls = [u.strip() for u in INPUT_URLS if u.strip()]
+def init_runtime():
+    """Abre bitácora, cachés, índice de variantes y exportador según el entorno.
+
+    No se hace al importar: los workers `spawn` de ParseStage reimportan el
+    módulo y solo necesitan el parseo, no las conexiones SQLite ni el índice.
+    Lo que ya esté puesto (p. ej. desde el bench) se respeta.
+    """
+    global metrics_exporter, response_cache, work_journal, variant_resolver, negative_cache
+    if metrics_exporter is None and (os.getenv("METRICS_TEXTFILE") or os.getenv("METRICS_PORT")):
+        metrics_exporter = MetricsExporter(
+            textfile=os.getenv("METRICS_TEXTFILE", ""),
+            port=int(os.getenv("METRICS_PORT", "0")),
+            interval=float(os.getenv("METRICS_INTERVAL", str(METRICS_INTERVAL_DEFAULT))),
+            host=os.getenv("METRICS_HOST", METRICS_HOST_DEFAULT),
+        )
+    if response_cache is None and os.getenv("HTTP_CACHE_DIR"):
+        response_cache = ResponseCache(
+            os.environ["HTTP_CACHE_DIR"],
+            max_bytes=int(float(os.getenv("HTTP_CACHE_MAX_MB", str(HTTP_CACHE_MAX_MB_DEFAULT))) * 1e6),
+            max_age=float(os.getenv("HTTP_CACHE_MAX_AGE_SECONDS", "0")),
+        )
+        # Con validadores guardados dejamos que el CDN conteste 304 por su cuenta.
+        HTTP_HEADERS.pop("Cache-Control", None)
+    if work_journal is None and os.getenv("JOURNAL_DB"):
+        work_journal = WorkJournal(os.environ["JOURNAL_DB"])
+    if variant_resolver.conn is None and os.getenv("SKU_INDEX_DB"):
+        variant_resolver = VariantResolver(os.environ["SKU_INDEX_DB"])
+    if negative_cache is None and os.getenv("NEGATIVE_CACHE_DB"):
+        negative_cache = NegativeCache(
+            os.environ["NEGATIVE_CACHE_DB"],
+            min_failures=int(os.getenv("NEGATIVE_MIN_FAILURES", str(NEGATIVE_MIN_FAILURES_DEFAULT))),
+            base_days=float(os.getenv("NEGATIVE_TTL_BASE_DAYS", str(NEGATIVE_TTL_BASE_DAYS_DEFAULT))),
+            max_days=float(os.getenv("NEGATIVE_TTL_MAX_DAYS", str(NEGATIVE_TTL_MAX_DAYS_DEFAULT))),
+            max_failure_ratio=float(os.getenv("NEGATIVE_MAX_FAILURE_RATIO", str(NEGATIVE_MAX_FAILURE_RATIO_DEFAULT))),
+        )
 
-    items: List[tuple] = [("code", c) for c in codes] + [("url", u) for u in urls]
+def process_item(kind: str, payload: str) -> ResultRow:
+    t0 = time.perf_counter()
+    row = _process_item(kind, payload)
+    stage_metrics.observe("item", time.perf_counter() - t0)
+    stage_metrics.add("items")
+    stage_metrics.count_status(row["STATUS"])
+    return row
+
+def _process_item(kind: str, payload: str) -> ResultRow:
+    try:
+        if kind == "code":
+            return process_code(payload)
+        return process_url(payload)
+    except Exception as e:
+        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if kind == "code":
+            return make_result_row(ts, payload, PDP_URL_TEMPLATE.format(code=payload), f"Error: {e}")
+        return make_result_row(ts, "", payload, f"Error: {e}")
+
+async def run_loop_async(
+    pending_items: List[tuple],
+    loop_idx: int,
+    time_budget: float,
+    concurrency: int,
+    all_results: List[ResultRow],
+    sink: Optional[ResultSink] = None,
+) -> List[tuple]:
+    """Procesa un loop con hasta `concurrency` ítems en vuelo.
+
+    Los ítems se arrancan en orden; los que no alcanzaron a arrancar antes de
+    agotar `time_budget` se regresan como pendientes. Las filas se imprimen
+    conforme terminan (y van directo a `sink`) y se agregan a `all_results`
+    en el orden de entrada.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    loop_start = time.time()
+    slots = asyncio.Semaphore(concurrency)
+    rows: Dict[int, ResultRow] = {}
+    tasks = []
+    next_pending: List[tuple] = []
+    total = len(pending_items)
+    stage_metrics.set_gauge("loop_actual", loop_idx)
+    stage_metrics.set_gauge("loop_items", 0, loop=loop_idx, estado="terminados")
+    stage_metrics.set_gauge("loop_items", total, loop=loop_idx, estado="pendientes")
+
+    async def worker(i: int, kind: str, payload: str):
+        if work_journal:
+            work_journal.mark_in_flight(kind, payload)
+        try:
+            row = await loop.run_in_executor(pool, process_item, kind, payload)
+        finally:
+            slots.release()
+        rows[i] = row
+        with stage_metrics.timed("guardar"):
+            if work_journal:
+                work_journal.mark_result(kind, payload, row)
+            if sink is not None:
+                sink.write(row)
+        stage_metrics.add_gauge("loop_items", 1, loop=loop_idx, estado="terminados")
+        stage_metrics.add_gauge("loop_items", -1, loop=loop_idx, estado="pendientes")
+        print(f"[Loop {loop_idx}] [{i}/{total}] {payload} -> {row['STATUS']}")
+        print(row_to_tsv(row))
+        sys.stdout.flush()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i, (kind, payload) in enumerate(pending_items, 1):
+            await slots.acquire()
+            elapsed = time.time() - loop_start
+            if elapsed >= time_budget:
+                slots.release()
+                print(f"\n⏰ Se alcanzó el límite de tiempo ({elapsed:.0f}s) en el loop {loop_idx}.")
+                print("   Lo que falta se marcará como pendiente para el siguiente loop.")
+                next_pending = pending_items[i-1:]
+                break
+            tasks.append(asyncio.create_task(worker(i, kind, payload)))
+
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    all_results.extend(rows[i] for i in sorted(rows))
+    return next_pending
+
+def iter_items() -> Iterator[tuple]:
+    """Ítems de la corrida sin duplicados: del catálogo (CATALOG) o de INPUT_CODES/INPUT_URLS."""
+    if os.getenv("CATALOG"):
+        tags = [t.strip() for t in os.getenv("CATALOG_TAGS", "").split(",") if t.strip()]
+        only_failed = os.getenv("CATALOG_ONLY_FAILED") == "1"
+        if is_sqlite_catalog(os.environ["CATALOG"]):
+            catalog = SkuCatalog(os.environ["CATALOG"])
+            try:
+                yield from dedupe_items(catalog.iter_items(tags, only_failed))
+            finally:
+                catalog.close()
+        else:
+            if only_failed:
+                print("⚠️ CATALOG_ONLY_FAILED solo aplica a catálogos SQLite; se ignora.")
+            yield from dedupe_items(iter_catalog_file(os.environ["CATALOG"], tags))
+        return
+    yield from dedupe_items(builtin_items())
+
+def build_items() -> List[tuple]:
+    return list(iter_items())
+
+run_delta_path: Optional[str] = None  # lo deja finalize_outputs() para el correo
+
+def finalize_outputs(csv_path: str = RESULTS_CSV) -> Optional[str]:
+    """XLSX, Parquet, delta y metadatos del catálogo a partir del CSV completo de la corrida.
+
+    Regresa la ruta del delta escrito en esta corrida (None si no hubo delta).
+    """
+    global run_delta_path
+    if os.getenv("CATALOG") and is_sqlite_catalog(os.environ["CATALOG"]):
+        catalog = SkuCatalog(os.environ["CATALOG"])
+        with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+            updated = catalog.record_results(csv.DictReader(f))
+        catalog.close()
+        print(f"📚 Catálogo: {updated} SKUs con último estado actualizado.")
+    with stage_metrics.timed("xlsx"):
+        build_xlsx_from_csv(csv_path, RESULTS_XLSX)
+    print(f"💾 Guardados '{csv_path}' y '{RESULTS_XLSX}'.")
+    if os.getenv("PARQUET_DIR"):
+        with stage_metrics.timed("parquet"):
+            try:
+                write_parquet_partition(csv_path, os.environ["PARQUET_DIR"])
+            except Exception as e:
+                # El Parquet es una salida secundaria: no debe tumbar la corrida ni el correo.
+                print(f"⚠️ No se pudo escribir Parquet en '{os.environ['PARQUET_DIR']}': {e}")
+    # Un delta de otra corrida no debe salir en el correo como si fuera el de hoy.
+    if os.path.exists(DELTA_CSV):
+        os.remove(DELTA_CSV)
+    run_delta_path = None
+    if os.getenv("SNAPSHOT_DB"):
+        with stage_metrics.timed("delta"):
+            run_delta_path = compute_delta(csv_path, os.environ["SNAPSHOT_DB"], DELTA_CSV)
+    return run_delta_path
+
+def main() -> List[ResultRow]:
+    run_start = time.time()
+    init_runtime()
+    shard_index, shard_count = shard_config()
+    # La lista del shard se arma completa antes de empezar: la bitácora, el
+    # planificador y la caché negativa trabajan sobre todos los ítems a la vez.
+    items = select_shard(iter_items(), shard_index, shard_count)
+    variant_resolver.new_run()
+    if shard_count > 1:
+        rate_controller.split(shard_count)
+        print(f"🧩 Shard {shard_index} (de {shard_count}): {len(items)} ítems, "
+              f"ritmo {rate_controller.rate:.2f} req/s (1/{shard_count} del total).")
     total = len(items)
+    csv_path = shard_path(RESULTS_CSV, shard_index, shard_count)
+    pending_path = shard_path(PENDING_TXT, shard_index, shard_count)
+
+    if os.getenv("PRIORITY_SCHEDULER") == "1" and os.getenv("SNAPSHOT_DB"):
+        items = schedule_items(items, os.environ["SNAPSHOT_DB"])
 
     print(f"Procesando {total} ítems de Liverpool…\n")
+    if metrics_exporter:
+        metrics_exporter.start()
     print_header_once()
 
     time_budget = float(os.getenv("TIME_BUDGET_SECONDS", str(DEFAULT_TIME_BUDGET_SECONDS)))
     max_loops = int(os.getenv("MAX_LOOPS", str(MAX_LOOPS_DEFAULT)))
+    concurrency = max(1, int(os.getenv("CONCURRENCY", str(CONCURRENCY_DEFAULT))))
 
-    all_results: List[Dict[str, Any]] = []
+    all_results: List[ResultRow] = []
     pending_items = items
-
+    sink = ResultSink(csv_path)
+
+    if work_journal:
+        done = work_journal.resume(items, datetime.now().strftime("%Y-%m-%d"))
+        if done:
+            print(f"📒 Reanudando: {len(done)} ítems ya capturados hoy según la bitácora.")
+            for item in items:
+                if item in done:
+                    sink.write(done[item])
+                    all_results.append(done[item])
+            pending_items = [item for item in items if item not in done]
+
+    def add_row(kind: str, payload: str, row: ResultRow):
+        """Fila resuelta sin pasar por los loops (listados, omitidos)."""
+        stage_metrics.add("items")
+        stage_metrics.count_status(row["STATUS"])
+        if work_journal:
+            work_journal.mark_result(kind, payload, row)
+        sink.write(row)
+        all_results.append(row)
+
+    listing = None
+    found = None
+    if (os.getenv("LISTING_PRICES") or os.getenv("LISTING_URLS")) and not pending_items:
+        print("\n🗂️ La bitácora ya cubre todos los ítems; no se piden los listados.")
+    elif os.getenv("LISTING_PRICES"):
+        # Listados ya recorridos una sola vez (`listings`) para todos los shards.
+        if os.path.exists(os.environ["LISTING_PRICES"]):
+            found, pages, _ = load_listing_prices(os.environ["LISTING_PRICES"])
+            pages_fetched = 0
+            print(f"\n🗂️ {len(found)} precios de listados leídos de '{os.environ['LISTING_PRICES']}'.")
+        else:
+            print(f"\n⚠️ No existe '{os.environ['LISTING_PRICES']}'; todo va a PDP.")
+    elif os.getenv("LISTING_URLS"):
+        if shard_count > 1:
+            print("⚠️ Cada shard va a recorrer todos los listados; para pedirlos una sola vez "
+                  "corre `listings` antes y pasa el resultado en LISTING_PRICES.")
+        print(f"\n🗂️ Buscando precios en los listados de '{os.environ['LISTING_URLS']}'…")
+        with stage_metrics.timed("listados"):
+            found, pages, pages_fetched = discover_listing_prices(
+                read_listing_urls(os.environ["LISTING_URLS"]), concurrency,
+                int(os.getenv("LISTING_MAX_PAGES", str(LISTING_MAX_PAGES_DEFAULT))),
+            )
+    if found is not None:
+        bulk, pending_items, sample = apply_listing_prices(
+            pending_items, found, int(os.getenv("LISTING_VERIFY", str(LISTING_VERIFY_DEFAULT))),
+        )
+        for kind, payload in bulk:
+            add_row(kind, payload, listing_row(payload, found[payload]))
+        listing = (found, pages, pages_fetched, bulk, sample)
+        print(f"🗂️ {len(bulk)} ítems resueltos desde listados; {len(pending_items)} van a PDP "
+              f"({len(sample)} de ellos para verificar).")
+
+    # Los muertos conocidos no gastan turno: se omiten o, si ya venció su TTL,
+    # se vuelven a probar después de todo lo demás.
+    negative_due: List[tuple] = []
+    if negative_cache:
+        pending_items, skipped, negative_due = negative_cache.split(pending_items, time.time())
+        for (kind, payload), last_status in skipped:
+            add_row(kind, payload, skipped_row(kind, payload, last_status))
+        if skipped or negative_due:
+            print(f"🪦 {len(skipped)} ítems omitidos por fallas seguidas; "
+                  f"{len(negative_due)} se vuelven a probar al final si alcanza el tiempo.")
+
+    import asyncio
+
+    loops_start = time.time()
     for loop_idx in range(1, max_loops + 1):
         if not pending_items:
             print(f"\n✅ No hay pendientes para el loop {loop_idx}. Terminamos.")
             break
 
         print(f"\n================ LOOP {loop_idx}/{max_loops} - {len(pending_items)} ítems pendientes ================")
-        loop_start = time.time()
-        next_pending: List[tuple] = []
-
-        for i, (kind, payload) in enumerate(pending_items, 1):
-            elapsed = time.time() - loop_start
-            if elapsed >= time_budget:
-                print(f"\n⏰ Se alcanzó el límite de tiempo ({elapsed:.0f}s) en el loop {loop_idx}.")
-                print("   Lo que falta se marcará como pendiente para el siguiente loop.")
-                next_pending = pending_items[i-1:]
-                break
-
-            try:
-                if kind == "code":
-                    row = process_code(payload)
-                else:
-                    row = process_url(payload)
-
-                all_results.append(row)
-                print(f"[Loop {loop_idx}] [{i}/{len(pending_items)}] {payload} -> {row['STATUS']}")
-                print(row_to_tsv(row))
-                sys.stdout.flush()
+        next_pending = asyncio.run(run_loop_async(
+            pending_items, loop_idx, time_budget, concurrency, all_results, sink
+        ))
 
-            except Exception as e:
-                ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                err_row = {
-                    "TIMESTAMP": ts,
-                    "SKU": payload if kind == "code" else "",
-                    "URL_PDP": PDP_URL_TEMPLATE.format(code=payload) if kind == "code" else payload,
-                    "CODIGO_PRODUCTO": "",
-                    "TITULO": "",
-                    "PRECIO_REGULAR_NUM": "",
-                    "PRECIO_DESCUENTO_NUM": "",
-                    "VENDEDOR": "",
-                    "STATUS": f"Error: {e}",
-                }
-                all_results.append(err_row)
-                print(f"[Loop {loop_idx}] [{i}/{len(pending_items)}] {payload} -> Error: {e}")
-                print(row_to_tsv(err_row))
-                sys.stdout.flush()
-
-        save_results(all_results)
+        print(f"💾 {sink.rows_written} filas acumuladas en '{csv_path}'.")
         pending_items = next_pending
 
+    if negative_due:
+        # Pasada de baja prioridad: solo si no quedó trabajo vivo y con el tiempo que sobró.
+        probe_max = int(os.getenv("NEGATIVE_PROBE_MAX", str(NEGATIVE_PROBE_MAX_DEFAULT)))
+        left = time_budget * max_loops - (time.time() - loops_start)
+        probe = [item for item, _ in negative_due[:probe_max]] if not pending_items and left > 0 else []
+        not_probed = []
+        if probe:
+            print(f"\n================ REPRUEBA - {len(probe)} ítems muertos con TTL vencido ================")
+            not_probed = asyncio.run(run_loop_async(
+                probe, max_loops + 1, min(time_budget, left), concurrency, all_results, sink
+            ))
+        not_probed = set(not_probed) | {item for item, _ in negative_due[len(probe):]}
+        for item, last_status in negative_due:
+            if item in not_probed:
+                add_row(*item, skipped_row(*item, last_status))
+
+    sink.close()
+    parse_stage.close()
+    if negative_cache:
+        failed, revived = negative_cache.record_results(all_results)
+        print(f"🪦 Caché negativa: {failed} fallas registradas, {revived} ítems revividos.")
+    if not sink.rows_written:
+        print("⚠️ No hubo resultados; el CSV solo trae encabezados.")
+    if shard_count > 1:
+        # XLSX, Parquet y delta se generan una sola vez en el merge.
+        print(f"💾 Guardado '{csv_path}'.")
+    else:
+        finalize_outputs(csv_path)
+
     if pending_items:
-        with open("liverpool_pendientes.txt", "w", encoding="utf-8") as f:
+        with open(pending_path, "w", encoding="utf-8") as f:
             for kind, payload in pending_items:
                 f.write(payload + "\n")
-        print(f"\n⚠️ Quedaron {len(pending_items)} ítems pendientes. Guardados en 'liverpool_pendientes.txt'.")
+        print(f"\n⚠️ Quedaron {len(pending_items)} ítems pendientes. Guardados en '{pending_path}'.")
     else:
         print("\n✅ No quedaron pendientes.")
 
+    if work_journal:
+        print(f"\n📒 Bitácora de hoy: {work_journal.counts()}")
+    if response_cache:
+        print(f"\n🗄️ Caché HTTP: {response_cache.summary()}")
+    if parse_cache:
+        print(f"🧠 Caché de parseo: {parse_cache.summary()}")
+    if next_data_route:
+        print(f"⚡ Ruta /_next/data: {next_data_route.summary()}")
+    if variant_resolver.counts["reusadas"] or variant_resolver.conn is not None:
+        print(f"🧬 Variantes: {variant_resolver.summary()}")
+    if listing:
+        report = listing_report(items, *listing, all_results)
+        listing_path = shard_path(LISTING_REPORT_JSON, shard_index, shard_count)
+        write_run_report(report, listing_path)
+        print(f"\n🗂️ {format_listing_report(report)}\n   Detalle en '{listing_path}'.")
+
+    if metrics_exporter:
+        metrics_exporter.stop()
+    report = stage_metrics.report(time.time() - run_start)
+    report["reintentos"] = retry_policy.metrics()
+    write_run_report(report, shard_path(RUN_REPORT_JSON, shard_index, shard_count))
+    print("\n📊 " + format_run_report(report))
+
     print("\n🎉 Proceso terminado.")
     return all_results
 
 # ============================================================
 # 9) EMAIL (para GitHub: lee credenciales de variables de entorno)
 # ============================================================
-import smtplib
-import ssl
-from email.message import EmailMessage
-
 def enviar_resultados_por_mail(
     sender: str,
     password: str,
     recipients: str,
     archivos_adjuntos=None,
-    asunto: str = "Resultados scraper Liverpool"
+    asunto: str = "Resultados scraper Liverpool",
+    resumen: str = "",
+    mensaje: str = "Te mando los archivos generados por el scraper de Liverpool.",
 ):
+    import smtplib
+    import ssl
+    from email.message import EmailMessage
+
     if archivos_adjuntos is None:
         archivos_adjuntos = []
 
@@ -900,10 +3738,12 @@ def enviar_resultados_por_mail(
 
     cuerpo = (
         "Hola Abraham,\n\n"
-        "Te mando los archivos generados por el scraper de Liverpool.\n\n"
+        f"{mensaje}\n\n"
         "Si ves varios correos en el mismo día, corresponden a diferentes ejecuciones del scraper.\n\n"
         "Saludos."
     )
+    if resumen:
+        cuerpo += "\n\n" + "-" * 60 + "\n" + resumen
     msg.set_content(cuerpo)
 
     for filename in archivos_adjuntos:
@@ -931,17 +3771,71 @@ def enviar_resultados_por_mail(
 # 10) Punto de entrada para GitHub Actions
 # ============================================================
 def run():
-    results = main()
+    if sys.argv[1:2] == ["catalog-import"]:
+        # python liverpool_scraper.py catalog-import catalogo.db [lista.txt] [tag ...]
+        args = sys.argv[2:]
+        source = args[1] if len(args) > 1 else ""
+        import_catalog(args[0], source, args[2:])
+        return
+    if sys.argv[1:2] == ["listings"]:
+        # python liverpool_scraper.py listings [salida.json]  (lee LISTING_URLS)
+        init_runtime()
+        found, pages, fetched = discover_listing_prices(
+            read_listing_urls(os.environ["LISTING_URLS"]),
+            max(1, int(os.getenv("CONCURRENCY", str(CONCURRENCY_DEFAULT)))),
+            int(os.getenv("LISTING_MAX_PAGES", str(LISTING_MAX_PAGES_DEFAULT))),
+        )
+        out = sys.argv[2] if len(sys.argv) > 2 else LISTING_PRICES_JSON
+        save_listing_prices(out, found, pages, fetched)
+        print(f"🗂️ {len(found)} productos en {fetched} páginas de listado -> '{out}'.")
+        return
+    if sys.argv[1:2] == ["merge"]:
+        # python liverpool_scraper.py merge [carpeta_con_shards]
+        started = time.time()
+        shard_dir = sys.argv[2] if len(sys.argv) > 2 else "."
+        merged = merge_shards(shard_dir)
+        if merged:
+            finalize_outputs(RESULTS_CSV)
+        else:
+            # Fallaron todos los shards: no hay CSV que convertir, pero sí hay que avisar.
+            print("⚠️ Ningún shard dejó filas; no se generan XLSX, Parquet ni delta.")
+        print("\n📊 " + format_run_report(merge_run_reports(shard_dir, started)))
+    else:
+        merged = None
+        main()
+        if shard_config()[1] > 1:
+            print("📨 Corrida por shard: el correo lo manda el paso de merge.")
+            return
+
     sender = os.environ.get("EMAIL_SENDER")
     password = os.environ.get("EMAIL_PASSWORD")
     recipients = os.environ.get("EMAIL_TO")
 
+    resumen = ""
+    if os.path.exists(RUN_REPORT_JSON):
+        with open(RUN_REPORT_JSON, "r", encoding="utf-8") as f:
+            resumen = format_run_report(json.load(f))
+
+    adjuntos = [RESULTS_CSV, RESULTS_XLSX]
+    if os.getenv("EMAIL_ONLY_DELTA") == "1" and run_delta_path:
+        adjuntos = [run_delta_path]
+    aviso = {}
+    if merged == 0:
+        adjuntos = []
+        aviso = {
+            "asunto": "⚠️ Scraper Liverpool: corrida sin resultados",
+            "mensaje": "La corrida de hoy no dejó resultados: ningún shard subió filas. "
+                       "Revisa los logs de los jobs en GitHub Actions.",
+        }
+
     if sender and password and recipients:
         enviar_resultados_por_mail(
             sender=sender,
             password=password,
             recipients=recipients,
-            archivos_adjuntos=["liverpool_datos.csv", "liverpool_datos.xlsx"],
+            archivos_adjuntos=adjuntos,
+            resumen=resumen,
+            **aviso,
         )
     else:
         print("⚠️ EMAIL_SENDER / EMAIL_PASSWORD / EMAIL_TO no configuradas; no se envía correo.")